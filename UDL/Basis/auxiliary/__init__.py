@@ -1,2 +1,3 @@
-from ..auxiliary.utils import AverageMeter, accuracy, MetricLogger, SmoothedValue, set_random_seed
+from ..auxiliary.utils import AverageMeter, accuracy, MetricLogger, SmoothedValue, set_random_seed, get_rng_state, set_rng_state, \
+    autocast_fp32
 from ..auxiliary.logger import create_logger, print_log, get_root_logger
\ No newline at end of file
@@ -10,7 +10,7 @@ import numpy as np
 import random
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
-from functools import partial
+from functools import partial, wraps
 
 
 def set_random_seed(seed):
@@ -22,6 +22,45 @@ def set_random_seed(seed):
     cudnn.deterministic = True
 
 
+def get_rng_state():
+    """python, numpy, torch (and cuda) random states, restored by ``set_rng_state``."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if state.get('cuda') is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def autocast_fp32(func):
+    """Run ``func`` outside of autocast with its floating tensors promoted to fp32.
+
+    Used for numerically sensitive parts (ssim loss, metrics, softmax) under bf16/fp16 training.
+    """
+
+    def _to_fp32(v):
+        if isinstance(v, torch.Tensor) and v.is_floating_point():
+            return v.float()
+        return v
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        device_type = next((v.device.type for v in list(args) + list(kwargs.values())
+                            if isinstance(v, torch.Tensor)), 'cpu')
+        with torch.autocast(device_type=device_type, enabled=False):
+            args = [_to_fp32(v) for v in args]
+            kwargs = {k: _to_fp32(v) for k, v in kwargs.items()}
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
 def show_memory_info(hint):
     pid = os.getpid()
     p = psutil.Process(pid)
@@ -249,6 +288,18 @@ class MetricLogger(object):
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
+    def state_dict(self):
+        return {k: {'deque': list(m.deque), 'val': m.val, 'total': m.total, 'count': m.count}
+                for k, m in self.meters.items()}
+
+    def load_state_dict(self, state_dict):
+        for k, state in state_dict.items():
+            meter = self.meters[k]
+            meter.deque.clear()
+            meter.deque.extend(state['deque'])
+            meter.val, meter.total, meter.count = state['val'], state['total'], state['count']
+            meter.avg = meter.total / meter.count if meter.count else 0
+
     def log_every(self, iterable, print_freq, header=None):
         i = 1
         if not header:
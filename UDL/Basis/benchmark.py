@@ -0,0 +1,402 @@
+"""
+Cross-variant cost benchmark: params, FLOPs, cpu forward/backward latency and peak RSS
+of every builder found under UDL/hisr/HISR/*, UDL/pansharpening/models and UDL/derain/compared_*.
+
+usage:
+    python -m UDL.Basis.benchmark --list
+    python -m UDL.Basis.benchmark --filter "PSRT_KAv2[0-9]|Swin_poolv30" --size 64 --out results/benchmark
+    python -m UDL.Basis.benchmark --dynamic-conv --windows 4 16 64 --widths 32 64 128 --out results/dynconv
+    python -m UDL.Basis.benchmark --channels-last --filter "FusionNet|PanNet|Swin_poolv30" --out results/channels_last
+"""
+import argparse
+import ast
+import contextlib
+import csv
+import importlib
+import io
+import multiprocessing as mp
+import os
+import re
+import sys
+import time
+import traceback
+import numpy as np
+import torch
+import torch.nn.functional as F
+from UDL.Basis.module import dynamic_depthwise_conv2d, enable_channels_last, to_channels_last
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from fvcore.nn import FlopCountAnalysis
+except ImportError:
+    FlopCountAnalysis = None
+    print("you don't install fvcore. [Optional] pip install fvcore to count FLOPs.")
+
+UDL_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(UDL_ROOT)
+
+# task: glob-like roots (relative to UDL/) scanned for builders
+SEARCH_ROOTS = {
+    'hisr': ['hisr/HISR'],
+    'pansharpening': ['pansharpening/models'],
+    'derain': ['derain/compared_CNN', 'derain/compared_trans'],
+}
+
+FIELDS = ['name', 'task', 'module', 'builder', 'params(M)', 'FLOPs(G)', 'fwd(ms)', 'bwd(ms)',
+          'peak_rss(MB)', 'rss_delta(MB)', 'status']
+CHANNELS_LAST_FIELDS = ['name', 'task', 'module', 'builder', 'params(M)', 'fwd(ms)', 'fwd_cl(ms)', 'fwd_speedup',
+                        'bwd(ms)', 'bwd_cl(ms)', 'bwd_speedup', 'cl_err', 'status']
+
+
+def find_builders(roots=SEARCH_ROOTS):
+    """Statically collect ``def build(args)`` / ``def build_xxx(args)`` returning (model, criterion, ...).
+
+    Modules are parsed, not imported, so broken or py2 files are skipped cheaply.
+    """
+    entries = []
+    for task, dirs in roots.items():
+        for d in dirs:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(UDL_ROOT, d)):
+                dirnames[:] = sorted(n for n in dirnames if n not in ('bak', '__pycache__'))
+                for fname in sorted(filenames):
+                    if not fname.endswith('.py') or fname == '__init__.py':
+                        continue
+                    path = os.path.join(dirpath, fname)
+                    for func in _parse_builders(path):
+                        rel = os.path.relpath(path, REPO_ROOT)[:-3]
+                        entries.append({'task': task, 'module': rel.replace(os.sep, '.'), 'builder': func,
+                                        'name': _entry_name(os.path.join(UDL_ROOT, d), dirpath, fname, func)})
+    return entries
+
+
+def _parse_builders(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+    except (SyntaxError, UnicodeDecodeError, ValueError):
+        return []
+    funcs = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef) or not re.fullmatch(r'build(_\w+)?', node.name):
+            continue
+        if [a.arg for a in node.args.args] != ['args']:
+            continue
+        # builders hand back (model, criterion[, optimizer, scheduler]); helpers return a single module
+        if any(isinstance(n, ast.Return) and isinstance(n.value, ast.Tuple) and len(n.value.elts) >= 2
+               for n in ast.walk(node)):
+            funcs.append(node.name)
+    return funcs
+
+
+def _entry_name(root, dirpath, fname, func):
+    name = os.path.relpath(dirpath, root).replace(os.sep, '/')
+    if not fname.startswith(('model_', 'main_')) or func != 'build':
+        name = f"{name}/{fname[:-3]}:{func}"
+    return name
+
+
+def make_batch(task, batch_size=1, size=64, scale=4, hsi_bands=31, ms_bands=8):
+    """Synthetic batches with the keys each task's train_step reads."""
+    B, H = batch_size, size
+    if task == 'hisr':
+        return {'gt': torch.rand(B, hsi_bands, H, H), 'up': torch.rand(B, hsi_bands, H, H),
+                'lrhsi': torch.rand(B, hsi_bands, H // scale, H // scale), 'rgb': torch.rand(B, 3, H, H)}
+    if task == 'pansharpening':
+        return {'gt': torch.rand(B, ms_bands, H, H), 'lms': torch.rand(B, ms_bands, H, H),
+                'mms': torch.rand(B, ms_bands, H // 2, H // 2), 'ms': torch.rand(B, ms_bands, H // 4, H // 4),
+                'ms_hp': torch.rand(B, ms_bands, H // 4, H // 4),
+                'pan': torch.rand(B, 1, H, H), 'pan_hp': torch.rand(B, 1, H, H)}
+    return {'O': torch.rand(B, 3, H, H), 'B': torch.rand(B, 3, H, H)}
+
+
+def load_args(entry, device):
+    """The variant's own option module if it has one, else the task defaults."""
+    from UDL.Basis.config import Config
+    from UDL.Basis import option
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        pkg = entry['module'].rsplit('.', 1)[0]
+        pkg_dir = os.path.join(REPO_ROOT, *pkg.split('.'))
+        args = None
+        for fname in sorted(os.listdir(pkg_dir)):
+            if fname.startswith('option') and fname.endswith('.py'):
+                mod = importlib.import_module(f"{pkg}.{fname[:-3]}")
+                args = getattr(mod, 'cfg', None) or getattr(mod, 'args', None)
+                if args is not None:
+                    break
+        if args is None:
+            args = Config(getattr(option, {'pansharpening': 'panshaprening_cfg'}.get(
+                entry['task'], f"{entry['task']}_cfg"))())
+    finally:
+        sys.argv = argv
+    args.device = device
+    args.global_rank = 0
+    for k, v in {'dataset': 'wv3' if entry['task'] == 'pansharpening' else 'cave_x4', 'lr': 1e-4}.items():
+        if getattr(args, k, None) is None:
+            setattr(args, k, v)
+    return args
+
+
+def _first_tensor(out):
+    if isinstance(out, torch.Tensor):
+        return out
+    if isinstance(out, dict):
+        out = list(out.values())
+    if isinstance(out, (list, tuple)):
+        for v in out:
+            t = _first_tensor(v)
+            if t is not None:
+                return t
+    return None
+
+
+def capture_inputs(model, batch, step='train_step'):
+    """Run one ``train_step`` (or ``step``) and record the positional inputs of the top-level forward."""
+    if not hasattr(model, step):
+        return (next(iter(batch.values())),)
+    captured = []
+    forward = model.forward
+
+    def recorder(*inputs, **kwargs):
+        if not captured:
+            captured.append(inputs)
+        return forward(*inputs, **kwargs)
+
+    model.forward = recorder
+    try:
+        getattr(model, step)(batch)
+    finally:
+        del model.forward
+    return captured[0]
+
+
+def _timeit(fn, warmup, repeat, device):
+    times = []
+    for i in range(warmup + repeat):
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        fn()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append(time.perf_counter() - t)
+    return float(np.median(times)) * 1e3
+
+
+def _peak_rss_mb():
+    if resource is not None:
+        # ru_maxrss is KB on linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024 ** 2
+    import psutil
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+
+
+def benchmark_entry(entry, cfg):
+    row = {k: entry[k] for k in ('name', 'task', 'module', 'builder')}
+    rss0 = _peak_rss_mb()
+    torch.manual_seed(0)
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, cfg.device)
+        module = importlib.import_module(entry['module'])
+        model = getattr(module, entry['builder'])(args)[0].to(cfg.device)
+    row['params(M)'] = round(sum(p.numel() for p in model.parameters()) / 1e6, 4)
+
+    batch = {k: v.to(cfg.device) for k, v in make_batch(entry['task'], cfg.batch_size, cfg.size, cfg.scale,
+                                                         cfg.hsi_bands, cfg.ms_bands).items()}
+    with contextlib.redirect_stdout(io.StringIO()):
+        inputs = capture_inputs(model, batch)
+
+    model.eval()
+    if FlopCountAnalysis is not None:
+        try:
+            with torch.no_grad():
+                # traced at aten level, so functional F.conv2d / matmul in dynamic-kernel blocks are counted
+                flops = FlopCountAnalysis(model, inputs).unsupported_ops_warnings(False) \
+                    .uncalled_modules_warnings(False).total()
+            row['FLOPs(G)'] = round(flops / 1e9, 4)
+        except Exception as e:
+            row['status'] = f"flops: {type(e).__name__}"
+
+    row['fwd(ms)'], row['bwd(ms)'] = _time_fwd_bwd(model, inputs, cfg)
+
+    if cfg.channels_last:
+        model.eval()
+        with torch.no_grad():
+            ref = _first_tensor(model(*inputs))
+            enable_channels_last(model)
+            inputs = to_channels_last(inputs)
+            out = _first_tensor(model(*inputs))
+        row['cl_err'] = f"{((out - ref).abs().max() / ref.abs().max().clamp(min=1e-12)).item():.1e}"
+        row['fwd_cl(ms)'], row['bwd_cl(ms)'] = _time_fwd_bwd(model, inputs, cfg)
+        row['fwd_speedup'] = round(row['fwd(ms)'] / row['fwd_cl(ms)'], 2)
+        row['bwd_speedup'] = round(row['bwd(ms)'] / row['bwd_cl(ms)'], 2)
+
+    peak = _peak_rss_mb()
+    row['peak_rss(MB)'] = round(peak, 1)
+    row['rss_delta(MB)'] = round(peak - rss0, 1)
+    row.setdefault('status', 'ok')
+    return row
+
+
+def _time_fwd_bwd(model, inputs, cfg):
+    """Median eval forward and train backward latency (ms)."""
+    model.eval()
+    with torch.no_grad():
+        fwd = _timeit(lambda: model(*inputs), cfg.warmup, cfg.repeat, cfg.device)
+
+    model.train()
+    bwd = []
+
+    def fwd_bwd():
+        loss = _first_tensor(model(*inputs)).float().mean()
+        t = time.perf_counter()
+        loss.backward()
+        bwd.append(time.perf_counter() - t)
+        model.zero_grad(set_to_none=True)
+
+    _timeit(fwd_bwd, cfg.warmup, cfg.repeat, cfg.device)
+    return round(fwd, 2), round(float(np.median(bwd[cfg.warmup:])) * 1e3, 2)
+
+
+def _worker(entry, cfg, queue):
+    torch.set_num_threads(cfg.threads)
+    try:
+        queue.put(benchmark_entry(entry, cfg))
+    except Exception as e:
+        queue.put({**{k: entry[k] for k in ('name', 'task', 'module', 'builder')},
+                   'status': f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}",
+                   'traceback': traceback.format_exc()})
+
+
+def run(entries, cfg):
+    """One spawned process per builder so peak RSS and imported modules do not leak across variants."""
+    ctx = mp.get_context('spawn')
+    rows = []
+    for i, entry in enumerate(entries):
+        queue = ctx.Queue()
+        p = ctx.Process(target=_worker, args=(entry, cfg, queue), daemon=True)
+        p.start()
+        try:
+            row = queue.get(timeout=cfg.timeout)
+        except Exception:
+            row = {k: entry[k] for k in ('name', 'task', 'module', 'builder')}
+            row['status'] = 'timeout' if p.is_alive() else f"crashed (exitcode {p.exitcode})"
+        p.join(5)
+        if p.is_alive():
+            p.kill()
+        if cfg.verbose and 'traceback' in row:
+            print(row['traceback'])
+        row.pop('traceback', None)
+        print(f"[{i + 1}/{len(entries)}] {row['name']}: {row['status']}")
+        rows.append(row)
+    return rows
+
+
+DYNCONV_FIELDS = ['windows', 'channels', 'size', 'repeat(ms)', 'folded(ms)', 'folded_sum(ms)', 'speedup',
+                  'max_err']
+
+
+def benchmark_dynamic_conv(cfg):
+    """Per-sample, per-window depthwise kernels: the repeat + grouped conv the models used to run
+    against module.dynamic_depthwise_conv2d (all n responses, and reduce='sum')."""
+    rows = []
+    k = 3
+    for n in cfg.windows:
+        for C in cfg.widths:
+            B, H = cfg.batch_size, cfg.size
+            x = torch.randn(B, C, H, H, device=cfg.device)
+            kernels = torch.randn(B, n, C, k, k, device=cfg.device)
+
+            def repeat():
+                y = x.repeat(1, n, 1, 1).reshape(1, B * n * C, H, H)
+                y = F.conv2d(y, kernels.reshape(B * n * C, 1, k, k), padding=1, groups=B * n * C)
+                return y.view(B, n, C, H, H)
+
+            with torch.no_grad():
+                err = (repeat() - dynamic_depthwise_conv2d(x, kernels, padding=1)).abs().max().item()
+                row = {'windows': n, 'channels': C, 'size': H, 'max_err': f"{err:.1e}",
+                       'repeat(ms)': _timeit(repeat, cfg.warmup, cfg.repeat, cfg.device),
+                       'folded(ms)': _timeit(lambda: dynamic_depthwise_conv2d(x, kernels, padding=1),
+                                             cfg.warmup, cfg.repeat, cfg.device),
+                       'folded_sum(ms)': _timeit(lambda: dynamic_depthwise_conv2d(x, kernels, padding=1,
+                                                                                  reduce='sum'),
+                                                 cfg.warmup, cfg.repeat, cfg.device)}
+            row['speedup'] = round(row['repeat(ms)'] / row['folded(ms)'], 2)
+            for key in ('repeat(ms)', 'folded(ms)', 'folded_sum(ms)'):
+                row[key] = round(row[key], 3)
+            print(' '.join(f"{key}={row[key]}" for key in DYNCONV_FIELDS))
+            rows.append(row)
+    return rows
+
+
+def write_table(rows, out, fields=FIELDS):
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    cols = [k for k in fields if k not in ('module', 'builder')]
+    with open(out + '.md', 'w') as f:
+        f.write('| ' + ' | '.join(cols) + ' |\n')
+        f.write('|' + '---|' * len(cols) + '\n')
+        for row in rows:
+            f.write('| ' + ' | '.join(str(row.get(k, '')) for k in cols) + ' |\n')
+    print(f"saved {out}.csv and {out}.md")
+
+
+def benchmark_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='Cross-variant params/FLOPs/latency/memory benchmark')
+    parser.add_argument('--list', action='store_true', help='only list the discovered builders')
+    parser.add_argument('--task', default=None, choices=list(SEARCH_ROOTS.keys()))
+    parser.add_argument('--filter', default=None, type=str, help='regex on the builder name or module')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--size', default=64, type=int, help='HR spatial size of the synthetic inputs')
+    parser.add_argument('--scale', default=4, type=int, help='hisr upsampling ratio of lrhsi')
+    parser.add_argument('--hsi-bands', default=31, type=int)
+    parser.add_argument('--ms-bands', default=8, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--timeout', default=600, type=float, help='seconds per builder')
+    parser.add_argument('--out', default='benchmark', type=str, help='writes <out>.csv and <out>.md')
+    parser.add_argument('--verbose', action='store_true', help='print tracebacks of failed builders')
+    parser.add_argument('--dynamic-conv', action='store_true',
+                        help='microbenchmark the per-window dynamic depthwise conv instead of the builders')
+    parser.add_argument('--windows', default=[4, 16, 64], type=int, nargs='+', help='kernels per sample')
+    parser.add_argument('--widths', default=[32, 64, 128], type=int, nargs='+', help='channels')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='also time every builder with channels_last weights and inputs, '
+                             'writes the NCHW / channels_last comparison')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    cfg = benchmark_cfg(argv)
+    if cfg.dynamic_conv:
+        torch.set_num_threads(cfg.threads)
+        rows = benchmark_dynamic_conv(cfg)
+        write_table(rows, cfg.out, DYNCONV_FIELDS)
+        return rows
+    entries = find_builders({cfg.task: SEARCH_ROOTS[cfg.task]} if cfg.task else SEARCH_ROOTS)
+    if cfg.filter:
+        entries = [e for e in entries if re.search(cfg.filter, e['name']) or re.search(cfg.filter, e['module'])]
+    if cfg.list:
+        for e in entries:
+            print(f"{e['task']:<14}{e['name']:<48}{e['module']}.{e['builder']}")
+        return entries
+    rows = run(entries, cfg)
+    write_table(rows, cfg.out, CHANNELS_LAST_FIELDS if cfg.channels_last else FIELDS)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
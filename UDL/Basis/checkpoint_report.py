@@ -0,0 +1,153 @@
+"""
+Activation checkpointing trade-off (module.enable_activation_checkpointing, --checkpoint-stages): peak memory and
+forward + backward time of one training step per patch size, without checkpointing and with the selected stages
+checkpointed per block and per stage, on cpu or cuda.
+
+Peak memory is the one of memory_plan.PeakMemory: bytes of the tensors allocated during forward and backward
+(activations, recomputed activations, gradients), weights and inputs excluded. ``grad_err`` is the largest
+gradient difference to the run without checkpointing, relative to the largest gradient (dropout / DropPath masks
+are replayed, so it is 0 up to recompute round-off). Models built for a single resolution (the Swin_pool variants
+take 64 x 64 only) get the pixels of a patch size as a batch of native patches, see the ``inputs`` column.
+
+usage:
+    python -m UDL.Basis.checkpoint_report --filter "^PSRT$|^Swin_poolv30_shortcut$" --sizes 64 96 128
+    python -m UDL.Basis.checkpoint_report --filter "^PSRT$" --sizes 64 128 --stages 0 --amp --out results/ckpt
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import re
+import sys
+import traceback
+import torch
+from UDL.Basis.module import enable_activation_checkpointing, checkpoint_stages
+from UDL.Basis.memory_plan import PeakMemory, MB
+
+FIELDS = ['name', 'size', 'inputs', 'checkpoint', 'stages', 'peak(MB)', 'mem_saved', 'fwd_bwd(ms)', 'slowdown',
+          'grad_err', 'status']
+
+
+def _train_step(model, inputs, amp):
+    from UDL.Basis.benchmark import _first_tensor
+    device_type = inputs[0].device.type
+    dtype = torch.bfloat16 if device_type == 'cpu' else torch.float16
+    with torch.autocast(device_type, dtype=dtype, enabled=amp):
+        loss = _first_tensor(model(*inputs)).float().mean()
+    loss.backward()
+
+
+def check_entry(entry, cfg):
+    """One row per (patch size, checkpointing mode) of ``entry``."""
+    # benchmark (and its optional fvcore import) only for the command line
+    from UDL.Basis.benchmark import REPO_ROOT, load_args, make_batch, capture_inputs, _timeit
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, cfg.device)
+        torch.manual_seed(0)
+        model = getattr(importlib.import_module(entry['module']), entry['builder'])(args)[0].to(cfg.device)
+    model.train()
+    stages = checkpoint_stages(model)
+    if not stages:
+        return [{'name': entry['name'], 'status': 'no checkpointable stages'}]
+    rows = []
+    for size in cfg.sizes:
+        common = {'name': entry['name'], 'size': size}
+        try:
+            try:
+                batch = make_batch('hisr', cfg.batch_size, size, cfg.scale, cfg.hsi_bands)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    inputs = tuple(x.to(cfg.device) for x in capture_inputs(model, batch))
+            except (AssertionError, RuntimeError):
+                # built for one resolution (attention masks of Swin_pool): as many native patches as pixels
+                native = getattr(model, 'img_size', None)
+                if native is None or native == size:
+                    raise
+                n = max(1, round(cfg.batch_size * size ** 2 / native ** 2))
+                batch = make_batch('hisr', n, native, cfg.scale, cfg.hsi_bands)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    inputs = tuple(x.to(cfg.device) for x in capture_inputs(model, batch))
+            common['inputs'] = ' '.join('x'.join(map(str, x.shape)) for x in inputs)
+        except Exception as e:
+            rows.append(dict(common, status=f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"))
+            if cfg.verbose:
+                traceback.print_exc()
+            continue
+        ref = base = None
+        for mode in ['off', 'block', 'stage']:
+            row = dict(common, checkpoint=mode)
+            try:
+                selected = enable_activation_checkpointing(model, cfg.stages if mode != 'off' else [], mode)
+                row['stages'] = ' '.join(type(s).__name__ + str(stages.index(s)) for s in selected) or '-'
+                model.zero_grad(set_to_none=True)
+                torch.manual_seed(0)
+                with contextlib.redirect_stdout(io.StringIO()), PeakMemory() as memory:
+                    _train_step(model, inputs, cfg.amp)
+                grads = torch.cat([p.grad.flatten().float() for p in model.parameters() if p.grad is not None])
+                model.zero_grad(set_to_none=True)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ms = _timeit(lambda: _train_step(model, inputs, cfg.amp), cfg.warmup, cfg.repeat, cfg.device)
+                model.zero_grad(set_to_none=True)
+            except Exception as e:
+                row['status'] = f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"
+                if cfg.verbose:
+                    traceback.print_exc()
+                rows.append(row)
+                continue
+            if ref is None:
+                ref, base = grads, (memory.peak, ms)
+            row['peak(MB)'] = round(memory.peak / MB, 1)
+            row['mem_saved'] = f"{1 - memory.peak / base[0]:.0%}"
+            row['fwd_bwd(ms)'] = round(ms, 1)
+            row['slowdown'] = round(ms / base[1], 2)
+            row['grad_err'] = f"{((grads - ref).abs().max() / ref.abs().max().clamp(min=1e-12)).item():.1e}"
+            row['status'] = 'ok'
+            rows.append(row)
+        enable_activation_checkpointing(model, [])
+    return rows
+
+
+def checkpoint_report_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='Memory / time of activation checkpointing per patch size')
+    parser.add_argument('--filter', required=True, type=str, help='regex on the hisr builder name or module')
+    parser.add_argument('--sizes', nargs='+', default=[64, 96, 128], type=int, help='HR training patch sizes')
+    parser.add_argument('--stages', nargs='+', default=[-1], type=int,
+                        help='indices of the checkpointed stages, -1: all (see --checkpoint-stages)')
+    parser.add_argument('--amp', action='store_true', help='autocast the step, bf16 on cpu and fp16 on cuda')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--scale', default=4, type=int, help='hisr upsampling ratio of lrhsi')
+    parser.add_argument('--hsi-bands', default=31, type=int, help='has to match the model (31 for the CAVE variants)')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--out', default='checkpoint_report', type=str, help='writes <out>.csv and <out>.md')
+    parser.add_argument('--verbose', action='store_true', help='print tracebacks of failed builders')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from UDL.Basis.benchmark import SEARCH_ROOTS, find_builders, write_table
+    cfg = checkpoint_report_cfg(argv)
+    torch.set_num_threads(cfg.threads)
+    entries = [e for e in find_builders({'hisr': SEARCH_ROOTS['hisr']})
+               if re.search(cfg.filter, e['name']) or re.search(cfg.filter, e['module'])]
+    rows = []
+    for i, entry in enumerate(entries):
+        try:
+            entry_rows = check_entry(entry, cfg)
+        except Exception as e:
+            entry_rows = [{'name': entry['name'],
+                           'status': f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"}]
+            if cfg.verbose:
+                traceback.print_exc()
+        for row in entry_rows:
+            print(f"[{i + 1}/{len(entries)}] " + ' '.join(f"{k}={row[k]}" for k in FIELDS if k in row))
+        rows.extend(entry_rows)
+    write_table(rows, cfg.out, FIELDS)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from torch import nn
+from UDL.Basis.auxiliary import autocast_fp32
 
 class SetCriterion(nn.Module):
     """ This class computes the loss for DETR.
@@ -40,12 +41,13 @@ class SetCriterion(nn.Module):
                     self.loss_dicts.update({k: loss(outputs, targets)})
 
             elif k == 'ssim_loss':
-                loss = self.losses[k]
+                # ssim is computed in fp32 even under bf16/fp16 autocast
+                loss = autocast_fp32(self.losses[k])
                 loss_dicts = 1 - loss(outputs, targets, *args)
                 if isinstance(loss_dicts, dict):
-                    self.loss_dicts.update(1 - loss(outputs, targets, *args))
+                    self.loss_dicts.update(loss_dicts)
                 else:
-                    self.loss_dicts.update({k: 1 - loss(outputs, targets, *args)})
+                    self.loss_dicts.update({k: loss_dicts})
 
             else:
                 loss = self.losses[k]
@@ -1,10 +1,12 @@
 import os
 import subprocess
+import numpy as np
 import torch
 from torch import nn
 import torch.multiprocessing as mp
 from torch import distributed as dist
 from torch.nn.parallel.distributed import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from logging import info as log_string
 try:
     from apex.parallel.distributed import DistributedDataParallel as DDP
@@ -66,7 +68,9 @@ def _init_dist_pytorch(backend, **kwargs):
     # TODO: use local_rank instead of rank % num_gpus
     rank = int(os.environ['RANK'])
     num_gpus = torch.cuda.device_count()
-    torch.cuda.set_device(rank % num_gpus)
+    # cpu-only ranks (gloo)
+    if num_gpus > 0:
+        torch.cuda.set_device(rank % num_gpus)
     dist.init_process_group(backend=backend, **kwargs)
 
 
@@ -127,6 +131,32 @@ def reduce_mean(tensor, nprocs=None):
     # print(rt)
     return rt
 
+def gather_eval_records(records, dst=0, all_ranks=False):
+    """Merges the ``(dataset index, record)`` pairs of all ranks in dataset order.
+
+    Indices seen on several ranks (the padding of DistributedSampler) are kept once. The merged list is
+    returned on ``dst`` only, or on every rank with ``all_ranks`` (all_gather_object). Works with gloo and nccl,
+    outside torch.distributed the records are only sorted.
+    """
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = get_dist_info()
+        if all_ranks:
+            parts = [None] * world_size
+            dist.all_gather_object(parts, records)
+        else:
+            parts = [None] * world_size if rank == dst else None
+            dist.gather_object(records, parts, dst=dst)
+            if rank != dst:
+                return None
+    else:
+        parts = [records]
+    merged = {}
+    for part in parts:
+        for index, record in part:
+            merged.setdefault(index, record)
+    return [(index, merged[index]) for index in sorted(merged)]
+
+
 class MMDistributedDataParallel(DistributedDataParallel):
 
     def __init__(self, model, device_ids):
@@ -168,7 +198,8 @@ def dist_train_v1(args, model):
                     model = DDP(model, delay_allreduce=True)
             else:
                 # model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank])
-                model = MMDistributedDataParallel(model, device_ids=[args.local_rank])
+                model = MMDistributedDataParallel(
+                    model, device_ids=[args.local_rank] if str(args.device).startswith('cuda') else None)
                 # train_sampler = torch.auxiliary.data.distributed.DistributedSampler(train_dataset)
                 # val_sampler = torch.auxiliary.data.distributed.DistributedSampler(val_dataset)
     elif args.mode == "DP":
@@ -177,3 +208,79 @@ def dist_train_v1(args, model):
 
     return model
 
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler that can start in the middle of an epoch.
+
+    The permutation only depends on (seed, epoch), so storing the number of samples already consumed
+    is enough to continue a preempted epoch with exactly the remaining batches. Also used without
+    torch.distributed (one replica), where it replaces the RandomSampler of shuffle=True.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        if num_replicas is None and not (dist.is_available() and dist.is_initialized()):
+            num_replicas, rank = 1, 0
+        super(ResumableSampler, self).__init__(dataset, num_replicas, rank, shuffle, seed, drop_last)
+        self.start_index = 0
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def set_epoch(self, epoch):
+        # a restored position only holds for the epoch it was saved in
+        if epoch != self.epoch:
+            self.start_index = 0
+        super(ResumableSampler, self).set_epoch(epoch)
+
+    def state_dict(self, consumed):
+        return {'epoch': self.epoch, 'seed': self.seed, 'start_index': consumed}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.seed = state_dict['seed']
+        self.start_index = state_dict['start_index']
+
+
+class ShapeBucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler for evaluation that only batches samples of the same shape.
+
+    Samples are grouped by ``dataset.sample_shape(i)`` (loading every sample once if the dataset has no such
+    method), buckets keep their first-appearance order and indices stay sorted inside a bucket. A batch holds
+    at most ``max_batch`` samples and, with ``budget`` > 0, at most ``budget`` fp32 bytes of the first input.
+    Under torch.distributed every rank takes every num_replicas-th batch.
+    """
+
+    def __init__(self, dataset, max_batch=1, budget=0, num_replicas=None, rank=None):
+        if num_replicas is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            num_replicas = dist.get_world_size() if distributed else 1
+            rank = dist.get_rank() if distributed else 0
+        buckets = {}
+        for i in range(len(dataset)):
+            buckets.setdefault(self._shape(dataset, i), []).append(i)
+        batches = []
+        for shape, indices in buckets.items():
+            n = max_batch
+            if budget > 0:
+                n = max(1, min(n, int(budget // (4 * np.prod(shape[0])))))
+            batches.extend(indices[j:j + n] for j in range(0, len(indices), n))
+        self.batches = batches[rank::num_replicas]
+
+    @staticmethod
+    def _shape(dataset, index):
+        if hasattr(dataset, 'sample_shape'):
+            return (tuple(dataset.sample_shape(index)),)
+        sample = dataset[index]
+        values = sample.values() if isinstance(sample, dict) else sample
+        return tuple(tuple(v.shape) for v in values if isinstance(v, torch.Tensor))
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -0,0 +1,267 @@
+"""
+Vectorized multi-model training: N copies of one architecture (different seeds / learning rates)
+are stacked with torch.func.stack_module_state and trained in one process with vmap over a shared batch.
+Each copy keeps its own loss, optimizer state, gradient clipping and checkpoints.
+"""
+import datetime
+import os
+import time
+import torch
+from torch import nn
+from torch.func import stack_module_state, functional_call, vmap
+from logging import info as log_string
+from UDL.Basis.auxiliary import MetricLogger, set_random_seed
+from UDL.Basis.framework import save_checkpoint
+from UDL.pansharpening.common.evaluate import analysis_accu
+
+
+class StackedAdam():
+    """Adam/AdamW over parameters stacked along dim 0 with per-model lr and weight decay.
+
+    Element-wise like torch.optim.Adam(W), so each slice evolves exactly as its own optimizer would.
+    """
+
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=0., decoupled=False):
+        self.params = params
+        self.lr = torch.as_tensor(lr, dtype=torch.float32)
+        self.weight_decay = torch.as_tensor(weight_decay, dtype=torch.float32).expand_as(self.lr).clone()
+        self.betas = betas
+        self.eps = eps
+        self.decoupled = decoupled
+        self.state = {k: {'step': 0, 'exp_avg': torch.zeros_like(p), 'exp_avg_sq': torch.zeros_like(p)}
+                      for k, p in params.items()}
+
+    @classmethod
+    def from_optimizer(cls, params, optimizer, lrs=None):
+        group = optimizer.param_groups[0]
+        n = next(iter(params.values())).shape[0]
+        lrs = lrs if lrs else [group['lr']] * n
+        if not isinstance(optimizer, (torch.optim.Adam, torch.optim.AdamW)):
+            raise NotImplementedError(f"vectorized training supports Adam/AdamW, got {type(optimizer).__name__}")
+        return cls(params, lrs, group['betas'], group['eps'], group['weight_decay'],
+                   decoupled=isinstance(optimizer, torch.optim.AdamW))
+
+    def _per_model(self, t, p):
+        return t.to(p.device).view(-1, *([1] * (p.dim() - 1)))
+
+    @torch.no_grad()
+    def step(self):
+        beta1, beta2 = self.betas
+        for k, p in self.params.items():
+            if p.grad is None:
+                continue
+            state = self.state[k]
+            lr, wd = self._per_model(self.lr, p), self._per_model(self.weight_decay, p)
+            grad = p.grad
+            if self.decoupled:
+                p.mul_(1 - lr * wd)
+            else:
+                grad = grad + wd * p
+            state['step'] += 1
+            state['exp_avg'].mul_(beta1).add_(grad, alpha=1 - beta1)
+            state['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            bias_correction1 = 1 - beta1 ** state['step']
+            bias_correction2 = 1 - beta2 ** state['step']
+            denom = (state['exp_avg_sq'] / bias_correction2).sqrt_().add_(self.eps)
+            p.sub_(lr / bias_correction1 * state['exp_avg'] / denom)
+
+    def zero_grad(self):
+        for p in self.params.values():
+            p.grad = None
+
+    def state_dict(self, index):
+        return {'lr': float(self.lr[index]), 'weight_decay': float(self.weight_decay[index]),
+                'betas': self.betas, 'eps': self.eps,
+                'state': {k: {'step': s['step'], 'exp_avg': s['exp_avg'][index].clone(),
+                              'exp_avg_sq': s['exp_avg_sq'][index].clone()} for k, s in self.state.items()}}
+
+    def load_state_dict(self, index, state_dict):
+        for k, s in state_dict['state'].items():
+            self.state[k]['step'] = s['step']
+            self.state[k]['exp_avg'][index].copy_(s['exp_avg'])
+            self.state[k]['exp_avg_sq'][index].copy_(s['exp_avg_sq'])
+
+
+class StackedEnsemble(nn.Module):
+    """Holds the stacked parameters of ``models`` and computes their losses on one batch with vmap."""
+
+    def __init__(self, models, criterion):
+        super(StackedEnsemble, self).__init__()
+        self.num_models = len(models)
+        params, buffers = stack_module_state(models)
+        self.params = params
+        self.buffers_ = buffers
+        # models[0] only provides the forward code, its own tensors are swapped out by functional_call
+        self.base = models[0]
+        self.criterion = getattr(models[0], 'criterion', criterion)
+        self.input_keys = None
+        self.target_key = None
+
+    def bind(self, batch):
+        """Find which batch entries the model's train_step feeds to forward and to the criterion."""
+        captured = {}
+        forward, criterion_forward = self.base.forward, self.criterion.forward
+
+        def record_forward(*inputs):
+            captured.setdefault('inputs', inputs)
+            out = forward(*inputs)
+            captured.setdefault('output', out)
+            return out
+
+        def record_criterion(outputs, targets, *args, **kwargs):
+            captured.setdefault('criterion', (outputs, targets))
+            return criterion_forward(outputs, targets, *args, **kwargs)
+
+        self.base.forward, self.criterion.forward = record_forward, record_criterion
+        try:
+            with torch.no_grad():
+                self.base.train_step(batch)
+        finally:
+            del self.base.forward, self.criterion.forward
+        keys = {id(v): k for k, v in batch.items()}
+        outputs, targets = captured['criterion']
+        if outputs is not captured['output'] or id(targets) not in keys \
+                or any(id(v) not in keys for v in captured['inputs']):
+            raise NotImplementedError(f"{type(self.base).__name__}.train_step does not feed batch entries "
+                                      f"straight to forward/criterion, which vectorized training requires")
+        self.input_keys = [keys[id(v)] for v in captured['inputs']]
+        self.target_key = keys[id(targets)]
+
+    def _loss(self, params, buffers, inputs, target):
+        output = functional_call(self.base, (params, buffers), inputs)
+        loss_dicts, weight_dict = self.criterion(output, target)
+        loss = sum(loss_dicts[k] * weight_dict[k] for k in loss_dicts.keys() if k in weight_dict)
+        return loss, dict(loss_dicts), output
+
+    def forward(self, batch):
+        if self.input_keys is None:
+            self.bind(batch)
+        inputs = tuple(batch[k] for k in self.input_keys)
+        # randomness='different': every copy draws its own dropout / drop-path masks
+        return vmap(self._loss, in_dims=(0, 0, None, None), randomness='different')(
+            self.params, self.buffers_, inputs, batch[self.target_key])
+
+    def clip_grad_norm_(self, max_norm):
+        """Per-model global-norm clipping, returns the [N] grad norms."""
+        grads = [p.grad for p in self.params.values() if p.grad is not None]
+        norms = torch.stack([g.flatten(1).pow(2).sum(1) for g in grads]).sum(0).sqrt()
+        if max_norm > 0:
+            scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+            for g in grads:
+                g.mul_(scale.view(-1, *([1] * (g.dim() - 1))))
+        return norms
+
+    def model_state_dict(self, index):
+        state_dict = {k: v[index].detach().clone() for k, v in self.params.items()}
+        state_dict.update({k: v[index].clone() for k, v in self.buffers_.items()})
+        return state_dict
+
+    def load_model_state_dict(self, index, state_dict):
+        with torch.no_grad():
+            for k, v in {**self.params, **self.buffers_}.items():
+                v[index].copy_(state_dict[k])
+
+
+def build_ensemble(args, builder):
+    """Builds ``args.num_models`` copies with ``args.ensemble_seeds`` (default seed, seed+1, ...)."""
+    seeds = args.ensemble_seeds or [args.seed + i for i in range(args.num_models)]
+    assert len(seeds) == args.num_models, "--ensemble-seeds needs one seed per model"
+    models = []
+    for seed in seeds:
+        set_random_seed(seed)
+        model, criterion, optimizer, scheduler = builder(args)
+        models.append(model.to(args.device))
+    ensemble = StackedEnsemble(models, criterion)
+    optimizer = StackedAdam.from_optimizer(ensemble.params, optimizer, args.ensemble_lrs)
+    set_random_seed(args.seed)
+    return ensemble, optimizer, seeds
+
+
+class EnsembleRunner():
+
+    def __init__(self, args):
+        self.args = args
+        self.metric_logger = MetricLogger(delimiter="  ", dist_print=args.global_rank)
+        self.best = [None] * args.num_models
+
+    def train_one_epoch(self, ensemble, data_loader, optimizer, epoch):
+        args = self.args
+        ensemble.train()
+        header = 'Epoch: [{}]'.format(epoch)
+        print_freq = len(data_loader) if args.print_freq <= 0 else args.print_freq
+        metric_logger = self.metric_logger
+        for batch, idx in metric_logger.log_every(data_loader, print_freq, header):
+            batch = {k: v.to(args.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+            losses, loss_dicts, outputs = ensemble(batch)
+            # copies are independent, so the summed loss gives every copy its own gradient
+            (losses.sum() / args.accumulated_step).backward()
+            if idx % args.accumulated_step == 0:
+                grad_norms = ensemble.clip_grad_norm_(args.clip_max_norm)
+                optimizer.step()
+                optimizer.zero_grad()
+                metric_logger.update(**{f'grad_norm_{i}': g for i, g in enumerate(grad_norms.tolist())})
+            metric_logger.update(**{f'Loss_{i}': l for i, l in enumerate(losses.tolist())})
+            if idx % print_freq == 0:
+                with torch.no_grad():
+                    gt = batch[ensemble.target_key]
+                    metric_logger.update(**{f'PSNR_{i}': analysis_accu(gt[0].permute(1, 2, 0),
+                                                                       outputs[i, 0].permute(1, 2, 0), 4)['PSNR']
+                                            for i in range(ensemble.num_models)})
+        return {k: meter.avg for k, meter in metric_logger.meters.items()}
+
+    def save(self, ensemble, optimizer, epoch, stats, seeds):
+        args = self.args
+        for i in range(ensemble.num_models):
+            loss = stats[f'Loss_{i}']
+            is_best = self.best[i] is None or loss < self.best[i]
+            self.best[i] = loss if is_best else self.best[i]
+            model_save_dir = os.path.join(args.model_save_dir, f"model_{i}")
+            os.makedirs(model_save_dir, exist_ok=True)
+            save_checkpoint({
+                'epoch': epoch,
+                'arch': args.arch,
+                'state_dict': ensemble.model_state_dict(i),
+                'best_metric': self.best[i],
+                'loss': loss,
+                'best_epoch': epoch if is_best else None,
+                'amp': None,
+                'seed': seeds[i],
+                'ensemble_optimizer': optimizer.state_dict(i)
+            }, model_save_dir, is_best, filename=f"{epoch}.pth.tar")
+
+    def resume(self, ensemble, optimizer):
+        args = self.args
+        epochs = [int(f.split('.')[0]) for f in os.listdir(os.path.join(args.resume, "model_0"))
+                  if f.split('.')[0].isdigit()]
+        if not epochs:
+            log_string("=> no checkpoint found at '{}'".format(args.resume))
+            return
+        epoch = max(epochs)
+        for i in range(ensemble.num_models):
+            path = os.path.join(args.resume, f"model_{i}", f"{epoch}.pth.tar")
+            checkpoint = torch.load(path, map_location=args.device, weights_only=False)
+            ensemble.load_model_state_dict(i, checkpoint['state_dict'])
+            optimizer.load_state_dict(i, checkpoint['ensemble_optimizer'])
+            self.best[i] = checkpoint['best_metric']
+        args.start_epoch = epoch + 1
+        log_string(f"=> loaded {ensemble.num_models} models from '{args.resume}' (epoch {epoch})")
+
+    def run(self, train_loader, builder, **kwargs):
+        args = self.args
+        ensemble, optimizer, seeds = build_ensemble(args, builder)
+        log_string(f"vectorized training of {ensemble.num_models} models, seeds {seeds}, "
+                   f"lr {optimizer.lr.tolist()}")
+        if args.resume and os.path.isdir(args.resume):
+            self.resume(ensemble, optimizer)
+        start_time = time.time()
+        for epoch in range(args.start_epoch, args.epochs + 1):
+            if kwargs.get('train_sampler') is not None:
+                kwargs.get('train_sampler').set_epoch(epoch)
+            stats = self.train_one_epoch(ensemble, train_loader, optimizer, epoch)
+            if args.global_rank == 0:
+                log_string("Averaged stats: {}".format(self.metric_logger))
+                if epoch % args.print_freq == 0 or epoch == args.epochs:
+                    self.save(ensemble, optimizer, epoch, stats, seeds)
+                log_string('Training time {}'.format(
+                    str(datetime.timedelta(seconds=int(time.time() - start_time)))))
+        return ensemble
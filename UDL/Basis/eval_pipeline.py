@@ -0,0 +1,131 @@
+"""
+Pipelined evaluation (--eval-pipeline): batches are prefetched and copied to the device by one thread, the main
+thread only launches eval_step, and a second thread turns the metrics into floats (the ``.item()`` that waits
+for the device) and re-scores multi-image batches. Outputs go through ResultWriter, which already copies them
+into pinned memory on a side stream and writes them from its own thread.
+
+    pipeline = EvalPipeline(eval_loader, args.device)
+    for batch, idx in metric_logger.log_every(pipeline, 1, header):
+        sr, metrics = model.eval_step(batch)
+        writer.put(index, sr)
+        pipeline.put(metric_logger, batch, sr, metrics)
+    pipeline.close(metric_logger)
+
+Metrics are applied to the MetricLogger by the main thread in batch order, so the averages are the ones of the
+sequential loop.
+"""
+import queue
+import threading
+import torch
+from UDL.Basis.result_writer import eval_metrics_per_image
+
+
+def to_device(x, device, non_blocking=False):
+    """Moves the tensors of a (nested) batch to ``device``."""
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
+    if isinstance(x, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_device(v, device, non_blocking) for v in x)
+    return x
+
+
+def _record_stream(x, stream):
+    if isinstance(x, torch.Tensor):
+        x.record_stream(stream)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _record_stream(v, stream)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _record_stream(v, stream)
+
+
+class EvalPipeline():
+    """Iterates ``loader`` ``depth`` batches ahead on ``device`` and scores eval outputs off the main thread.
+
+    On cuda the host-to-device copies of the (pinned) batches run on a side stream, the compute stream waits
+    for them by event. ``put`` queues an eval_step result for scoring, the floats come back to the main thread
+    through ``put`` / ``close``, which apply them to the MetricLogger.
+    """
+
+    def __init__(self, loader, device, depth=2, gt_key='gt'):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.gt_key = gt_key
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.batches = queue.Queue(maxsize=depth)
+        self.results = queue.Queue(maxsize=depth)
+        self.scores = queue.Queue()
+        self.pending = 0
+        self.scorer = threading.Thread(target=self._score, daemon=True)
+        self.scorer.start()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader = threading.Thread(target=self._load, daemon=True)
+        loader.start()
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            batch, event = item
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+                _record_stream(batch, torch.cuda.current_stream(self.device))
+            yield batch
+        loader.join()
+
+    def _load(self):
+        try:
+            for batch in self.loader:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = to_device(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = to_device(batch, self.device)
+                self.batches.put((batch, event))
+            self.batches.put(None)
+        except BaseException as e:
+            self.batches.put(e)
+
+    def _score(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            batch, sr, metrics = item
+            try:
+                scores = eval_metrics_per_image(batch, sr, metrics, self.gt_key)
+                self.scores.put(scores)
+            except Exception as e:
+                self.scores.put(e)
+
+    def _apply(self, metric_logger, block=False):
+        while self.pending and (block or not self.scores.empty()):
+            scores = self.scores.get()
+            self.pending -= 1
+            if isinstance(scores, Exception):
+                raise scores
+            for s in scores:
+                metric_logger.update_dict(s)
+
+    def put(self, metric_logger, batch, sr, metrics):
+        """Queues ``eval_step(batch) == (sr, metrics)`` for scoring and logs the batches scored so far."""
+        self.results.put((batch, sr.detach(), metrics))
+        self.pending += 1
+        self._apply(metric_logger)
+
+    def close(self, metric_logger):
+        """Waits for the queued batches and logs their metrics."""
+        self._apply(metric_logger, block=True)
+        self.results.put(None)
+        self.scorer.join()
@@ -0,0 +1,225 @@
+"""
+Export the inference graph of any builder found by UDL.Basis.benchmark to TorchScript and ONNX, check the
+exported models against eager mode and time them on cpu (TorchScript interpreter / ONNX Runtime).
+
+usage:
+    python -m UDL.Basis.export --filter "PSRT_KAv22|SWATv4|FusionNet|DCFNet" --out results/export
+    python -m UDL.Basis.export --filter "^SWATv4$" --checkpoint results/hisr/SWATv4/model_best.pth.tar --check-size 128
+"""
+import argparse
+import contextlib
+import importlib
+import inspect
+import io
+import os
+import re
+import sys
+import traceback
+import torch
+from torch import nn
+from UDL.Basis.benchmark import (SEARCH_ROOTS, REPO_ROOT, find_builders, load_args, make_batch, capture_inputs,
+                                 _first_tensor, _timeit, write_table)
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+    print("you don't install onnxruntime. [Optional] pip install onnxruntime to check and time the ONNX models.")
+
+FIELDS = ['name', 'task', 'inputs', 'files', 'eager(ms)', 'torchscript(ms)', 'onnxruntime(ms)',
+          'ts_err', 'ts_err@check', 'onnx_err', 'onnx_err@check', 'status']
+
+
+class InferenceGraph(nn.Module):
+    """The bare forward of a model wrapper: no train_step/eval_step, criterion or metrics, one output tensor.
+
+    Only the modules forward touches end up in the traced graph, so the criterion does not need removing.
+    """
+
+    def __init__(self, model):
+        super(InferenceGraph, self).__init__()
+        self.model = model
+        # torch.onnx.export restores the wrapper's mode afterwards, which must not switch BatchNorm back to train
+        self.eval()
+
+    def forward(self, *inputs):
+        return _first_tensor(self.model(*inputs))
+
+
+def load_weights(model, path):
+    """Loads a framework checkpoint ({'state_dict': ...} or a bare state dict, DDP prefixes stripped) from a path
+    or an already loaded checkpoint."""
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False) if isinstance(path, str) else path
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    state_dict = {re.sub(r'^(module\.|ddp\.)+', '', k): v for k, v in state_dict.items()}
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing = [k for k in missing if not k.startswith('criterion.')]
+    if missing or unexpected:
+        print(f"=> {path if isinstance(path, str) else 'checkpoint'}: {len(missing)} missing / "
+              f"{len(unexpected)} unexpected keys, e.g. {(missing + unexpected)[:3]}")
+    return model
+
+
+def resize_inputs(inputs, size, check_size):
+    """Random inputs with the spatial dims of the [B, C, H, W] inputs scaled by check_size / size."""
+    g = torch.Generator().manual_seed(1)
+    return tuple(torch.rand(*x.shape[:2], round(x.shape[2] * check_size / size), round(x.shape[3] * check_size / size),
+                            generator=g, dtype=x.dtype).to(x.device) if x.dim() == 4 else x for x in inputs)
+
+
+def _rel_err(out, ref):
+    out = torch.as_tensor(out).to(ref)
+    if out.shape != ref.shape:
+        return f"shape {tuple(out.shape)}"
+    return f"{((out - ref).abs().max() / ref.abs().max().clamp(min=1e-12)).item():.1e}"
+
+
+def export_onnx(graph, inputs, path, opset):
+    names = [f"input{i}" for i in range(len(inputs))]
+    # only the spatial axes are dynamic: the per-sample kernel banks (KernelAttention) are conv weights
+    # whose shape depends on the batch size, and ONNX Conv needs a statically known weight shape
+    dynamic_axes = {n: {2: f'height{i}', 3: f'width{i}'} for i, (n, x) in enumerate(zip(names, inputs)) if x.dim() == 4}
+    dynamic_axes['output'] = {2: 'height', 3: 'width'}
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(graph, inputs, path, input_names=names, output_names=['output'], dynamic_axes=dynamic_axes,
+                      opset_version=opset, do_constant_folding=True, **kwargs)
+    return names
+
+
+def export_entry(entry, cfg):
+    row = {k: entry[k] for k in ('name', 'task')}
+    torch.manual_seed(0)
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, 'cpu')
+        module = importlib.import_module(entry['module'])
+        model = getattr(module, entry['builder'])(args)[0]
+        batch = make_batch(entry['task'], cfg.batch_size, cfg.size, cfg.scale, cfg.hsi_bands, cfg.ms_bands)
+        # some builders / train_steps hard-code .cuda(), the inputs are captured where the model was built
+        inputs = tuple(x.cpu() for x in capture_inputs(model, batch))
+        model.cpu()
+    if cfg.checkpoint:
+        load_weights(model, cfg.checkpoint)
+    graph = InferenceGraph(model)
+    check_inputs = resize_inputs(inputs, cfg.size, cfg.check_size) if cfg.check_size else None
+    row['inputs'] = ' '.join('x'.join(map(str, x.shape)) for x in inputs)
+    base = os.path.join(cfg.out, re.sub(r'[^\w.-]+', '_', entry['name']))
+    os.makedirs(cfg.out, exist_ok=True)
+    files, status = [], []
+
+    with torch.no_grad():
+        ref = graph(*inputs)
+        ref_check = graph(*check_inputs) if check_inputs else None
+        row['eager(ms)'] = round(_timeit(lambda: graph(*inputs), cfg.warmup, cfg.repeat, 'cpu'), 2)
+
+        if 'torchscript' in cfg.formats:
+            try:
+                traced = torch.jit.trace(graph, inputs, check_trace=False)
+                traced.save(base + '.pt')
+                files.append(os.path.basename(base) + '.pt')
+                # the reloaded file is what ships, so that is what gets checked and timed
+                traced = torch.jit.load(base + '.pt')
+                row['ts_err'] = _rel_err(traced(*inputs), ref)
+                if check_inputs:
+                    row['ts_err@check'] = _check(lambda: traced(*check_inputs), ref_check)
+                row['torchscript(ms)'] = round(_timeit(lambda: traced(*inputs), cfg.warmup, cfg.repeat, 'cpu'), 2)
+            except Exception as e:
+                status.append(f"torchscript: {type(e).__name__}")
+                _print_exc(cfg)
+
+        if 'onnx' in cfg.formats:
+            try:
+                names = export_onnx(graph, inputs, base + '.onnx', cfg.opset)
+                files.append(os.path.basename(base) + '.onnx')
+                if onnxruntime is not None:
+                    options = onnxruntime.SessionOptions()
+                    options.intra_op_num_threads = cfg.threads
+                    session = onnxruntime.InferenceSession(base + '.onnx', options,
+                                                           providers=['CPUExecutionProvider'])
+                    # inputs forward never reads (e.g. the gt some wrappers pass along) are pruned from the graph
+                    used = {i.name for i in session.get_inputs()}
+                    feed = {n: x.numpy() for n, x in zip(names, inputs) if n in used}
+                    row['onnx_err'] = _rel_err(session.run(None, feed)[0], ref)
+                    if check_inputs:
+                        row['onnx_err@check'] = _check(lambda: session.run(
+                            None, {n: x.numpy() for n, x in zip(names, check_inputs) if n in used})[0], ref_check)
+                    row['onnxruntime(ms)'] = round(_timeit(lambda: session.run(None, feed), cfg.warmup, cfg.repeat,
+                                                           'cpu'), 2)
+            except Exception as e:
+                status.append(f"onnx: {type(e).__name__}")
+                _print_exc(cfg)
+
+    row['files'] = ' '.join(files)
+    errors = [row[k] for k in ('ts_err', 'onnx_err') if k in row]
+    if any(not _close(e, cfg.rtol) for e in errors):
+        status.append('mismatch')
+    if any(not _close(row[k], cfg.rtol) for k in ('ts_err@check', 'onnx_err@check') if k in row):
+        # the trace baked in shapes of the export size (python-side size arithmetic)
+        status.append('static shapes')
+    row['status'] = ', '.join(status) or 'ok'
+    return row
+
+
+def _check(fn, ref):
+    try:
+        return _rel_err(fn(), ref)
+    except Exception as e:
+        return type(e).__name__
+
+
+def _close(err, rtol):
+    try:
+        return float(err) <= rtol
+    except ValueError:
+        return False
+
+
+def _print_exc(cfg):
+    if cfg.verbose:
+        traceback.print_exc()
+
+
+def export_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='TorchScript/ONNX export with eager parity check and cpu timing')
+    parser.add_argument('--task', default=None, choices=list(SEARCH_ROOTS.keys()))
+    parser.add_argument('--filter', required=True, type=str, help='regex on the builder name or module')
+    parser.add_argument('--checkpoint', default='', type=str, help='weights to export, random init if empty')
+    parser.add_argument('--formats', default=['torchscript', 'onnx'], nargs='+', choices=['torchscript', 'onnx'])
+    parser.add_argument('--opset', default=17, type=int)
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--size', default=64, type=int, help='HR spatial size the graph is traced at')
+    parser.add_argument('--check-size', default=128, type=int,
+                        help='second HR size the exported dynamic axes are checked at, 0 to skip')
+    parser.add_argument('--scale', default=4, type=int, help='hisr upsampling ratio of lrhsi')
+    parser.add_argument('--hsi-bands', default=31, type=int)
+    parser.add_argument('--ms-bands', default=8, type=int)
+    parser.add_argument('--rtol', default=1e-4, type=float, help='max relative error to eager mode')
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--out', default='export', type=str, help='directory of the exported files and export.csv/md')
+    parser.add_argument('--verbose', action='store_true', help='print tracebacks of failed exports')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    cfg = export_cfg(argv)
+    torch.set_num_threads(cfg.threads)
+    entries = find_builders({cfg.task: SEARCH_ROOTS[cfg.task]} if cfg.task else SEARCH_ROOTS)
+    entries = [e for e in entries if re.search(cfg.filter, e['name']) or re.search(cfg.filter, e['module'])]
+    rows = []
+    for i, entry in enumerate(entries):
+        try:
+            row = export_entry(entry, cfg)
+        except Exception as e:
+            row = {'name': entry['name'], 'task': entry['task'],
+                   'status': f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"}
+            _print_exc(cfg)
+        print(f"[{i + 1}/{len(entries)}] {row['name']}: {row['status']}")
+        rows.append(row)
+    write_table(rows, os.path.join(cfg.out, 'export'), FIELDS)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
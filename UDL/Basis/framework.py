@@ -12,13 +12,16 @@ import matplotlib.pyplot as plt
 import numpy as np
 from .dist_utils import dist_train_v1
 from .scatter_gather import scatter_kwargs
+from .module import to_channels_last
 try:
     import apex
     from apex.parallel import DistributedDataParallel as DDP
     # from auxiliary.fp16_utils import *
     from apex import amp, optimizers
     from apex.multi_tensor_apply import multi_tensor_applier
+    APEX_AVAILABLE = True
 except:
+    APEX_AVAILABLE = False
     print("Currently using torch.cuda.amp")
     try:
         from torch.cuda import amp
@@ -54,6 +57,9 @@ class model_amp(nn.Module):
         self.criterion = criterion
         self.reg = regularization
         self.device_ids = device_ids
+        # torch.amp: fp16 needs a GradScaler, bf16 has the fp32 exponent range and runs on cpu as well
+        self.amp_dtype = torch.bfloat16 if getattr(args, 'amp_dtype', 'fp16') == 'bf16' else torch.float16
+        self.device_type = 'cuda' if str(getattr(args, 'device', 'cuda')).startswith('cuda') else 'cpu'
         if regularization:
             log_string("using l2_regularization for nn.Conv2D")
 
@@ -61,9 +67,18 @@ class model_amp(nn.Module):
         self.model = dist_train_v1(self.args, self.model)
 
     def scatter(self, inputs, kwargs, device_ids):
+        if self.device_type == 'cpu':
+            # batches stay on the host, the model moves them to args.device itself
+            return (inputs,), (kwargs,)
         return scatter_kwargs(inputs, kwargs, device_ids)
 
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.amp_dtype)
+
     def __call__(self, *inputs, **kwargs):
+        if getattr(self.args, 'channels_last', False):
+            # converted on the host, .to(device) in train_step keeps the memory format
+            inputs, kwargs = to_channels_last(inputs), to_channels_last(kwargs)
         if not self.args.amp or self.args.amp is None:
             # output, loss 将返回值修改为字典,
             # 不使用SetCriterion方法和遍历来合并不同的loss,loss的返回值将由字典变为数值
@@ -76,9 +91,10 @@ class model_amp(nn.Module):
 
         else:
             # torch.amp optimization
-            with amp.autocast():
+            with self.autocast():
                 inputs, kwargs = self.scatter(inputs, kwargs, self.device_ids)
-                loss, log_vars = self.model.train_step(*inputs[0], **kwargs[0])
+                outputs = self.model.train_step(*inputs[0], **kwargs[0])
+                loss, log_vars = outputs['loss'], outputs['log_vars']
                 log_vars['reg_loss'] = 0.0
                 if self.reg:
                     loss = self.l2_regularization(loss, self.model)
@@ -95,15 +111,39 @@ class model_amp(nn.Module):
                 # optimizer.step()
                 if self.args.clip_max_norm > 0:
                     torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.clip_max_norm)
-            else:
+            elif scaler is not None:
                 # torch.amp optimization
                 scaler.scale(loss).backward()
                 # scaler.step(optimizer)
                 # scaler.update()
+            else:
+                # torch.amp bf16 optimization, no loss scaling
+                loss.backward()
         else:
             loss.backward()
             # optimizer.step()
 
+    def clip_grad(self, optimizer, max_norm=0, scaler=None, step=True):
+        """Norm of the accumulated gradients, clipped to ``max_norm`` (> 0) right before an optimizer step.
+
+        Under a fp16 GradScaler the gradients are unscaled first (``scaler.unscale_``, once per step, ``step``
+        skips it), so the threshold and the logged norm are the ones of the real gradients. Between the steps of
+        --accumulated-step the scaled norm is divided by the scale instead.
+        """
+        if scaler is not None and step:
+            scaler.unscale_(optimizer)
+        if max_norm > 0 and step:
+            return torch.nn.utils.clip_grad_norm_(self.parameters(), max_norm)
+        grad_norm = get_grad_norm(self.parameters())
+        return grad_norm / scaler.get_scale() if scaler is not None and not step else grad_norm
+
+    def step(self, optimizer, scaler=None):
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+
     def l2_regularization(self, criterion, model, weight_decay=1e-5, flag=False):
         regularizations = []
         for k, v in model.named_parameters():
@@ -125,9 +165,10 @@ class model_amp(nn.Module):
 
         scaler = None
         if self.args.amp is not None:
-            cudnn.deterministic = False
-            cudnn.benchmark = True
-            assert torch.backends.cudnn.enabled, "Amp requires cudnn backend to be enabled."
+            if self.device_type == 'cuda':
+                cudnn.deterministic = False
+                cudnn.benchmark = True
+                assert torch.backends.cudnn.enabled, "Amp requires cudnn backend to be enabled."
 
             if not self.args.amp:
                 log_string("apex optimization")
@@ -136,9 +177,11 @@ class model_amp(nn.Module):
                 # keep_batchnorm_fp32=args.keep_batchnorm_fp32,
                 # loss_scale=args.loss_scale
                 # )
+            elif self.amp_dtype == torch.bfloat16:
+                log_string(f"torch.amp bf16 optimization on {self.device_type}")
             else:
                 log_string("torch.amp optimization")
-                scaler = amp.GradScaler()
+                scaler = torch.cuda.amp.GradScaler()
 
         return optimizer, scaler
 
@@ -213,14 +256,28 @@ def partial_load_checkpoint(base_wrap, state_dict, amp=None, dismatch_list=[]):
     return pretrained_dict
 
 
-def load_checkpoint(args, model, optimizer, ignore_params=[]):
+def use_apex(args):
+    """--amp False trains through apex amp, True through torch.amp, None without mixed precision."""
+    return APEX_AVAILABLE and args.amp is not None and not args.amp
+
+
+def amp_state_dict(args):
+    """apex amp state for a checkpoint, None unless training runs through apex.
+
+    torch.amp keeps its loss scale in the GradScaler, saved under 'scaler' (None for bf16).
+    """
+    return amp.state_dict() if use_apex(args) else None
+
+
+def load_checkpoint(args, model, optimizer, ignore_params=[], scaler=None):
     global_rank = args.global_rank
     checkpoint = {}
     if args.resume:
         if os.path.isfile(args.resume):
             if args.distributed:
                 dist.barrier()
-            init_checkpoint = torch.load(args.resume, map_location=f"cuda:{args.local_rank}")
+            map_location = f"cuda:{args.local_rank}" if str(args.device).startswith('cuda') else args.device
+            init_checkpoint = torch.load(args.resume, map_location=map_location, weights_only=False)
             if init_checkpoint.get('state_dict') is None:
                 checkpoint['state_dict'] = init_checkpoint
                 del init_checkpoint
@@ -231,23 +288,29 @@ def load_checkpoint(args, model, optimizer, ignore_params=[]):
             args.start_epoch = args.best_epoch = checkpoint.setdefault('epoch', 0) + 1
             args.best_epoch = checkpoint.setdefault('best_epoch', 0)
             args.best_prec1 = checkpoint.setdefault('best_metric', 0)
-            if args.amp is not None:
+            if use_apex(args):
                 print(checkpoint.keys())
                 try:
                     amp.load_state_dict(checkpoint['amp'])
                 except:
                     Warning("no loading amp_state_dict")
+            if scaler is not None and checkpoint.get('scaler') is not None:
+                scaler.load_state_dict(checkpoint['scaler'])
             # if ignore_params is not None:
             # if checkpoint.get('state_dict') is not None:
             #     ckpt = partial_load_checkpoint(checkpoint['state_dict'], args.amp, ignore_params)
             # else:
             #     print(checkpoint.keys())
             #     ckpt = partial_load_checkpoint(checkpoint, args.amp, ignore_params)
-            if model is not None:
+            if checkpoint.get('quantization') is not None:
+                # int8 models of UDL.Basis.quantize are stored whole, their packed weights do not fit the float model
+                model = checkpoint['model']
+            elif model is not None:
                 print(checkpoint['state_dict'].keys())
                 print(model)
                 base_wrap = "model" in list(model.state_dict().keys())[0]
-                ckpt = partial_load_checkpoint(base_wrap, checkpoint['state_dict'], args.amp, ignore_params)
+                ckpt = partial_load_checkpoint(base_wrap, checkpoint['state_dict'], args.amp if use_apex(args) else None,
+                                               ignore_params)
                 if args.distributed:
                     model.module.load_state_dict(ckpt, strict=args.load_model_strict)  # , strict=False
                 else:
@@ -289,7 +352,30 @@ def load_checkpoint(args, model, optimizer, ignore_params=[]):
             if global_rank == 0:
                 log_string("=> no checkpoint found at '{}'".format(args.resume))
 
-        return model, optimizer
+    return model, optimizer
+
+
+def load_resume_state(args, scaler, sampler, metric_logger):
+    """Restores the mid-epoch part of a ``resume_state.pth.tar`` written every ``args.save_every_iters``.
+
+    Model and optimizer are loaded by ``load_checkpoint`` from the same file. Returns the saved RNG states,
+    which the caller applies right before continuing the interrupted epoch, or None for a plain checkpoint.
+    """
+    if not args.resume or not os.path.isfile(args.resume):
+        return None
+    checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
+    if not isinstance(checkpoint, dict) or checkpoint.get('iter') is None:
+        return None
+    # continue inside the saved epoch instead of the next one
+    args.start_epoch = checkpoint['epoch']
+    if scaler is not None and checkpoint.get('scaler') is not None:
+        scaler.load_state_dict(checkpoint['scaler'])
+    if sampler is not None and checkpoint.get('sampler') is not None:
+        sampler.load_state_dict(checkpoint['sampler'])
+    metric_logger.load_state_dict(checkpoint['metric_logger'])
+    if args.global_rank == 0:
+        log_string("=> resuming epoch {} at iteration {}".format(checkpoint['epoch'], checkpoint['iter']))
+    return checkpoint['rng']
 
 
 def show_maps(axes, O, B, outputs):
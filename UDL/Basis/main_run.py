@@ -15,7 +15,8 @@ from logging import info as log_string
 # from UDL.mmcls.compared.mmclassification.mmcls.datasets import build_dataloader, build_dataset
 # from UDL.mmcls.compared.mmclassification.mmcls.models import build_classifier
 from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, get_root_logger
-from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint
+from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint, \
+    amp_state_dict
 from UDL.Basis.dist_utils import init_dist, dist_train_v1, get_dist_info, reduce_mean
 import logging
 import copy
@@ -142,7 +143,7 @@ class EpochRunner():
         model = model_amp(args, model, criterion, args.reg)
         optimizer, scaler = model.apex_initialize(optimizer)
         model.dist_train()
-        model, optimizer = load_checkpoint(args, model, optimizer)
+        model, optimizer = load_checkpoint(args, model, optimizer, scaler=scaler)
         if args.start_epoch >= 1:
             args.epochs += 1
         start_time = time.time()
@@ -171,7 +172,8 @@ class EpochRunner():
                         'best_metric': args.best_prec1,
                         'loss': val_loss,
                         'best_epoch': args.best_epoch,
-                        'amp': amp.state_dict() if args.amp_opt_level != 'O0' else None,
+                        'amp': amp_state_dict(args),
+                        'scaler': scaler.state_dict() if scaler is not None else None,
                         'optimizer': optimizer.state_dict()
                     }, args.model_save_dir, is_best, filename=f"{epoch}.pth.tar")
             if args.global_rank == 0:
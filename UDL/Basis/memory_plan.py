@@ -0,0 +1,321 @@
+"""
+Memory-budgeted inference: one planner picks the spatial tile size, the tiles per forward and the spectral band
+chunk (module.enable_band_chunking) so that a full scene fits into --eval-memory-mb, on cpu as well as cuda.
+
+Peak memory is measured, not guessed: PeakMemory counts the bytes of every tensor the forward allocates and
+frees (kernel workspaces excluded). The planner probes one tile at two sizes per band chunk, fits
+``peak = a + b * tile^2`` and adds the whole-scene accumulators of tiled_inference. Whole-image inference is
+preferred when it fits (band chunking is exact, tiling blends), then the largest tile.
+
+Band chunking only lowers the peak of nn.Sequential conv + non-inplace activation blocks with at least as many
+outputs as bands. The tails of PSRT, PSRT_KAv22, SWATv4 and Swin_poolv30_shortcut end in an in-place LeakyReLU, so
+for them chunking is a no-op and the plan is tiling only; the ``chunked`` column of the report counts the blocks.
+
+usage:
+    python -m UDL.Basis.memory_plan --filter "^PSRT$|^Swin_poolv30_shortcut$" --size 512 --budget-mb 256
+    python -m UDL.Basis.memory_plan --filter "^SWATv4$" --size 256 --budget-mb 128 --band-chunk 8 --out results/plan
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import math
+import os
+import re
+import sys
+import time
+import traceback
+from functools import partial
+import torch
+from torch.multiprocessing.reductions import StorageWeakRef
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
+from logging import info as log_string
+from UDL.Basis.module import tiled_inference, enable_band_chunking, _chunk_saves_memory, _grid_pad
+
+MB = 2 ** 20
+FIELDS = ['name', 'bands', 'inputs', 'mode', 'tile_size', 'tiles_per_batch', 'band_chunk', 'chunked', 'est_peak(MB)',
+          'peak(MB)', 'time(ms)', 'err', 'status']
+
+
+class PeakMemory(TorchDispatchMode):
+    """Peak bytes of the tensors allocated inside the ``with`` block, tensors created before it (weights, inputs)
+    and views of them are not counted."""
+
+    def __init__(self):
+        super(PeakMemory, self).__init__()
+        # StorageImpl address -> (weak ref, bytes), 0 bytes for storages from outside the block
+        self.live = {}
+        self.current = self.peak = 0
+
+    def _storages(self, tree):
+        for t in tree_leaves(tree):
+            if isinstance(t, torch.Tensor) and t.layout == torch.strided:
+                yield t.untyped_storage()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        for storage in self._storages((args, kwargs)):
+            self.live.setdefault(storage._cdata, (StorageWeakRef(storage), 0))
+        out = func(*args, **(kwargs or {}))
+        for key, (ref, nbytes) in list(self.live.items()):
+            if ref.expired():
+                del self.live[key]
+                self.current -= nbytes
+        for storage in self._storages(out):
+            if storage._cdata not in self.live:
+                self.live[storage._cdata] = (StorageWeakRef(storage), storage.nbytes())
+                self.current += storage.nbytes()
+        self.peak = max(self.peak, self.current)
+        return out
+
+
+@torch.no_grad()
+def measure_peak(fn, *inputs, **kwargs):
+    """(peak bytes, output) of ``fn(*inputs)``."""
+    with PeakMemory() as memory:
+        out = fn(*inputs, **kwargs)
+    return memory.peak, out
+
+
+def _bytes(t):
+    return t.numel() * t.element_size()
+
+
+def _round_up(x, multiple):
+    return int(math.ceil(x / multiple) * multiple)
+
+
+def chunked_blocks(model, chunk, bands):
+    """Number of blocks ``enable_band_chunking(model, chunk, bands)`` would patch, 0 when chunking is a no-op."""
+    return sum(1 for m in model.modules() if chunk > 0 and _chunk_saves_memory(m, bands, chunk))
+
+
+def tiled_overhead(inputs, out_channels, scale, tile_size, overlap, tiles_per_batch):
+    """Bytes tiled_inference holds besides the forward: padded inputs, the float32 output accumulator and
+    weight map of the whole scene, the batch of tile inputs and the output of the previous batch."""
+    b, _, h, w = inputs[0].shape
+    stride = tile_size - overlap
+    H, W = h + _grid_pad(h, tile_size, stride), w + _grid_pad(w, tile_size, stride)
+    padded = sum(_bytes(x) * H * W // (h * w) for x in inputs) if (H, W) != (h, w) else 0
+    accumulator = (b * out_channels + 1) * H * W * scale ** 2 * 4
+    tiles = (sum(_bytes(x) // (h * w) for x in inputs) + b * out_channels * scale ** 2 * 4) * \
+        tile_size ** 2 * tiles_per_batch
+    return padded + accumulator + tiles
+
+
+def plan_inference(model, inputs, budget_mb, overlap=16, multiple=8, chunks=(64, 32, 16, 8), max_tiles_per_batch=16,
+                   forward=None):
+    """Picks {'tile_size', 'tiles_per_batch', 'band_chunk', 'est_peak'} for ``forward(*inputs)`` under budget_mb.
+
+    tile_size 0 is whole-image inference. Band chunks below the band count (the widest input) are tried next to
+    no chunking (0), unless no block of ``model`` would be chunked. ``model`` is left without band chunking.
+    """
+    forward = forward or partial(type(model).forward, model)
+    # 5% headroom: padding to window multiples makes the peak of some models step above the quadratic fit
+    budget = 0.95 * budget_mb * MB
+    bands = max(x.shape[1] for x in inputs)
+    b, _, h, w = inputs[0].shape
+    tileable = all(x.dim() == 4 and x.shape[-2:] == (h, w) for x in inputs)
+    t1 = _round_up(max(2 * overlap, 32), multiple)
+    probe = tileable and min(h, w) >= 2 * t1
+    chunks = [c for c in chunks if c < bands and chunked_blocks(model, c, bands)]
+    fits = {}
+    try:
+        for chunk in [0] + chunks:
+            enable_band_chunking(model, chunk, bands)
+            if not probe:
+                # small or multi-resolution inputs: measured whole
+                fits[chunk] = (measure_peak(forward, *inputs)[0], 0, None)
+                continue
+            (p1, out), (p2, _) = [measure_peak(forward, *[x[..., :t, :t] for x in inputs]) for t in (t1, 2 * t1)]
+            slope = max(p2 - p1, 0) / (3 * t1 ** 2)
+            out = out if isinstance(out, torch.Tensor) else out[0]
+            fits[chunk] = (max(p1 - slope * t1 ** 2, 0), slope, (out.shape[1], out.shape[-1] // t1))
+    finally:
+        enable_band_chunking(model, 0, bands)
+
+    def plan(tile_size, chunk, est, n=1):
+        return {'tile_size': tile_size, 'tiles_per_batch': n, 'band_chunk': chunk, 'est_peak': est}
+
+    for chunk, (a, slope, _) in fits.items():
+        if a + slope * h * w <= budget:
+            return plan(0, chunk, a + slope * h * w)
+    if not probe:
+        chunk = min(fits, key=lambda c: fits[c][0])
+        log_string(f"=> no plan fits {budget_mb} MB, running whole images with band chunk {chunk}")
+        return plan(0, chunk, fits[chunk][0])
+
+    def estimate(chunk, tile_size, n):
+        a, slope, (out_channels, scale) = fits[chunk]
+        return a + slope * tile_size ** 2 * n + tiled_overhead(inputs, out_channels, scale, tile_size, overlap, n)
+
+    sizes = range(_round_up(max(h, w), multiple), _round_up(overlap + multiple, multiple) - 1, -multiple)
+    best = None
+    for chunk in fits:
+        tile_size = next((t for t in sizes if estimate(chunk, t, 1) <= budget), None)
+        if tile_size is not None and (best is None or tile_size > best[0]):
+            best = (tile_size, chunk)
+    if best is None:
+        tile_size = sizes[-1]
+        chunk = min(fits, key=lambda c: estimate(c, tile_size, 1))
+        log_string(f"=> no plan fits {budget_mb} MB, the smallest ({tile_size}px tiles, band chunk {chunk}) "
+                   f"needs {estimate(chunk, tile_size, 1) / MB:.0f} MB")
+        return plan(tile_size, chunk, estimate(chunk, tile_size, 1))
+    tile_size, chunk = best
+    stride = tile_size - overlap
+    num_tiles = ((h + _grid_pad(h, tile_size, stride) - tile_size) // stride + 1) * \
+                ((w + _grid_pad(w, tile_size, stride) - tile_size) // stride + 1)
+    n = 1
+    while n < min(max_tiles_per_batch, num_tiles) and estimate(chunk, tile_size, n + 1) <= budget:
+        n += 1
+    return plan(tile_size, chunk, estimate(chunk, tile_size, n), n)
+
+
+class PlannedInference():
+    """Replacement ``model.forward`` running every input shape with its own plan (see ``plan_inference``).
+
+    With ``budget_mb=0`` the plan is fixed: ``tile_size`` (0: whole image) and ``band_chunk``.
+    """
+
+    def __init__(self, model, budget_mb=0, tile_size=0, band_chunk=0, overlap=16, window='gaussian',
+                 tiles_per_batch=16):
+        self.model = model
+        self.forward = partial(type(model).forward, model)
+        self.budget_mb = budget_mb
+        self.overlap = overlap
+        self.window = window
+        self.fixed = {'tile_size': tile_size, 'tiles_per_batch': tiles_per_batch, 'band_chunk': band_chunk,
+                      'est_peak': None}
+        self.plans = {}
+
+    def plan(self, *x):
+        key = tuple(tuple(t.shape) for t in x)
+        if key not in self.plans:
+            if self.budget_mb > 0:
+                plan = plan_inference(self.model, x, self.budget_mb, self.overlap, forward=self.forward,
+                                      max_tiles_per_batch=self.fixed['tiles_per_batch'])
+                log_string(f"=> memory plan for {key}: {plan['tile_size']}px tiles x{plan['tiles_per_batch']}, "
+                           f"band chunk {plan['band_chunk']}, ~{plan['est_peak'] / MB:.0f} MB")
+            else:
+                plan = self.fixed
+                bands = max(t.shape[1] for t in x)
+                if plan['band_chunk'] and not chunked_blocks(self.model, plan['band_chunk'], bands):
+                    log_string(f"=> band chunk {plan['band_chunk']} is a no-op for {type(self.model).__name__}: "
+                               f"no conv + non-inplace activation block with as many outputs as bands")
+            self.plans[key] = plan
+        return self.plans[key]
+
+    def __call__(self, *x, **kwargs):
+        plan = self.plan(*x)
+        enable_band_chunking(self.model, plan['band_chunk'], max(t.shape[1] for t in x))
+        if plan['tile_size'] == 0:
+            return self.forward(*x, **kwargs)
+        return tiled_inference(self.forward, *x, tile_size=plan['tile_size'], overlap=self.overlap,
+                               window=self.window, tiles_per_batch=plan['tiles_per_batch'], **kwargs)
+
+
+def enable_planned_inference(model, args):
+    """Makes ``model.forward`` (and thus eval_step) fit --eval-memory-mb, or apply --band-chunk (and --tile-size)."""
+    model.forward = PlannedInference(model, args.eval_memory_mb, args.tile_size, args.band_chunk, args.tile_overlap,
+                                     args.tile_window, args.crop_batch_size)
+    return model
+
+
+def _rel_err(out, ref):
+    return f"{((out - ref).abs().max() / ref.abs().max().clamp(min=1e-12)).item():.1e}"
+
+
+def check_entry(entry, cfg):
+    """Full-band whole-image reference against band chunking, the plan for --budget-mb and the plan without
+    band chunking, each with its measured peak memory and time."""
+    # benchmark (and its optional fvcore import) only for the command line, not for main_hisr's eval
+    from UDL.Basis.benchmark import REPO_ROOT, load_args, make_batch, capture_inputs, _first_tensor
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, cfg.device)
+        torch.manual_seed(0)
+        model = getattr(importlib.import_module(entry['module']), entry['builder'])(args)[0].to(cfg.device)
+        batch = make_batch('hisr', cfg.batch_size, cfg.size, cfg.scale, cfg.hsi_bands)
+        inputs = tuple(x.to(cfg.device) for x in capture_inputs(model, batch))
+    model.eval()
+    common = {'name': entry['name'], 'bands': max(x.shape[1] for x in inputs),
+              'inputs': ' '.join('x'.join(map(str, x.shape)) for x in inputs)}
+    rows, ref = [], None
+    plan = plan_inference(model, inputs, cfg.budget_mb, cfg.overlap, max_tiles_per_batch=cfg.tiles_per_batch)
+    modes = [('full', {'tile_size': 0, 'band_chunk': 0, 'tiles_per_batch': 1, 'est_peak': None}),
+             ('band_chunked', {'tile_size': 0, 'band_chunk': cfg.band_chunk, 'tiles_per_batch': 1, 'est_peak': None}),
+             ('planned', plan)]
+    if plan['band_chunk'] and plan['tile_size']:
+        # separates the chunking error from the tile blending
+        modes.append(('planned_unchunked', dict(plan, band_chunk=0, est_peak=None)))
+    for mode, p in modes:
+        forward = PlannedInference(model, 0, p['tile_size'], p['band_chunk'], cfg.overlap,
+                                   tiles_per_batch=p['tiles_per_batch'])
+        row = dict(common, mode=mode, **{k: p[k] for k in ('tile_size', 'tiles_per_batch', 'band_chunk')})
+        row['chunked'] = chunked_blocks(model, p['band_chunk'], common['bands'])
+        if p['est_peak'] is not None:
+            row['est_peak(MB)'] = round(p['est_peak'] / MB, 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peak, out = measure_peak(forward, *inputs)
+            t = time.perf_counter()
+            with torch.no_grad():
+                forward(*inputs)
+        out = _first_tensor(out)
+        row['peak(MB)'] = round(peak / MB, 1)
+        row['time(ms)'] = round((time.perf_counter() - t) * 1e3, 1)
+        if ref is None:
+            ref = out
+        row['err'] = _rel_err(out, ref)
+        if mode == 'planned_unchunked':
+            row['err'] = f"{row['err']} (chunking {_rel_err(planned, out)})"
+        planned = out
+        row['status'] = 'ok' if mode != 'planned' or peak <= cfg.budget_mb * MB else 'over budget'
+        if p['band_chunk'] and not row['chunked']:
+            row['status'] = f"{row['status']}, chunking no-op"
+        rows.append(row)
+    return rows
+
+
+def memory_plan_cfg(argv=None):
+    from UDL.Basis.benchmark import SEARCH_ROOTS
+    parser = argparse.ArgumentParser(description='Memory budget planner (tiles + band chunks) with parity check')
+    parser.add_argument('--filter', required=True, type=str, help='regex on the hisr builder name or module')
+    parser.add_argument('--budget-mb', default=256, type=float)
+    parser.add_argument('--band-chunk', default=8, type=int, help='chunk of the band_chunked parity row')
+    parser.add_argument('--overlap', default=16, type=int)
+    parser.add_argument('--tiles-per-batch', default=16, type=int, help='upper bound of the plan')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--size', default=256, type=int, help='HR spatial size of the synthetic scene')
+    parser.add_argument('--scale', default=4, type=int, help='hisr upsampling ratio of lrhsi')
+    parser.add_argument('--hsi-bands', default=31, type=int, help='has to match the model (31 for the CAVE variants)')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--out', default='memory_plan', type=str, help='writes <out>.csv and <out>.md')
+    parser.add_argument('--verbose', action='store_true', help='print tracebacks of failed builders')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from UDL.Basis.benchmark import SEARCH_ROOTS, find_builders, write_table
+    cfg = memory_plan_cfg(argv)
+    torch.set_num_threads(cfg.threads)
+    entries = [e for e in find_builders({'hisr': SEARCH_ROOTS['hisr']})
+               if re.search(cfg.filter, e['name']) or re.search(cfg.filter, e['module'])]
+    rows = []
+    for i, entry in enumerate(entries):
+        try:
+            entry_rows = check_entry(entry, cfg)
+        except Exception as e:
+            entry_rows = [{'name': entry['name'],
+                           'status': f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"}]
+            if cfg.verbose:
+                traceback.print_exc()
+        for row in entry_rows:
+            print(f"[{i + 1}/{len(entries)}] " + ' '.join(f"{k}={row[k]}" for k in FIELDS if k in row))
+        rows.extend(entry_rows)
+    write_table(rows, cfg.out, FIELDS)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
+import math
+from functools import partial, lru_cache
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import torch.nn.functional as F
 from torch.nn.modules.utils import _pair
 from typing import Optional, List
 from torch import Tensor
 import numpy as np
+from packaging.version import Version
 from .self_attn_module import *
 
 # implement tf.gather_nd() in pytorch
@@ -31,227 +35,332 @@ def gather_nd(tensor, indexes, ndim):
     return gathered
 
 
-class PatchMergeModule(nn.Module):
+def tile_window(size, kind='gaussian', device=None):
+    """2D blending weights of a ``size`` x ``size`` tile, largest at the centre.
 
-    def __init__(self, bs_axis_merge=False):
-        super().__init__()
-        if bs_axis_merge:
-            self.split_func = torch.split
+    'gaussian' (sigma = size / 8) and 'cosine' (Hann) down-weight tile borders so overlaps blend without seams,
+    'uniform' averages overlaps like the old forward_chop. Weights are floored at 1e-3 so border pixels covered
+    by a single tile stay defined.
+    """
+    coords = torch.arange(size, dtype=torch.float32, device=device)
+    if kind == 'gaussian':
+        sigma = size / 8
+        w = torch.exp(-(coords - (size - 1) / 2) ** 2 / (2 * sigma ** 2))
+    elif kind == 'cosine':
+        w = torch.sin(math.pi * (coords + 0.5) / size) ** 2
+    elif kind == 'uniform':
+        w = torch.ones_like(coords)
+    else:
+        raise ValueError(f"unknown tile window: {kind}")
+    w = w.clamp(min=1e-3)
+    return w[:, None] * w[None, :]
+
+
+def _grid_pad(size, tile_size, stride):
+    # padding that makes (size - tile_size) a multiple of stride
+    if size <= tile_size:
+        return tile_size - size
+    return math.ceil((size - tile_size) / stride) * stride + tile_size - size
+
+
+@torch.no_grad()
+def tiled_inference(forward, *x, tile_size=64, overlap=16, window='gaussian', tiles_per_batch=16,
+                    memory_budget=0, **kwargs):
+    """Runs ``forward`` on overlapping tiles of the 4D inputs ``x`` and blends the outputs.
+
+    Tiles are cut, batched and accumulated on the inputs' device. ``tiles_per_batch`` tiles (times the batch
+    size) go through ``forward`` at once; with ``memory_budget`` (bytes, cuda only) the tile batch is sized from
+    the peak memory of a single tile instead. Inputs are reflect-padded so the tile grid covers them exactly,
+    and the output scale (e.g. x4 SR) is taken from the output tile size.
+    Inputs smaller than the largest one by an integer factor r (the lrhsi of the Bidi models) are tiled at their
+    own scale, with tiles and overlaps of ``tile_size / r`` and ``overlap / r`` pixels.
+    Returns a tensor, or a list if ``forward`` returns several outputs.
+    """
+    b = x[0].shape[0]
+    h, w = max(s.shape[-2] for s in x), max(s.shape[-1] for s in x)
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"tile overlap {overlap} must be smaller than the tile size {tile_size}")
+    ratios = []
+    for s in x:
+        if s.dim() != 4 or h % s.shape[-2] or w % s.shape[-1] or h // s.shape[-2] != w // s.shape[-1]:
+            raise ValueError(f"tiled inputs must be 4D with (H, W) an integer fraction of {(h, w)}, "
+                             f"got {tuple(s.shape)}")
+        r = h // s.shape[-2]
+        if tile_size % r or overlap % r:
+            raise ValueError(f"tile size {tile_size} and overlap {overlap} must be multiples of {r} to tile "
+                             f"the {tuple(s.shape[-2:])} input")
+        ratios.append(r)
+    pad_h, pad_w = _grid_pad(h, tile_size, stride), _grid_pad(w, tile_size, stride)
+    if pad_h or pad_w:
+        mode = 'reflect' if pad_h < h and pad_w < w else 'replicate'
+        x = [F.pad(s, (0, pad_w // r, 0, pad_h // r), mode=mode) for s, r in zip(x, ratios)]
+    H, W = h + pad_h, w + pad_w
+    coords = [(i, j) for i in range(0, H - tile_size + 1, stride) for j in range(0, W - tile_size + 1, stride)]
+    device = x[0].device
+    probe = memory_budget > 0 and device.type == 'cuda'
+    n = 1 if probe else max(1, tiles_per_batch)
+
+    single, outputs, weights, windows, scales = False, None, None, None, None
+    start = 0
+    while start < len(coords):
+        chunk = coords[start:start + n]
+        inputs = [torch.cat([s[..., i // r:(i + tile_size) // r, j // r:(j + tile_size) // r] for i, j in chunk],
+                            dim=0) for s, r in zip(x, ratios)]
+        if probe:
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        out = forward(*inputs, **kwargs)
+        if probe:
+            per_tile = max(torch.cuda.max_memory_allocated(device) - base, 1)
+            n, probe = max(1, int(memory_budget // per_tile)), False
+        if outputs is None:
+            single = isinstance(out, torch.Tensor)
+            out = [out] if single else list(out)
+            scales = [o.shape[-1] // tile_size for o in out]
+            for o, r in zip(out, scales):
+                if r < 1 or o.shape[-2:] != (tile_size * r, tile_size * r):
+                    raise ValueError(f"output tiles {tuple(o.shape[-2:])} are not an integer upscaling of the "
+                                     f"{tile_size}px input tiles")
+            outputs = [torch.zeros(b, o.shape[1], H * r, W * r, device=device) for o, r in zip(out, scales)]
+            weights = [torch.zeros(1, 1, H * r, W * r, device=device) for r in scales]
+            windows = [tile_window(tile_size * r, window, device) for r in scales]
         else:
-            self.split_func = lambda x, _, dim: [x]
+            out = [out] if single else list(out)
+        for o, acc, weight, win, r in zip(out, outputs, weights, windows, scales):
+            for k, (i, j) in enumerate(chunk):
+                region = (..., slice(i * r, (i + tile_size) * r), slice(j * r, (j + tile_size) * r))
+                acc[region].addcmul_(o[k * b:(k + 1) * b].float(), win)
+                weight[region].add_(win)
+        start += len(chunk)
+
+    outputs = [acc.div_(weight)[..., :h * r, :w * r].to(x[0].dtype) for acc, weight, r in zip(outputs, weights, scales)]
+    return outputs[0] if single else outputs
+
+
+def enable_tiled_inference(model, args):
+    """Makes ``model.forward`` (and thus eval_step) run through ``tiled_inference`` with the ``--tile-*`` options."""
+    model.forward = partial(tiled_inference, partial(type(model).forward, model),
+                            tile_size=args.tile_size, overlap=args.tile_overlap, window=args.tile_window,
+                            tiles_per_batch=args.crop_batch_size, memory_budget=args.tile_budget_mb * 2 ** 20)
+    return model
+
+
+# elementwise modules a conv output can be pushed through band chunk by band chunk
+_SEPARABLE = (nn.ReLU, nn.LeakyReLU, nn.ReLU6, nn.ELU, nn.GELU, nn.SiLU, nn.Sigmoid, nn.Tanh, nn.Identity)
+
+
+def band_chunked_conv2d(conv, x, chunk, post=None):
+    """``post(conv(x))`` of an nn.Conv2d, computed ``chunk`` output channels at a time.
+
+    Every chunk (whole groups for grouped / depthwise convs) goes through the elementwise, channel-separable
+    ``post`` before it is written into the output, so a non-inplace activation after a tail expanding to the
+    bands holds one band chunk instead of a second full-band tensor. Identical to the unchunked conv.
+    """
+    kwargs = dict(stride=conv.stride, padding=conv.padding, dilation=conv.dilation)
+    if conv.padding_mode != 'zeros':
+        x = F.pad(x, conv._reversed_padding_repeated_twice, mode=conv.padding_mode)
+        kwargs['padding'] = 0
+    weight, bias, groups = conv.weight, conv.bias, conv.groups
+    if groups == 1:
+        chunks = [(x, slice(i, i + chunk), 1) for i in range(0, conv.out_channels, chunk)]
+    else:
+        in_per_group, out_per_group = conv.in_channels // groups, conv.out_channels // groups
+        step = max(1, chunk // out_per_group)
+        chunks = [(x[:, g * in_per_group:(g + step) * in_per_group],
+                   slice(g * out_per_group, (g + step) * out_per_group), min(step, groups - g))
+                  for g in range(0, groups, step)]
+    out = None
+    for xs, o, n in chunks:
+        y = F.conv2d(xs, weight[o], None if bias is None else bias[o], groups=n, **kwargs)
+        if post is not None:
+            y = post(y)
+        if out is None:
+            out = y.new_empty(y.shape[0], conv.out_channels, *y.shape[2:])
+        out[:, o] = y
+    return out
+
+
+def _chunked_sequential_forward(seq, chunk, x):
+    return band_chunked_conv2d(seq[0], x, chunk, post=seq[1:])
+
+
+def _chunk_saves_memory(m, min_channels, chunk):
+    # a plain conv allocates its whole output anyway, chunking only pays off when a non-inplace elementwise module
+    # would otherwise hold a second full-band tensor (conv + activation tails, grouped convs + activation)
+    return isinstance(m, nn.Sequential) and len(m) > 1 and isinstance(m[0], nn.Conv2d) and \
+        all(isinstance(p, _SEPARABLE) for p in m[1:]) and \
+        any(not isinstance(p, nn.Identity) and not getattr(p, 'inplace', False) for p in m[1:]) and \
+        m[0].out_channels >= min_channels and m[0].out_channels > chunk
+
+
+def enable_band_chunking(model, chunk, min_channels):
+    """Runs the nn.Sequential conv + elementwise activation blocks of ``model`` whose conv has at least
+    ``min_channels`` (the band count) outputs through ``band_chunked_conv2d`` with ``chunk`` channels. Only blocks
+    with a non-inplace activation are chunked, other convs keep their forward. ``chunk=0`` restores the plain
+    forwards.
+    """
+    for m in model.modules():
+        if 'forward' in m.__dict__ and isinstance(m.__dict__['forward'], partial) and \
+                m.__dict__['forward'].func is _chunked_sequential_forward:
+            del m.forward
+    if chunk <= 0:
+        return model
+    for m in model.modules():
+        if _chunk_saves_memory(m, min_channels, chunk):
+            m.forward = partial(_chunked_sequential_forward, m, chunk)
+    return model
+
+
+# modules kept in fp32 by HalfInference: normalisation statistics, attention softmax, KernelAttention's window
+# reweighting (pooling + sigmoid over tiny activations)
+FP32_MODULES = ('Softmax', 'LayerNorm', 'GroupNorm', 'BatchNorm2d', 'InstanceNorm2d', 'WinKernel_Reweight')
+
+
+def _fp32_forward(forward, device_type, *args, **kwargs):
+    with torch.autocast(device_type, enabled=False):
+        return forward(*[a.float() if isinstance(a, Tensor) and a.is_floating_point() else a for a in args],
+                       **kwargs)
+
+
+def _to_float(out):
+    if isinstance(out, Tensor):
+        return out.float()
+    return type(out)(_to_float(o) for o in out) if isinstance(out, (list, tuple)) else out
+
+
+class HalfInference():
+    """Replacement ``model.forward`` running under torch.autocast with ``dtype`` (fp16 / bf16).
+
+    Modules whose class name is in ``fp32_modules`` run with autocast disabled on fp32 inputs. The inputs stay
+    fp32, so the final reconstruction add (``tail(x) + lms``) promotes to fp32, and outputs are cast back to fp32
+    before any metric. Wraps the current ``model.forward``, i.e. tiled / planned inference enabled before.
+    ``enabled = False`` runs the fp32 reference.
+    """
+
+    def __init__(self, model, dtype, fp32_modules=FP32_MODULES):
+        forward = model.forward
+        self.forward = forward.forward if isinstance(forward, HalfInference) else forward
+        self.device_type = next(model.parameters()).device.type
+        self.dtype = dtype
+        self.enabled = True
+        for m in model.modules():
+            if type(m).__name__ in fp32_modules and 'forward' not in m.__dict__:
+                m.forward = partial(_fp32_forward, m.forward, self.device_type)
+
+    def __call__(self, *x, **kwargs):
+        if not self.enabled:
+            return self.forward(*x, **kwargs)
+        with torch.autocast(self.device_type, dtype=self.dtype):
+            return _to_float(self.forward(*x, **kwargs))
+
+
+def enable_half_inference(model, args):
+    """Makes ``model.forward`` (and thus eval_step) run in --eval-precision, keeping --eval-fp32-modules in fp32."""
+    dtype = torch.bfloat16 if args.eval_precision == 'bf16' else torch.float16
+    model.forward = HalfInference(model, dtype, args.eval_fp32_modules)
+    return model.forward
+
+
+def to_channels_last(x):
+    """The 4D tensors of x (a tensor or a dict/list/tuple batch) in channels_last memory format."""
+    if isinstance(x, torch.Tensor):
+        return x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+    if isinstance(x, dict):
+        return type(x)((k, to_channels_last(v)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_channels_last(v) for v in x)
+    return x
+
+
+def enable_channels_last(model):
+    """Converts the 4D weights and buffers of ``model`` to channels_last (NHWC strides) in place, so optimizers
+    built on the parameters stay valid. cudnn / oneDNN then run the convolutions without layout transposes as
+    long as the inputs are channels_last too (``to_channels_last``).
+
+    ``Module.to(memory_format=...)`` would also try to convert 5D tensors (the kernel banks of the
+    kernel-attention blocks) and fail, so only 4D tensors are touched here.
+    """
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            if t.dim() == 4:
+                t.data = t.data.contiguous(memory_format=torch.channels_last)
+    return model
+
+
+# stage containers of the window-attention models: Swin BasicLayer, SwinIR RSTB, PSRT_Block, Bidi Stage
+CHECKPOINT_STAGES = ('BasicLayer', 'RSTB', 'PSRT_Block', 'Stage')
+
+
+def _checkpointed_forward(forward, *args, **kwargs):
+    if not torch.is_grad_enabled():
+        return forward(*args, **kwargs)
+    return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
 
-    def forward_chop(self, is_training, *x, shave=12, **kwargs):
-        # 不存在输入张量不一样的情况, 如不一样请先处理成一样的再输入
-        # 但输出存在维度不一样的情况, 因为网络有多层并且每层尺度不同, 进行分开处理: final_output, intermediate_output
-        x = torch.cat(x, dim=0)
-        split_func = self.split_func
-        args = self.args
-        # self.axes[1][0].imshow(x[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-        x.cpu()
-        batchsize = args.crop_batch_size
-        b, c, h, w = x.size()
-        padsize = int(args.patch_size)
-        shave = int(args.patch_size / 2)
-        # print(self.scale, self.idx_scale)
-        scale = args.scale  # self.scale[self.idx_scale]
-
-        h_cut = (h - padsize) % (int(shave / 2))
-        w_cut = (w - padsize) % (int(shave / 2))
-
-        x_unfold = F.unfold(x, padsize, stride=int(shave / 2)).permute(2, 0, 1).contiguous()
-
-        ################################################
-        # 最后一块patch单独计算
-        ################################################
-
-        x_hw_cut = x[..., (h - padsize):, (w - padsize):]
-        y_hw_cut = self.forward(is_training, *[s.cuda() for s in split_func(x_hw_cut, [1, 1], dim=0)], **kwargs)
-        y_hw_cut = [s.cpu() for s in y_hw_cut]
-
-        x_h_cut = x[..., (h - padsize):, :]
-        x_w_cut = x[..., :, (w - padsize):]
-        y_h_cut = self.cut_h(x_h_cut, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs)
-        y_w_cut = self.cut_w(x_w_cut, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs)
-        # self.axes[0][0].imshow(y_h_cut[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-        ################################################
-        # 左上patch单独计算，不是平均而是覆盖
-        ################################################
-
-        x_h_top = x[..., :padsize, :]
-        x_w_top = x[..., :, :padsize]
-        y_h_top = self.cut_h(x_h_top, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs)
-        y_w_top = self.cut_w(x_w_top, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs)
-
-        # self.axes[0][1].imshow(y_h_top[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-        ################################################
-        # img->patch，最大计算crop_s个patch，防止bs*p*p太大
-        ################################################
-
-        x_unfold = x_unfold.view(x_unfold.size(0), -1, c, padsize, padsize)
-        y_unfold = []
-
-        x_range = x_unfold.size(0) // batchsize + (x_unfold.size(0) % batchsize != 0)
-        x_unfold.cuda()
-        for i in range(x_range):
-            y_unfold.append([s.cpu() for s in self.forward(*[s[:, 0, ...] for s in split_func(x_unfold[i * batchsize:(i + 1) * batchsize, ...], [1, 1], dim=1)]
-                , **kwargs)])
-            # P.data_parallel(self.model, x_unfold[i*batchsize:(i+1)*batchsize,...], range(self.n_GPUs)).cpu())
-
-        for i, s in enumerate(zip(*y_unfold)):
-            if i < len(y_unfold):
-                y_unfold[i] = s
-            else:
-                y_unfold.append(s)
-
-        out = []
-        for s_unfold, s_h_top, s_w_top, s_h_cut, s_w_cut, s_hw_cut in zip(y_unfold, y_h_top, y_w_top, y_h_cut, y_w_cut, y_hw_cut):
-
-            s_unfold = torch.cat(s_unfold, dim=0)
-
-            y = F.fold(s_unfold.view(s_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                       ((h - h_cut) * scale, (w - w_cut) * scale), padsize * scale,
-                       stride=int(shave / 2 * scale))
-            # 312， 480
-            # self.axes[0][2].imshow(y[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-            ################################################
-            # 第一块patch->y
-            ################################################
-            y[..., :padsize * scale, :] = s_h_top
-            y[..., :, :padsize * scale] = s_w_top
-            # self.axes[0][3].imshow(y[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-            s_unfold = s_unfold[...,
-                       int(shave / 2 * scale):padsize * scale - int(shave / 2 * scale),
-                       int(shave / 2 * scale):padsize * scale - int(shave / 2 * scale)].contiguous()
-            # 1，3，24，24
-            s_inter = F.fold(s_unfold.view(s_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                             ((h - h_cut - shave) * scale, (w - w_cut - shave) * scale),
-                             padsize * scale - shave * scale,
-                             stride=int(shave / 2 * scale))
-
-            s_ones = torch.ones(s_inter.shape, dtype=s_inter.dtype)
-            divisor = F.fold(F.unfold(s_ones, padsize * scale - shave * scale,
-                                      stride=int(shave / 2 * scale)),
-                             ((h - h_cut - shave) * scale, (w - w_cut - shave) * scale),
-                             padsize * scale - shave * scale,
-                             stride=int(shave / 2 * scale))
-
-            s_inter = s_inter / divisor
-            # self.axes[1][1].imshow(y_inter[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-            ################################################
-            # 第一个半patch
-            ################################################
-            y[..., int(shave / 2 * scale):(h - h_cut) * scale - int(shave / 2 * scale),
-            int(shave / 2 * scale):(w - w_cut) * scale - int(shave / 2 * scale)] = s_inter
-            # self.axes[1][2].imshow(y[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-            y = torch.cat([y[..., :y.size(2) - int((padsize - h_cut) / 2 * scale), :],
-                           s_h_cut[..., int((padsize - h_cut) / 2 * scale + 0.5):, :]], dim=2)
-            # 图分为前半和后半
-            # x->y_w_cut
-            # model->y_hw_cut
-            y_w_cat = torch.cat([s_w_cut[..., :s_w_cut.size(2) - int((padsize - h_cut) / 2 * scale), :],
-                                 s_hw_cut[..., int((padsize - h_cut) / 2 * scale + 0.5):, :]], dim=2)
-            y = torch.cat([y[..., :, :y.size(3) - int((padsize - w_cut) / 2 * scale)],
-                           y_w_cat[..., :, int((padsize - w_cut) / 2 * scale + 0.5):]], dim=3)
-            out.append(y.cuda())
-            # self.axes[1][3].imshow(y[0, ...].permute(1, 2, 0).cpu().numpy() / 255)
-            # plt.show()
-
-        return out#y.cuda()
-
-    def cut_h(self, x_h_cut, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs):
-        split_func = self.split_func
-        # b,c*k*k,n_H*n_W: 1, 30000, 3->2, 30000, 3
-        x_h_cut_unfold = F.unfold(x_h_cut, padsize, stride=int(shave / 2)).permute(2, 0, 1).contiguous() # transpose(0, 2)
-
-        x_h_cut_unfold = x_h_cut_unfold.view(x_h_cut_unfold.size(0), -1, c, padsize, padsize) # x_h_cut_unfold.size(0), -1, padsize, padsize
-        x_range = x_h_cut_unfold.size(0) // batchsize + (x_h_cut_unfold.size(0) % batchsize != 0)
-        y_h_cut_unfold = []
-        x_h_cut_unfold.cuda()
-        # TODO: [[a0, b0, c0], [a1, b1, c1], ...] -> [[a0, a1], [b0, b1], ...] -> [cat() for s in [[a0, a1], [b0, b1], ...]]
-        for i in range(x_range):
-            y_h_cut_unfold.append([s.cpu() for s in self.forward(*[s[:, 0, ...] for s in split_func(x_h_cut_unfold[i * batchsize:(i + 1) * batchsize,
-                                               ...], [1, 1], dim=1)], **kwargs)])  # P.data_parallel(self.model, x_h_cut_unfold[i*batchsize:(i+1)*batchsize,...], range(self.n_GPUs)).cpu())
-
-        for i, s in enumerate(zip(*y_h_cut_unfold)):
-            if i < len(y_h_cut_unfold):
-                y_h_cut_unfold[i] = s
-            else:
-                y_h_cut_unfold.append(s)
-
-        y_h_cut = []
-        for s_h_cut_unfold  in y_h_cut_unfold:
-
-            s_h_cut_unfold = torch.cat(s_h_cut_unfold, dim=0)
-            # nH*nW, c, k, k: 3, 3, 100, 100
-            s_h_cut = F.fold(
-                s_h_cut_unfold.view(s_h_cut_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                (padsize * scale, (w - w_cut) * scale), padsize * scale, stride=int(shave / 2 * scale))
-            s_h_cut_unfold = s_h_cut_unfold[..., :,
-                             int(shave / 2 * scale):padsize * scale - int(shave / 2 * scale)].contiguous()
-            s_h_cut_inter = F.fold(
-                s_h_cut_unfold.view(s_h_cut_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                (padsize * scale, (w - w_cut - shave) * scale), (padsize * scale, padsize * scale - shave * scale),
-                stride=int(shave / 2 * scale))
-
-            s_ones = torch.ones(s_h_cut_inter.shape, dtype=s_h_cut_inter.dtype)
-            divisor = F.fold(
-                F.unfold(s_ones, (padsize * scale, padsize * scale - shave * scale),
-                         stride=int(shave / 2 * scale)), (padsize * scale, (w - w_cut - shave) * scale),
-                (padsize * scale, padsize * scale - shave * scale), stride=int(shave / 2 * scale))
-            s_h_cut_inter = s_h_cut_inter / divisor
-
-            s_h_cut[..., :, int(shave / 2 * scale):(w - w_cut) * scale - int(shave / 2 * scale)] = s_h_cut_inter
-            y_h_cut.append(s_h_cut)
-
-        return y_h_cut
-
-    def cut_w(self, x_w_cut, h, w, c, h_cut, w_cut, padsize, shave, scale, batchsize, **kwargs):
-
-        split_func = self.split_func
-        x_w_cut_unfold = torch.nn.functional.unfold(x_w_cut, padsize, stride=int(shave / 2)).permute(2, 0, 1).contiguous()
-
-        x_w_cut_unfold = x_w_cut_unfold.view(x_w_cut_unfold.size(0), -1, c, padsize, padsize)
-        x_range = x_w_cut_unfold.size(0) // batchsize + (x_w_cut_unfold.size(0) % batchsize != 0)
-        y_w_cut_unfold = []
-        x_w_cut_unfold.cuda()
-
-        #TODO: [[a0, b0], [a1, b1], ...] -> [[a0, a1], [b0, b1], ...] -> [cat() for s in [[a0, a1], [b0, b1], ...]]
-        for i in range(x_range):
-            y_w_cut_unfold.append([s.cpu() for s in self.forward(*[s[:, 0, ...]for s in split_func(x_w_cut_unfold[i * batchsize:(i + 1) * batchsize,
-                                               ...], [1, 1], dim=1)], **kwargs)])  # P.data_parallel(self.model, x_w_cut_unfold[i*batchsize:(i+1)*batchsize,...], range(self.n_GPUs)).cpu())
-        for i, s in enumerate(zip(*y_w_cut_unfold)):
-            if i < len(y_w_cut_unfold):
-                y_w_cut_unfold[i] = s
-            else:
-                y_w_cut_unfold.append(s)
-        y_w_cut = []
-        for s_w_cut_unfold in y_w_cut_unfold:
 
-            s_w_cut_unfold = torch.cat(s_w_cut_unfold, dim=0)
+def checkpoint_stages(model, stage_types=CHECKPOINT_STAGES):
+    """The outermost modules of ``model`` whose class name is in ``stage_types``, in ``modules()`` order
+    (the RSTB of SwinIR, not also the BasicLayer inside it)."""
+    stages = []
+    for m in model.modules():
+        if type(m).__name__ in stage_types and not any(m in s.modules() for s in stages):
+            stages.append(m)
+    return stages
 
-            s_w_cut = torch.nn.functional.fold(
-                s_w_cut_unfold.view(s_w_cut_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                ((h - h_cut) * scale, padsize * scale), padsize * scale, stride=int(shave / 2 * scale))
-            s_w_cut_unfold = s_w_cut_unfold[..., int(shave / 2 * scale):padsize * scale - int(shave / 2 * scale),
-                             :].contiguous()
-            s_w_cut_inter = torch.nn.functional.fold(
-                s_w_cut_unfold.view(s_w_cut_unfold.size(0), -1, 1).transpose(0, 2).contiguous(),
-                ((h - h_cut - shave) * scale, padsize * scale), (padsize * scale - shave * scale, padsize * scale),
-                stride=int(shave / 2 * scale))
 
-            s_ones = torch.ones(s_w_cut_inter.shape, dtype=s_w_cut_inter.dtype)
-            divisor = torch.nn.functional.fold(
-                torch.nn.functional.unfold(s_ones, (padsize * scale - shave * scale, padsize * scale),
-                                           stride=int(shave / 2 * scale)), ((h - h_cut - shave) * scale, padsize * scale),
-                (padsize * scale - shave * scale, padsize * scale), stride=int(shave / 2 * scale))
-            s_w_cut_inter = s_w_cut_inter / divisor
+def enable_activation_checkpointing(model, stages=(), granularity='block', stage_types=CHECKPOINT_STAGES):
+    """Recomputes the activations of the selected stages (indices into ``checkpoint_stages``, -1 for all) in
+    backward instead of storing them, with non-reentrant ``torch.utils.checkpoint``.
 
-            s_w_cut[..., int(shave / 2 * scale):(h - h_cut) * scale - int(shave / 2 * scale), :] = s_w_cut_inter
-            y_w_cut.append(s_w_cut)
+    ``granularity='block'`` checkpoints every block of the stage's first nn.ModuleList (the attention maps of one
+    block are alive at a time, block inputs are kept), ``'stage'`` the stage as a whole (only its input is kept,
+    the backward of the stage then holds all of its activations again). Stages without a ModuleList (Bidi) are
+    always checkpointed whole. The non-reentrant variant restores the autocast state and RNG (dropout,
+    DropPath) of the forward, works with inputs that do not require grad and with DDP's
+    find_unused_parameters. Under no_grad the plain forward runs. Empty ``stages`` restores the plain forwards.
+    """
+    for m in model.modules():
+        if 'forward' in m.__dict__ and isinstance(m.__dict__['forward'], partial) and \
+                m.__dict__['forward'].func is _checkpointed_forward:
+            del m.forward
+    all_stages = checkpoint_stages(model, stage_types)
+    selected = all_stages if -1 in stages else [all_stages[i] for i in stages]
+    for stage in selected:
+        blocks = next((c for c in stage.modules() if isinstance(c, nn.ModuleList)), None)
+        for m in (blocks if granularity == 'block' and blocks is not None else [stage]):
+            m.forward = partial(_checkpointed_forward, m.forward)
+    return selected
+
+
+def _no_split(x, _, dim):
+    return [x]
+
+
+class PatchMergeModule(nn.Module):
 
-        return y_w_cut
+    def __init__(self, bs_axis_merge=False):
+        super().__init__()
+        # module level function rather than a lambda, so whole models can be pickled (int8 checkpoints)
+        if bs_axis_merge:
+            self.split_func = torch.split
+        else:
+            self.split_func = _no_split
 
+    def forward_chop(self, *x, **kwargs):
+        """Full-image inference in overlapping tiles of ``args.tile_size`` (default ``args.patch_size``).
 
+        An ``args.tile_overlap`` that is not smaller than the tile (the --tile-overlap default of 16 with a 16 px
+        training patch) falls back to a quarter of the tile.
+        """
+        args = self.args
+        tile_size = getattr(args, 'tile_size', 0) or args.patch_size
+        overlap = getattr(args, 'tile_overlap', tile_size // 4)
+        if overlap >= tile_size:
+            overlap = tile_size // 4
+        return tiled_inference(partial(type(self).forward, self), *x, tile_size=tile_size, overlap=overlap,
+                               window=getattr(args, 'tile_window', 'gaussian'),
+                               tiles_per_batch=args.crop_batch_size,
+                               memory_budget=getattr(args, 'tile_budget_mb', 0) * 2 ** 20, **kwargs)
 
 
 class PrimalConvBlock(nn.Module):
@@ -535,7 +644,7 @@ class HirePatch(nn.Module):
                 elif axis == 3:
                     x = x.unfold(axis, half, half // 2).transpose(3, 2)
                 x = x.reshape(self.bs * factor * p, c, x.shape[-2], x.shape[-1])
-            x = x.view(self.bs, c, -1, *shape).permute(0, 2, 3, 4, 1)
+            x = x.reshape(self.bs, c, -1, *shape).permute(0, 2, 3, 4, 1)
         else:
             # x = self.patch_merge(x).view(self.bs, c, -1, new_h, new_w).permute(0, 2, 3, 4, 1)
             x = x.unfold(axes[0], new_h, new_h // 2).unfold(axes[1], new_w, new_w // 2). \
@@ -619,7 +728,7 @@ class MHSPatch(nn.Module):
                     elif axis == 3:
                         x = x.unfold(axis, ps, ps // 2).transpose(3, 2)
                     x = x.reshape(bs * factor * p, c, x.shape[-2], x.shape[-1])
-                x = x.view(bs, -1, N).permute(0, 2, 1)  # .permute(0, 2, 3, 1)
+                x = x.reshape(bs, -1, N).permute(0, 2, 1)  # .permute(0, 2, 3, 1)
             else:
                 x = x.unfold(axes[0], new_h, new_h // 2).unfold(axes[1], new_w, new_w // 2). \
                     reshape(b, -1, N).permute(0, 2, 1)  # .permute(0, 2, 3, 1)
@@ -680,7 +789,7 @@ class HireSharePatch(nn.Module):
                 elif axis == 3:
                     x = x.unfold(axis, half, half // stride_ratio).transpose(3, 2)
                 x = x.reshape(bs * factor * p, c, x.shape[-2], x.shape[-1])
-            x = x.view(bs, c, -1, *shape).permute(0, 2, 3, 4, 1)
+            x = x.reshape(bs, c, -1, *shape).permute(0, 2, 3, 4, 1)
         else:
             # x = self.patch_merge(x).view(self.bs, c, -1, new_h, new_w).permute(0, 2, 3, 4, 1)
             x = x.unfold(axes[0], new_h, new_h // stride_ratio).unfold(axes[1], new_w, new_w // stride_ratio). \
@@ -785,4 +894,161 @@ class OutConv(nn.Module):
         self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1)
 
     def forward(self, x):
-        return self.conv(x)
\ No newline at end of file
+        return self.conv(x)
+
+@lru_cache(maxsize=64)
+def shifted_window_mask(H, W, window_size, shift_size, device):
+    """SW-MSA attention mask [nW, ws*ws, ws*ws] of an (H, W) feature map, built once per size and device."""
+    img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
+    slices = (slice(0, -window_size), slice(-window_size, -shift_size), slice(-shift_size, None))
+    cnt = 0
+    for h in slices:
+        for w in slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+    mask_windows = img_mask.view(1, H // window_size, window_size, W // window_size, window_size, 1)
+    mask_windows = mask_windows.permute(0, 1, 3, 2, 4, 5).reshape(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask.to(device)
+
+
+def get_relative_position_bias(attn):
+    """``attn.relative_position_bias_table`` gathered by ``attn.relative_position_index`` to [nH, Wh*Ww, Wh*Ww].
+
+    Without grad the gathered tensor is kept on the module and reused until the table changes: the key holds
+    the table's version counter, which optimizer steps and load_state_dict bump. Writes through ``.data``
+    (EMA, fp16 master weights) keep the counter, attention modules mix in RelativePositionBiasCache so
+    train()/eval() and load_state_dict drop the cached bias as well; clear_relative_position_bias drops it
+    anywhere else.
+    """
+    table = attn.relative_position_bias_table
+    key = (table._version, table.data_ptr(), table.device)
+    cached = attn.__dict__.get('_relative_position_bias')
+    if not torch.is_grad_enabled() and cached is not None and cached[0] == key:
+        return cached[1]
+    N = attn.window_size[0] * attn.window_size[1]
+    bias = table[attn.relative_position_index.view(-1)].view(N, N, -1).permute(2, 0, 1).contiguous()
+    if not torch.is_grad_enabled():
+        attn.__dict__['_relative_position_bias'] = (key, bias)
+    return bias
+
+
+def clear_relative_position_bias(model):
+    """Drops the biases get_relative_position_bias cached on the modules of ``model``."""
+    for m in model.modules():
+        m.__dict__.pop('_relative_position_bias', None)
+
+
+class RelativePositionBiasCache():
+    """Mixin for attention modules using get_relative_position_bias: switching train/eval mode and
+    load_state_dict drop the cached bias."""
+
+    def train(self, mode=True):
+        self.__dict__.pop('_relative_position_bias', None)
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.__dict__.pop('_relative_position_bias', None)
+        return super()._load_from_state_dict(*args, **kwargs)
+
+
+
+def _weight_shape(*shape):
+    """Shape of a per-sample conv weight. ONNX Conv needs the weight shape to be known, so while exporting
+    the traced sizes are frozen to constants (the exported batch size is static)."""
+    if torch.onnx.is_in_onnx_export():
+        return tuple(int(s) for s in shape)
+    return shape
+
+
+def kernel_bank_conv2d(x, kernels, weight=None, bias=None, stride=1, padding=0):
+    """Convolves every sample of x [B, C, H, W] with its own bank of kernels [B, n*C, C, k, k].
+
+    One conv with groups=B runs all n kernels of a sample against a single copy of x instead of repeating
+    x n times. ``weight``/``bias`` of a following 1x1 projection ([C_out, n*C(, 1, 1)]) are folded into the
+    bank first, so the output is [B, C_out, H', W'] and its memory does not grow with n.
+    """
+    B, C, H, W = x.shape
+    k = kernels.shape[-2:]
+    kernels = kernels.reshape(B, -1, C, *k)
+    if weight is not None:
+        kernels = torch.einsum('om,bmcuv->bocuv', weight.reshape(weight.shape[0], -1), kernels)
+    kernels = kernels.reshape(_weight_shape(B * kernels.shape[1], C, *k))
+    x = F.conv2d(x.reshape(1, B * C, H, W), kernels, stride=stride, padding=padding, groups=B)
+    x = x.view(B, -1, *x.shape[-2:])
+    if bias is not None:
+        x = x + bias.view(1, -1, 1, 1)
+    return x
+
+
+def dynamic_depthwise_conv2d(x, kernels, stride=1, padding=0, reduce=None):
+    """Depthwise convolution of every sample of x [B, C, H, W] with its own n kernels [B, n, C, k, k].
+
+    Batch and channels are folded into the groups of one conv whose channel multiplier is n, so x is read
+    once rather than repeated per kernel. Returns [B, n, C, H', W'], or with ``reduce='sum'`` the sum over
+    the n responses [B, C, H', W'], computed as one conv with the summed kernels.
+    """
+    B, C, H, W = x.shape
+    k = kernels.shape[-2:]
+    kernels = kernels.reshape(B, -1, C, *k)
+    x = x.reshape(1, B * C, H, W)
+    if reduce == 'sum':
+        x = F.conv2d(x, kernels.sum(1).reshape(_weight_shape(B * C, 1, *k)), stride=stride, padding=padding,
+                     groups=B * C)
+        return x.view(B, C, *x.shape[-2:])
+    n = kernels.shape[1]
+    x = F.conv2d(x, kernels.transpose(1, 2).reshape(_weight_shape(B * C * n, 1, *k)), stride=stride,
+                 padding=padding, groups=B * C)
+    return x.view(B, C, n, *x.shape[-2:]).transpose(1, 2)
+
+# F.scaled_dot_product_attention for window attention, False falls back to the reference math
+FUSED_ATTENTION = hasattr(F, 'scaled_dot_product_attention')
+
+
+def _torch_at_least(version):
+    # compares release numbers ('10.0' < '2.1' as strings), local tags like +cu121 are dropped
+    return Version(torch.__version__.split('+')[0]) >= Version(version)
+
+
+# the scale= argument of scaled_dot_product_attention exists from torch 2.1 on
+_SDPA_SCALE = FUSED_ATTENTION and _torch_at_least('2.1')
+
+
+def window_attention(q, k, v, scale, bias=None, mask=None, dropout_p=0., fused=None):
+    """softmax(q @ k^T * scale + bias + mask) @ v for per-window q, k, v [B_, nH, N, d] with B_ = B * nW.
+
+    bias is the [nH, N, N] relative position bias, mask the [nW, N, N] shift mask. The fused path folds both
+    into one additive mask and lets scaled_dot_product_attention pick a flash / memory-efficient kernel where
+    the inputs allow it; the reference path materializes the scores and keeps the softmax in fp32.
+    """
+    if fused is None:
+        fused = FUSED_ATTENTION
+    B_, nH, N, d = q.shape
+    nW = 1 if mask is None else mask.shape[0]
+    if fused:
+        attn_mask = None if bias is None else bias.unsqueeze(0)
+        if mask is not None:
+            attn_mask = mask.unsqueeze(1) if attn_mask is None else attn_mask + mask.unsqueeze(1)
+        if attn_mask is not None:
+            # the windows of an image are folded into the head dim so that all images share one mask
+            attn_mask = attn_mask.expand(nW, nH, N, N).reshape(nW * nH, N, N).to(q.dtype)
+        if _SDPA_SCALE:
+            kwargs = {'scale': scale}
+        else:
+            # torch 2.0 always scales by d ** -0.5
+            q, kwargs = q * (scale * math.sqrt(d)), {}
+        x = F.scaled_dot_product_attention(q.reshape(B_ // nW, nW * nH, N, d), k.reshape(B_ // nW, nW * nH, N, d),
+                                           v.reshape(B_ // nW, nW * nH, N, d), attn_mask=attn_mask,
+                                           dropout_p=dropout_p, **kwargs)
+        return x.view(B_, nH, N, d)
+    attn = (q * scale) @ k.transpose(-2, -1)
+    if bias is not None:
+        attn = attn + bias.unsqueeze(0)
+    if mask is not None:
+        attn = attn.view(B_ // nW, nW, nH, N, N) + mask.unsqueeze(1).unsqueeze(0)
+        attn = attn.view(-1, nH, N, N)
+    # softmax is kept in fp32 under bf16/fp16 autocast
+    attn = F.softmax(attn.float(), dim=-1).type_as(v)
+    attn = F.dropout(attn, dropout_p, training=dropout_p > 0)
+    return attn @ v
@@ -3,6 +3,7 @@ import platform
 import warnings
 import os
 from UDL.Basis.config import Config
+from UDL.Basis.module import FP32_MODULES
 
 def common_cfg():
 
@@ -36,11 +37,68 @@ def common_cfg():
                         help="False is apex, besides True is  torch1.6+, which has supports amp ops to reduce gpu memory and speed up training")
     parser.add_argument('--amp-opt-level', type=str, default='O1', choices=['O0', 'O1', 'O2'],
                         help='mixed precision opt level, if O0, no amp is used')
+    parser.add_argument('--amp-dtype', type=str, default='fp16', choices=['fp16', 'bf16'],
+                        help='autocast dtype of torch.amp (--amp True), bf16 runs on cpu and cuda without loss scaling')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='keep conv weights and the 4D tensors of every batch in channels_last (NHWC) memory format')
+    parser.add_argument('--eval-precision', default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='run eval_step under torch.autocast with this dtype, outputs are cast back to fp32')
+    parser.add_argument('--eval-fp32-modules', nargs='*', default=list(FP32_MODULES), type=str,
+                        help='class names of modules kept in fp32 with --eval-precision fp16/bf16')
+    parser.add_argument('--eval-precision-check', action='store_true',
+                        help='also run every eval batch in fp32 and report metric deltas, max. error and speedup')
+
+    # * Vectorized multi-model training
+    parser.add_argument('--num-models', default=1, type=int,
+                        help='train N copies of the model in one process with torch.func.vmap (seed-variance studies)')
+    parser.add_argument('--ensemble-seeds', nargs='*', default=None, type=int,
+                        help='one seed per copy, default seed, seed+1, ...')
+    parser.add_argument('--ensemble-lrs', nargs='*', default=None, type=float,
+                        help='one learning rate per copy, default the builder lr')
 
     # * Training
     parser.add_argument('--accumulated-step', default=1, type=int)
     parser.add_argument('--clip_max_norm', default=0, type=float,
                         help='gradient clipping max norm')
+    parser.add_argument('--save-every-iters', default=0, type=int,
+                        help='write <model_save_dir>/resume_state.pth.tar every N iterations (0: off), '
+                             'pass it to --resume to continue the interrupted epoch exactly')
+    parser.add_argument('--checkpoint-stages', nargs='*', default=[], type=int,
+                        help='recompute the activations of these window-attention stages (BasicLayer / RSTB / '
+                             'PSRT_Block / Stage, in model order) in backward instead of storing them, -1: all stages')
+    parser.add_argument('--checkpoint-granularity', default='block', choices=['block', 'stage'],
+                        help='checkpoint every block of a stage or each stage as a whole')
+
+    # * Tiled inference
+    parser.add_argument('--tile-size', default=0, type=int,
+                        help='evaluate full scenes in overlapping tiles of this size (0: whole image at once)')
+    parser.add_argument('--tile-overlap', default=16, type=int)
+    parser.add_argument('--tile-window', default='gaussian', choices=['gaussian', 'cosine', 'uniform'],
+                        help='blending window of overlapping tiles')
+    parser.add_argument('--tile-budget-mb', default=0, type=int,
+                        help='size tile batches to this much cuda memory, 0 uses --crop_batch_size tiles')
+    parser.add_argument('--band-chunk', default=0, type=int,
+                        help='run conv + non-inplace activation blocks with at least as many outputs as bands this many '
+                             'bands at a time, a no-op for models without such blocks')
+    parser.add_argument('--eval-memory-mb', default=0, type=int,
+                        help='plan tile size, tiles per batch and band chunk per scene shape to fit this much '
+                             'memory (cpu or cuda), 0: off')
+
+    parser.add_argument('--eval-batch-size', default=1, type=int,
+                        help='batch up to N test images of the same shape')
+    parser.add_argument('--eval-budget-mb', default=0, type=int,
+                        help='also cap an eval batch at this many MB of (fp32) input, 0: no cap')
+    parser.add_argument('--eval-workers', default=0, type=int,
+                        help='dataloader workers prefetching test images')
+    parser.add_argument('--eval-pipeline', action='store_true',
+                        help='overlap test image loading / device copies, eval_step and metric scoring in threads')
+    parser.add_argument('--eval-rank-outputs', action='store_true',
+                        help='distributed eval: every rank keeps its own outputs in <result>_rank<r> instead of '
+                             'rank 0 merging the rank shards into one file (needs a directory all ranks see)')
+    parser.add_argument('--result-format', default='mat', choices=['mat', 'mat73', 'h5', 'npy'],
+                        help='eval outputs are saved as a MAT v5 file (kept in memory until the end, as '
+                             'sio.savemat did), or streamed to a MAT v7.3 file (read with h5py), a chunked HDF5 '
+                             'file or a npy memmap')
 
     # * extra
     parser.add_argument('--seed', default=10, type=int,
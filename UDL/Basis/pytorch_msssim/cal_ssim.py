@@ -48,14 +48,12 @@ class SSIM(torch.nn.Module):
         #print(img1.size())
         (_, channel, _, _) = img1.size()
 
-        if channel == self.channel and self.window.data.type() == img1.data.type():
+        # dtype/device check without .data, which is not allowed under torch.func transforms
+        if channel == self.channel and self.window.dtype == img1.dtype and self.window.device == img1.device:
             window = self.window
         else:
             window = create_window(self.window_size, channel)
-            
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
+            window = window.to(device=img1.device, dtype=img1.dtype)
             
             self.window = window
             self.channel = channel
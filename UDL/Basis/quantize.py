@@ -0,0 +1,266 @@
+"""
+Post-training int8 quantization of the builders found by UDL.Basis.benchmark, for cpu inference.
+
+    dynamic: int8 weights for every nn.Linear (window-attention qkv/proj and MLPs), activations are quantized
+             on the fly, no calibration
+    static:  FX graph mode quantization of the forward (convs, relus, adds, cats), the observers are calibrated
+             on --calib-batches batches of the task's Session training loader. Meant for conv stacks
+             (PNN, PanNet, FusionNet), the window transformers are not symbolically traceable.
+
+Float and int8 models are scored (SAM/ERGAS/PSNR) on --eval-batches batches of the Session eval loader and
+their forwards are timed on cpu. The int8 model is saved whole into <out>/<name>_<mode>.pth.tar, which
+eval_framework loads through --resume like any checkpoint (cpu only, run the eval with --device cpu).
+
+usage:
+    python -m UDL.Basis.quantize --filter "^SWATv4$" --mode dynamic --dataset cave_x4 \
+        --checkpoint results/hisr/SWATv4/model_best.pth.tar --out results/int8
+    python -m UDL.Basis.quantize --filter "PNN|PanNet|FusionNet" --mode static --dataset wv3 --calib-batches 8
+    # smoke run without data
+    python -m UDL.Basis.quantize --filter "PSRT_KAv22_noshuffle" --mode dynamic --dataset synthetic \
+        --override samples_per_gpu=2 eval_batch_size=1
+"""
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import os
+import re
+import sys
+import traceback
+import types
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from UDL.Basis.benchmark import SEARCH_ROOTS, REPO_ROOT, find_builders, load_args, capture_inputs, _timeit, \
+    write_table
+from UDL.Basis.export import load_weights
+from UDL.pansharpening.common.evaluate import analysis_accu
+
+FIELDS = ['name', 'task', 'mode', 'dataset', 'images', 'float_PSNR', 'int8_PSNR', 'dPSNR', 'float_SAM', 'int8_SAM',
+          'dSAM', 'float_ERGAS', 'int8_ERGAS', 'dERGAS', 'float(ms)', 'int8(ms)', 'speedup', 'size(MB)', 'int8_size(MB)',
+          'checkpoint', 'status']
+METRICS = ['PSNR', 'SAM', 'ERGAS']
+
+
+class QuantizedModel(nn.Module):
+    """Runs a quantized forward graph in place of a model wrapper's forward.
+
+    The wrapper's methods (eval_step, forward_chop, ...) are looked up on its class and run on this module, so
+    ``self(...)`` inside them reaches the int8 graph. Quantized kernels are cpu only: the inputs are moved to
+    the cpu and the output back to the device eval_step put the data on.
+    """
+
+    def __init__(self, model, graph, mode):
+        super(QuantizedModel, self).__init__()
+        self.graph = graph
+        self.mode = mode
+        self.wrapper_cls = type(model)
+        self.__dict__.update({k: v for k, v in vars(model).items() if not k.startswith('_') and k != 'training'})
+        if isinstance(getattr(model, 'criterion', None), nn.Module):
+            self.criterion = model.criterion
+
+    def forward(self, *inputs):
+        device = inputs[0].device
+        out = self.graph(*[x.cpu() if isinstance(x, torch.Tensor) else x for x in inputs])
+        return out.to(device) if isinstance(out, torch.Tensor) else out
+
+    def __getstate__(self):
+        # converted FX graphs do not unpickle, the scripted graph is stored through torch.jit.save instead
+        state = self.__dict__.copy()
+        state['_modules'] = dict(state['_modules'])
+        if isinstance(state['_modules'].get('graph'), torch.jit.ScriptModule):
+            f = io.BytesIO()
+            torch.jit.save(state['_modules'].pop('graph'), f)
+            state['scripted_graph'] = f.getvalue()
+        return state
+
+    def __setstate__(self, state):
+        scripted = state.pop('scripted_graph', None)
+        super(QuantizedModel, self).__setstate__(state)
+        if scripted is not None:
+            self._modules['graph'] = torch.jit.load(io.BytesIO(scripted), map_location='cpu')
+
+    def __getattr__(self, name):
+        try:
+            return super(QuantizedModel, self).__getattr__(name)
+        except AttributeError:
+            func = getattr(self.__dict__.get('wrapper_cls'), name, None)
+            if isinstance(func, types.FunctionType):
+                return types.MethodType(func, self)
+            # class attributes set by the builder (PNN.set_blk)
+            if func is None or callable(func):
+                raise
+            return func
+
+
+def quantize_model(model, mode, calib_batches=(), backend='x86', example_inputs=None):
+    """int8 copy of ``model`` (left untouched) wrapped in a QuantizedModel."""
+    torch.backends.quantized.engine = backend
+    float_model = copy.deepcopy(model).cpu().eval()
+    if mode == 'dynamic':
+        # the whole wrapper is the graph, its forward is unchanged apart from the swapped Linear layers
+        return QuantizedModel(model, quantize_dynamic(float_model, {nn.Linear}, dtype=torch.qint8), mode)
+    example_inputs = tuple(x.cpu() for x in example_inputs)
+    prepared = QuantizedModel(model, prepare_fx(float_model, get_default_qconfig_mapping(backend), example_inputs),
+                              mode)
+    with torch.no_grad():
+        for batch in calib_batches:
+            prepared.eval_step(batch)
+    return QuantizedModel(model, torch.jit.script(convert_fx(prepared.graph)), mode)
+
+
+def _model_size_mb(model):
+    f = io.BytesIO()
+    torch.save(model.state_dict(), f)
+    return round(f.tell() / 2 ** 20, 2)
+
+
+def score(model, batches):
+    """Mean SAM/ERGAS/PSNR of eval_step against batch['gt'], per image as in eval_framework."""
+    metrics = {k: [] for k in METRICS}
+    with torch.no_grad():
+        for batch in batches:
+            sr = model.eval_step(batch)[0]
+            gt = batch['gt'].to(sr.device)
+            for i in range(sr.shape[0]):
+                m = analysis_accu(gt[i].permute(1, 2, 0), sr[i].permute(1, 2, 0).to(gt.dtype), 4)
+                for k in METRICS:
+                    metrics[k].append(float(m[k]))
+    return {k: sum(v) / max(len(v), 1) for k, v in metrics.items()}
+
+
+def _session(task, args):
+    if task == 'hisr':
+        from UDL.hisr.common.hisr_dataset import HISRSession
+        return HISRSession(args)
+    if task == 'pansharpening':
+        from UDL.pansharpening.common.psdata import PansharpeningSession
+        return PansharpeningSession(args)
+    raise NotImplementedError(f"no Session for task {task}")
+
+
+def _take(loader, n):
+    batches = []
+    for batch in loader:
+        if len(batches) >= n:
+            break
+        batches.append(batch)
+    return batches
+
+
+def quantize_entry(entry, cfg):
+    row = {'name': entry['name'], 'task': entry['task'], 'mode': cfg.mode}
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, cfg.device)
+        for k, v in cfg.override.items():
+            setattr(args, k, v)
+        if cfg.dataset:
+            args.dataset = cfg.dataset
+        args.distributed = False
+        torch.manual_seed(0)
+        model = getattr(importlib.import_module(entry['module']), entry['builder'])(args)[0].to(cfg.device)
+    if cfg.checkpoint:
+        load_weights(model, cfg.checkpoint)
+    model.eval()
+    row['dataset'] = args.dataset
+    sess = _session(entry['task'], args)
+    eval_batches = _take(sess.get_eval_dataloader(args.dataset, False)[0], cfg.eval_batches)
+    row['images'] = sum(b['gt'].shape[0] for b in eval_batches)
+
+    with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+        inputs = capture_inputs(model, eval_batches[0], step='eval_step')
+    calib_batches = _take(sess.get_dataloader(args.dataset, False)[0], cfg.calib_batches) \
+        if cfg.mode == 'static' else []
+    with contextlib.redirect_stdout(io.StringIO()):
+        qmodel = quantize_model(model, cfg.mode, calib_batches, cfg.backend, inputs)
+        float_metrics, int8_metrics = score(model, eval_batches), score(qmodel, eval_batches)
+    for k in METRICS:
+        row[f'float_{k}'] = round(float_metrics[k], 4)
+        row[f'int8_{k}'] = round(int8_metrics[k], 4)
+        row[f'd{k}'] = round(int8_metrics[k] - float_metrics[k], 4)
+
+    # both forwards on the cpu with the same inputs, which is where the int8 model runs
+    inputs = tuple(x.cpu() for x in inputs)
+    float_model = copy.deepcopy(model).cpu()
+    with torch.no_grad():
+        row['float(ms)'] = round(_timeit(lambda: float_model(*inputs), cfg.warmup, cfg.repeat, 'cpu'), 2)
+        row['int8(ms)'] = round(_timeit(lambda: qmodel(*inputs), cfg.warmup, cfg.repeat, 'cpu'), 2)
+    row['speedup'] = round(row['float(ms)'] / row['int8(ms)'], 2)
+    row['size(MB)'], row['int8_size(MB)'] = _model_size_mb(float_model), _model_size_mb(qmodel.graph)
+
+    os.makedirs(cfg.out, exist_ok=True)
+    path = os.path.join(cfg.out, re.sub(r'[^\w.-]+', '_', entry['name']) + f"_{cfg.mode}.pth.tar")
+    source = torch.load(cfg.checkpoint, map_location='cpu', weights_only=False) if cfg.checkpoint else {}
+    torch.save({
+        'epoch': source.get('epoch', 0) if isinstance(source, dict) else 0,
+        'arch': getattr(args, 'arch', entry['name']),
+        'quantization': cfg.mode,
+        'model': qmodel,
+        'state_dict': qmodel.state_dict(),
+        'best_metric': int8_metrics['PSNR'],
+    }, path)
+    row['checkpoint'] = path
+    row['status'] = 'ok'
+    return row
+
+
+def _parse_value(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+
+def quantize_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='post-training int8 quantization with accuracy and cpu speed report')
+    parser.add_argument('--task', default=None, choices=list(SEARCH_ROOTS.keys()))
+    parser.add_argument('--filter', required=True, type=str, help='regex on the builder name or module')
+    parser.add_argument('--mode', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument('--checkpoint', default='', type=str, help='float weights, random init if empty')
+    parser.add_argument('--dataset', default='', type=str, help='Session dataset, the option module default if empty')
+    parser.add_argument('--override', default=[], nargs='*', help='option overrides key=value (json values)')
+    parser.add_argument('--calib-batches', default=8, type=int, help='training batches that calibrate static mode')
+    parser.add_argument('--eval-batches', default=4, type=int, help='eval batches the metrics are computed on')
+    parser.add_argument('--backend', default='x86' if 'x86' in torch.backends.quantized.supported_engines
+                        else torch.backends.quantized.supported_engines[-1],
+                        choices=torch.backends.quantized.supported_engines)
+    parser.add_argument('--device', default='cpu', type=str, help='device of the float model and its eval_step')
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--out', default='quantized', type=str, help='directory of the int8 checkpoints and the table')
+    parser.add_argument('--verbose', action='store_true', help='print tracebacks of failed models')
+    cfg = parser.parse_args(argv)
+    cfg.override = {k: _parse_value(v) for k, v in (kv.split('=', 1) for kv in cfg.override)}
+    return cfg
+
+
+def main(argv=None):
+    cfg = quantize_cfg(argv)
+    torch.set_num_threads(cfg.threads)
+    entries = find_builders({cfg.task: SEARCH_ROOTS[cfg.task]} if cfg.task else SEARCH_ROOTS)
+    entries = [e for e in entries if re.search(cfg.filter, e['name']) or re.search(cfg.filter, e['module'])]
+    rows = []
+    for i, entry in enumerate(entries):
+        try:
+            row = quantize_entry(entry, cfg)
+        except Exception as e:
+            row = {'name': entry['name'], 'task': entry['task'], 'mode': cfg.mode,
+                   'status': f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}"}
+            if cfg.verbose:
+                traceback.print_exc()
+        print(f"[{i + 1}/{len(entries)}] {row['name']}: {row['status']}")
+        rows.append(row)
+    write_table(rows, os.path.join(cfg.out, f"quantize_{cfg.mode}"), FIELDS)
+    return rows
+
+
+if __name__ == '__main__':
+    # run from the imported module so the saved int8 models pickle as UDL.Basis.quantize.QuantizedModel,
+    # not __main__.QuantizedModel, which only loads inside this script
+    from UDL.Basis.quantize import main
+    main()
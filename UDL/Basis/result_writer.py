@@ -0,0 +1,317 @@
+"""
+Incremental writer for evaluation outputs. Predictions are copied to the host and written to disk by a
+background thread as they are produced, so with the streaming formats the test set never has to fit in RAM
+and a killed run keeps everything written so far.
+"""
+import datetime
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+import h5py
+import scipy.io as sio
+from logging import info as log_string
+from UDL.pansharpening.common.evaluate import analysis_accu
+
+# file extension of every --result-format
+RESULT_EXTENSIONS = {'mat': '.mat', 'mat73': '.mat', 'h5': '.h5', 'npy': '.npy'}
+
+
+class ResultWriter():
+    """Writes per-image predictions [C, H, W] into one array ``key`` of shape [N, H, W, C].
+
+    fmt:
+        'mat':   MAT v5 file written by ``sio.savemat`` on close, as before; the outputs are kept in host
+                 memory until then and ``sio.loadmat`` (plt_mat.py) reads the file
+        'mat73': MAT v7.3 file (HDF5 with a MATLAB header) streamed to disk, ``load(path)`` in MATLAB gives
+                 the same N x H x W x C ``output``, in python it needs h5py (``sio.loadmat`` can not read it)
+        'h5':    chunked HDF5 dataset, one chunk per image
+        'npy':   numpy memmap, needs ``num``
+    The array is created from the shape/dtype of the first image. With ``num=None`` (mat/mat73/h5) it grows
+    as images arrive.
+    """
+
+    def __init__(self, path, fmt='mat', num=None, key='output', queue_size=4):
+        if fmt not in RESULT_EXTENSIONS:
+            raise ValueError(f"unknown result format: {fmt}")
+        if fmt == 'npy' and num is None:
+            raise ValueError("the npy memmap needs the number of images")
+        self.path = path
+        self.fmt = fmt
+        self.num = num
+        self.key = key
+        self.file = None
+        self.data = None
+        self.count = 0
+        self.size = 0
+        self.error = None
+        self.copy_stream = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put(self, index, output):
+        """Queues ``output`` ([C, H, W] or a batch [B, C, H, W] for images index, index+1, ...)."""
+        if self.error is not None:
+            raise self.error
+        output = output.detach()
+        event = None
+        if output.is_cuda:
+            # copy on a side stream into pinned memory, the worker waits for the event before writing
+            if self.copy_stream is None:
+                self.copy_stream = torch.cuda.Stream(output.device)
+            self.copy_stream.wait_stream(torch.cuda.current_stream(output.device))
+            with torch.cuda.stream(self.copy_stream):
+                host = torch.empty(output.shape, dtype=output.dtype, pin_memory=True)
+                host.copy_(output, non_blocking=True)
+                output.record_stream(self.copy_stream)
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+            output = host
+        self.queue.put((index, output, event))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            if self.fmt == 'npy':
+                self.data.flush()
+            elif self.fmt == 'mat':
+                sio.savemat(self.path, {self.key: self.data[:max(self.num or 0, self.size)]})
+            else:
+                self.file.close()
+                if self.fmt == 'mat73':
+                    self._write_mat_header()
+            self.file = None
+        if self.error is not None:
+            raise self.error
+        log_string(f"=> {self.count} results written to {self.path}")
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            index, output, event = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                output = output.cpu().numpy()
+                if output.ndim == 3:
+                    output = output[None]
+                for i, image in enumerate(output):
+                    self._write(index + i, image.transpose(1, 2, 0))
+            except Exception as e:
+                self.error = e
+
+    def _create(self, image):
+        h, w, c = image.shape
+        num = self.num or 1
+        maxnum = self.num
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.fmt == 'npy':
+            self.file = self.data = np.lib.format.open_memmap(self.path, mode='w+', dtype=image.dtype,
+                                                              shape=(num, h, w, c))
+        elif self.fmt == 'mat':
+            # nothing is opened, sio.savemat writes the whole file on close
+            self.file = self.path
+            self.data = np.zeros((num, h, w, c), dtype=image.dtype)
+        elif self.fmt == 'h5':
+            self.file = h5py.File(self.path, 'w')
+            self.data = self.file.create_dataset(self.key, shape=(num, h, w, c), maxshape=(maxnum, h, w, c),
+                                                 chunks=(1, h, w, c), dtype=image.dtype)
+        else:
+            # MATLAB is column-major: an N x H x W x C variable is stored as C x W x H x N
+            self.file = h5py.File(self.path, 'w', userblock_size=512)
+            self.data = self.file.create_dataset(self.key, shape=(c, w, h, num), maxshape=(c, w, h, maxnum),
+                                                 chunks=(c, w, h, 1), dtype=image.dtype)
+            self.data.attrs['MATLAB_class'] = np.bytes_('single' if image.dtype == np.float32 else 'double')
+        self.shape = image.shape
+
+    def _write(self, index, image):
+        if self.file is None:
+            self._create(image)
+        if image.shape != self.shape:
+            raise ValueError(f"result {index} has shape {image.shape}, expected {self.shape}")
+        if self.fmt == 'mat':
+            if index >= self.data.shape[0]:
+                # grows by doubling, close() keeps the first max(num, last index + 1) images
+                grown = np.zeros((max(index + 1, 2 * self.data.shape[0]),) + self.shape, self.data.dtype)
+                grown[:self.data.shape[0]] = self.data
+                self.data = grown
+            self.data[index] = image
+            self.size = max(self.size, index + 1)
+        elif self.fmt == 'mat73':
+            if index >= self.data.shape[-1]:
+                self.data.resize(index + 1, axis=3)
+            self.data[..., index] = image.transpose(2, 1, 0)
+        else:
+            if index >= self.data.shape[0]:
+                self.data.resize(index + 1, axis=0)
+            self.data[index] = image
+        self.count += 1
+
+    def _write_mat_header(self):
+        # the 128 byte MAT-file header inside the HDF5 user block marks the file as v7.3
+        text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} HDF5 schema 1.00 .'.format(
+            datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y'))
+        header = text.ljust(116).encode() + b' ' * 8 + b'\x00\x02' + b'IM'
+        with open(self.path, 'r+b') as f:
+            f.write(header)
+
+
+def eval_metrics_per_image(batch, sr, metrics, gt_key='gt'):
+    """The metrics of every image of an eval batch, as the floats MetricLogger.update_dict logs.
+
+    eval_step only scores the first image (``analysis_accu(gt[0], sr[0])``), so batches of several images
+    are re-scored per image, which keeps the averages identical to batch_size=1.
+    """
+    if sr.shape[0] == 1:
+        scores = [metrics]
+    else:
+        gt = batch[gt_key].to(sr.device)
+        with torch.no_grad():
+            scores = [analysis_accu(gt[i].permute(1, 2, 0), sr[i].permute(1, 2, 0), 4) for i in range(sr.shape[0])]
+    return [{k: torch.mean(v).item() if isinstance(v, torch.Tensor) else v for k, v in m.items()} for m in scores]
+
+
+def update_eval_metrics(metric_logger, batch, sr, metrics, gt_key='gt'):
+    """Logs the metrics of every image of an eval batch (see eval_metrics_per_image)."""
+    for m in eval_metrics_per_image(batch, sr, metrics, gt_key):
+        metric_logger.update_dict(m)
+
+
+class DistributedResults():
+    """Per-image metrics and outputs of a distributed eval, merged in dataset order when closed.
+
+    Every rank evaluates its share of the test set and streams its outputs to disk, only the metrics and the
+    positions of the outputs are gathered. The metrics of all ranks are gathered to every rank (``stats`` is
+    the same everywhere), images a padding sampler evaluated twice count once. With ``gather_outputs`` every
+    rank writes a ``<path>_rank<r>.part.h5`` shard that rank 0 copies into ``path`` in dataset order and then
+    removes (the shards have to be visible to rank 0, like the checkpoints); otherwise every rank keeps its own
+    ``<path>_rank<r>.<fmt>``.
+    """
+
+    def __init__(self, path, fmt='mat', num=None, gather_outputs=True, rank=0):
+        self.path, self.fmt, self.num = path, fmt, num
+        self.gather_outputs = gather_outputs
+        self.rank = rank
+        self.metrics = []
+        self.positions = []
+        self.stats = None
+        root, ext = os.path.splitext(path)
+        if gather_outputs:
+            # outputs in the order this rank produced them, ``positions`` maps them to dataset indices
+            self.writer = ResultWriter(self._shard(rank), 'h5')
+        else:
+            self.writer = ResultWriter(f"{root}_rank{rank}{ext}", fmt, num=num)
+
+    def _shard(self, rank):
+        return f"{os.path.splitext(self.path)[0]}_rank{rank}.part.h5"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
+
+    def put(self, index, output):
+        """Writes ``output`` ([C, H, W] or a batch [B, C, H, W] for images index, index+1, ...)."""
+        if not self.gather_outputs:
+            self.writer.put(index, output)
+            return
+        n = output.shape[0] if output.dim() == 4 else 1
+        start = len(self.positions)
+        self.writer.put(start, output)
+        self.positions.extend((index + i, (self.rank, start + i)) for i in range(n))
+
+    def update(self, indices, batch, sr, metrics, metric_logger=None, gt_key='gt'):
+        """Keeps the per-image metrics of a batch, ``metric_logger`` shows the rank-local progress."""
+        scores = eval_metrics_per_image(batch, sr, metrics, gt_key)
+        self.metrics.extend(zip(indices, scores))
+        if metric_logger is not None:
+            for m in scores:
+                metric_logger.update_dict(m)
+
+    def close(self):
+        from UDL.Basis.auxiliary import MetricLogger
+        from UDL.Basis.dist_utils import gather_eval_records, get_dist_info
+        # every shard is complete before the (collective) gathers below return on rank 0
+        self.writer.close()
+        metrics = gather_eval_records(self.metrics, all_ranks=True)
+        metric_logger = MetricLogger(delimiter="  ")
+        for _, m in metrics:
+            metric_logger.update_dict(m)
+        self.stats = {k: meter.avg for k, meter in metric_logger.meters.items()}
+        self.stats['images'] = len(metrics)
+        if self.rank == 0:
+            log_string(f"=> {len(metrics)} images of all ranks: {metric_logger}")
+        if self.gather_outputs:
+            positions = gather_eval_records(self.positions)
+            if positions is not None:
+                self._merge(positions, get_dist_info()[1])
+
+    def _merge(self, positions, world_size):
+        shards = {}
+        try:
+            with ResultWriter(self.path, self.fmt, num=self.num) as writer:
+                for index, (rank, k) in positions:
+                    if rank not in shards:
+                        shards[rank] = h5py.File(self._shard(rank), 'r')
+                    writer.put(index, torch.from_numpy(shards[rank]['output'][k].transpose(2, 0, 1)))
+        finally:
+            for f in shards.values():
+                f.close()
+            for rank in range(world_size):
+                if os.path.exists(self._shard(rank)):
+                    os.remove(self._shard(rank))
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def compare_eval_precision(eval_step, half, batch, metric_logger, ref_logger, gt_key='gt'):
+    """eval_step in half precision (``half``: module.HalfInference) and again in fp32 for --eval-precision-check.
+
+    The fp32 metrics go to ``ref_logger``, the max. abs output error and both step times to ``metric_logger``.
+    Returns the half precision ``(sr, metrics)``.
+    """
+    times = {}
+    for enabled in (False, True):
+        half.enabled = enabled
+        start = time.perf_counter()
+        sr, metrics = eval_step(batch)
+        _synchronize(sr.device)
+        times[enabled] = time.perf_counter() - start, sr, metrics
+    (fp32_time, ref, ref_metrics), (half_time, sr, metrics) = times[False], times[True]
+    update_eval_metrics(ref_logger, batch, ref, ref_metrics, gt_key)
+    metric_logger.update(max_err=(sr - ref).abs().max(), time_half=half_time, time_fp32=fp32_time)
+    return sr, metrics
+
+
+def precision_deltas(metric_logger, ref_logger, precision):
+    """``<metric>_fp32`` and ``<metric>_delta`` (``precision`` - fp32) averages of an --eval-precision-check run."""
+    stats = {}
+    for k, meter in ref_logger.meters.items():
+        stats[f"{k}_fp32"] = meter.avg
+        stats[f"{k}_delta"] = metric_logger.meters[k].avg - meter.avg
+    log_string(f"{precision} vs fp32: " + "  ".join(f"{k} {metric_logger.meters[k].avg:.4f} "
+                                                    f"({stats[k + '_delta']:+.2e})" for k in ref_logger.meters) +
+               f"  max_err {metric_logger.meters['max_err'].avg:.2e}  speedup "
+               f"{metric_logger.meters['time_fp32'].avg / metric_logger.meters['time_half'].avg:.2f}x")
+    return stats
@@ -0,0 +1,558 @@
+"""
+Local inference service for any builder found by UDL.Basis.benchmark. Requests are queued and requests of the
+same input shapes are coalesced into micro-batches (at most --max-batch-size images, a request waits at most
+--max-wait-ms for company). Scenes larger than --tile-size run through tiled_inference. Results are streamed
+back as npy or mat, throughput and latency counters are served as json.
+
+    POST /predict?format=npy|mat   body: npz of the task's batch keys ([C, H, W] or [B, C, H, W] arrays),
+                                   e.g. rgb/lrhsi/up for hisr, lms/ms/pan for pansharpening. gt is optional.
+                                   returns the output as [B, H, W, C] (npy, or 'output' of a mat file)
+    GET  /stats                    counters and latency percentiles
+    GET  /health
+
+usage:
+    python -m UDL.Basis.serve --filter "^SWATv4$" --checkpoint results/hisr/SWATv4/model_best.pth.tar --port 8000
+    python -m UDL.Basis.serve --filter "^SWATv4$" --socket /tmp/udl.sock --tile-size 128
+    # local load test against a running server
+    python -m UDL.Basis.serve --client --url http://127.0.0.1:8000 --task hisr --requests 64 --concurrency 8
+    python -m UDL.Basis.serve --client --socket /tmp/udl.sock --task hisr --size 128
+"""
+import argparse
+import collections
+import contextlib
+import http.client
+import importlib
+import io
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError, TimeoutError as FutureTimeout
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import scipy.io as sio
+import torch
+from UDL.Basis.benchmark import SEARCH_ROOTS, REPO_ROOT, find_builders, load_args, make_batch, _first_tensor
+from UDL.Basis.export import load_weights
+from UDL.Basis.module import tiled_inference, enable_channels_last, to_channels_last
+
+# the (upsampled) input gt defaults to when a request has none, for the eval_steps that read batch['gt']
+GT_FALLBACK = {'hisr': 'up', 'pansharpening': 'lms', 'derain': 'O'}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ServerStats():
+    """Thread-safe request/batch counters, latencies of the last ``window`` requests."""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counts = collections.Counter()
+        self.batch_sizes = collections.Counter()
+        self.latency = collections.deque(maxlen=window)
+        self.queue_wait = collections.deque(maxlen=window)
+        self.compute = collections.deque(maxlen=window)
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def add_batch(self, size, compute):
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['images'] += size
+            self.batch_sizes[size] += 1
+            self.compute.append(compute)
+
+    def add_request(self, latency, queue_wait):
+        with self.lock:
+            self.counts['completed'] += 1
+            self.latency.append(latency)
+            self.queue_wait.append(queue_wait)
+
+    def snapshot(self, queued=0):
+        with self.lock:
+            uptime = time.time() - self.start
+            stats = dict(self.counts, queued=queued, uptime_s=round(uptime, 1),
+                         images_per_s=round(self.counts['images'] / max(uptime, 1e-9), 3),
+                         mean_batch_size=round(self.counts['images'] / max(self.counts['batches'], 1), 3),
+                         batch_sizes={str(k): v for k, v in sorted(self.batch_sizes.items())})
+            for name, values in (('latency', self.latency), ('queue_wait', self.queue_wait),
+                                 ('compute', self.compute)):
+                if values:
+                    p = np.percentile(np.asarray(values) * 1e3, [50, 95, 99])
+                    stats[f'{name}_ms'] = {'p50': round(p[0], 2), 'p95': round(p[1], 2), 'p99': round(p[2], 2),
+                                           'max': round(max(values) * 1e3, 2)}
+        return stats
+
+
+class _Request():
+    __slots__ = ('inputs', 'key', 'size', 'future', 'time')
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        # only requests whose inputs have the same keys and [C, H, W] can share a batch
+        self.key = tuple(sorted((k, tuple(v.shape[1:])) for k, v in inputs.items()))
+        self.size = next(iter(inputs.values())).shape[0]
+        self.future = Future()
+        self.time = time.perf_counter()
+
+
+class MicroBatcher():
+    """Coalesces queued requests of the same shapes into batches for ``fn`` (dict of [B, C, H, W] -> [B, ...]).
+
+    The oldest request decides what runs next: it is batched with the same-shape requests behind it once they
+    add up to ``max_batch_size`` images or it has waited ``max_wait_ms``. Other shapes stay queued in order.
+    ``submit`` raises QueueFull beyond ``max_queue`` pending requests. Requests whose future was cancelled (the
+    client gave up) or that are queued longer than ``timeout_s`` (> 0) are dropped before they are batched.
+    """
+
+    def __init__(self, fn, max_batch_size=8, max_wait_ms=10, max_queue=256, stats=None, timeout_s=0):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.max_queue = max_queue
+        self.timeout_s = timeout_s
+        self.stats = stats or ServerStats()
+        self.pending = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, inputs):
+        request = _Request(inputs)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("the batcher is closed")
+            if len(self.pending) >= self.max_queue:
+                self.stats.add('rejected')
+                raise QueueFull(f"{len(self.pending)} requests queued")
+            self.pending.append(request)
+            self.stats.add('requests')
+            self.cond.notify()
+        return request.future
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _drop_expired(self):
+        now = time.perf_counter()
+        for r in list(self.pending):
+            if r.future.cancelled() or (self.timeout_s > 0 and now - r.time > self.timeout_s):
+                r.future.cancel()
+                self.pending.remove(r)
+                self.stats.add('expired')
+
+    def _next_batch(self):
+        """The next batch (possibly empty, all of it cancelled meanwhile), None once closed and drained."""
+        with self.cond:
+            while True:
+                self._drop_expired()
+                if not self.pending:
+                    if self.closed:
+                        return None
+                    self.cond.wait()
+                    continue
+                first = self.pending[0]
+                batch, size = [], 0
+                for r in self.pending:
+                    if r.key == first.key and (not batch or size + r.size <= self.max_batch_size):
+                        batch.append(r)
+                        size += r.size
+                remaining = first.time + self.max_wait - time.perf_counter()
+                if size >= self.max_batch_size or remaining <= 0 or self.closed:
+                    break
+                self.cond.wait(remaining)
+            for r in batch:
+                self.pending.remove(r)
+        # from here on a request is computed even if its client cancels
+        return [r for r in batch if r.future.set_running_or_notify_cancel()]
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                inputs = {k: torch.cat([r.inputs[k] for r in batch]) for k in batch[0].inputs}
+                output = self.fn(inputs)
+                self.stats.add_batch(sum(r.size for r in batch), time.perf_counter() - start)
+                offset = 0
+                for r in batch:
+                    r.future.set_result((output[offset:offset + r.size], start - r.time))
+                    offset += r.size
+            except Exception as e:
+                self.stats.add('errors', len(batch))
+                for r in batch:
+                    r.future.set_exception(e)
+
+
+class InferenceModel():
+    """A built (and optionally trained / quantized) model behind ``__call__(batch) -> [B, C, H, W]`` on cpu.
+
+    The first request of every set of keys runs through eval_step, which shows which batch keys the forward takes.
+    Later requests call the forward on those keys directly, skipping eval_step's metrics. Models whose eval_step
+    derives the forward inputs or changes its output (residual pansharpening nets) stay on eval_step.
+    """
+
+    def __init__(self, entry, cfg):
+        self.task = entry['task']
+        self.cfg = cfg
+        sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            args = load_args(entry, cfg.device)
+            args.distributed = False
+            torch.manual_seed(0)
+            model = getattr(importlib.import_module(entry['module']), entry['builder'])(args)[0]
+        if cfg.checkpoint:
+            checkpoint = torch.load(cfg.checkpoint, map_location='cpu', weights_only=False)
+            if isinstance(checkpoint, dict) and checkpoint.get('quantization') is not None:
+                # UDL.Basis.quantize saves the whole int8 model
+                model = checkpoint['model']
+            else:
+                load_weights(model, checkpoint)
+        self.model = model.to(cfg.device).eval()
+        if cfg.channels_last:
+            enable_channels_last(self.model)
+        if cfg.tile_size > 0:
+            self.model.forward = partial(self._forward, partial(type(self.model).forward, self.model))
+        # sorted batch keys -> batch keys of the forward's positional inputs, None: through eval_step
+        self.forward_keys = {}
+
+    def _forward(self, forward, *x, **kwargs):
+        if max(x[0].shape[-2:]) <= self.cfg.tile_size:
+            return forward(*x, **kwargs)
+        return tiled_inference(forward, *x, tile_size=self.cfg.tile_size, overlap=self.cfg.tile_overlap,
+                               window=self.cfg.tile_window, tiles_per_batch=self.cfg.tiles_per_batch, **kwargs)
+
+    def _eval_step(self, batch):
+        """eval_step's output and the batch keys its forward was called with (None if they are not all inputs)."""
+        calls = []
+        patched = 'forward' in vars(self.model)
+        forward = self.model.forward
+
+        def recorder(*x, **kwargs):
+            out = forward(*x, **kwargs)
+            calls.append((x, kwargs, out))
+            return out
+
+        self.model.forward = recorder
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                output = self.model.eval_step(batch)
+        finally:
+            if patched:
+                self.model.forward = forward
+            else:
+                del self.model.forward
+        if len(calls) != 1 or calls[0][1] or _first_tensor(output) is not _first_tensor(calls[0][2]):
+            return output, None
+        keys = []
+        for x in calls[0][0]:
+            key = next((k for k, v in batch.items() if isinstance(x, torch.Tensor) and x.shape == v.shape and
+                        torch.equal(x.cpu(), v.cpu())), None)
+            if key is None:
+                return output, None
+            keys.append(key)
+        return output, tuple(keys)
+
+    @torch.no_grad()
+    def __call__(self, batch):
+        fallback = GT_FALLBACK.get(self.task)
+        if 'gt' not in batch and fallback in batch:
+            batch = dict(batch, gt=batch[fallback])
+        if self.cfg.channels_last:
+            batch = to_channels_last(batch)
+        names = tuple(sorted(batch))
+        if names not in self.forward_keys:
+            output, self.forward_keys[names] = self._eval_step(batch)
+        elif self.forward_keys[names] is not None:
+            output = self.model(*[batch[k].to(self.cfg.device) for k in self.forward_keys[names]])
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                output = self.model.eval_step(batch)
+        return _first_tensor(output).float().cpu()
+
+
+def read_request(body):
+    """npz bytes -> dict of float32 [B, C, H, W] tensors."""
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        batch = {k: torch.from_numpy(np.ascontiguousarray(data[k], dtype=np.float32)) for k in data.files}
+    if not batch:
+        raise ValueError("empty request")
+    batch = {k: v[None] if v.dim() == 3 else v for k, v in batch.items()}
+    if any(v.dim() != 4 for v in batch.values()) or len({v.shape[0] for v in batch.values()}) != 1:
+        raise ValueError(f"expected [C, H, W] or [B, C, H, W] arrays with one batch size, got "
+                         f"{ {k: tuple(v.shape) for k, v in batch.items()} }")
+    return batch
+
+
+def encode_output(output, fmt):
+    """[B, C, H, W] -> npy or mat bytes of the [B, H, W, C] array (the layout ResultWriter writes)."""
+    output = output.permute(0, 2, 3, 1).numpy()
+    buf = io.BytesIO()
+    if fmt == 'npy':
+        np.save(buf, output)
+    elif fmt == 'mat':
+        sio.savemat(buf, {'output': output})
+    else:
+        raise ValueError(f"unknown result format: {fmt}")
+    return buf.getvalue()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 1 << 20
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self._reply(200, json.dumps(self.server.stats.snapshot(len(self.server.batcher))).encode(),
+                        'application/json')
+        elif path == '/health':
+            self._reply(200, b'{"status": "ok"}', 'application/json')
+        else:
+            self._reply(404, b'not found')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._reply(404, b'not found')
+            return
+        start = time.perf_counter()
+        fmt = parse_qs(url.query).get('format', [self.server.result_format])[0]
+        try:
+            batch = read_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if fmt not in ('npy', 'mat'):
+                raise ValueError(f"unknown result format: {fmt}")
+        except Exception as e:
+            self.server.stats.add('bad_requests')
+            self._reply(400, str(e).encode())
+            return
+        try:
+            future = self.server.batcher.submit(batch)
+            output, queue_wait = future.result(self.server.timeout_s)
+            body = encode_output(output, fmt)
+        except QueueFull as e:
+            self._reply(503, str(e).encode())
+            return
+        except (FutureTimeout, CancelledError):
+            # still queued: the batcher drops it instead of computing it for nobody
+            future.cancel()
+            self.server.stats.add('timeouts')
+            self._reply(504, f"no result within {self.server.timeout_s} s".encode())
+            return
+        except Exception as e:
+            self._reply(500, f"{type(e).__name__}: {e}".encode())
+            if self.server.verbose:
+                traceback.print_exc()
+            return
+        # counted before the reply, a client asking for /stats right after sees its request
+        self.server.stats.add_request(time.perf_counter() - start, queue_wait)
+        self._reply(200, body, 'application/x-matlab-data' if fmt == 'mat' else 'application/x-npy')
+
+    def _reply(self, code, body, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # large scenes go out in chunks instead of one socket write
+        view = memoryview(body)
+        for i in range(0, len(view), self.chunk_size):
+            self.wfile.write(view[i:i + self.chunk_size])
+
+    def address_string(self):
+        # unix socket peers have no (host, port)
+        return self.client_address[0] if isinstance(self.client_address, tuple) else self.server.address
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(RequestHandler, self).log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(model, cfg):
+    """HTTP server on --socket (unix) or --host/--port around a MicroBatcher of ``model``."""
+    stats = ServerStats()
+    batcher = MicroBatcher(model, cfg.max_batch_size, cfg.max_wait_ms, cfg.max_queue, stats, cfg.timeout)
+    if cfg.socket:
+        if os.path.exists(cfg.socket):
+            os.remove(cfg.socket)
+        server = UnixHTTPServer(cfg.socket, RequestHandler)
+        server.address = cfg.socket
+    else:
+        server = ThreadingHTTPServer((cfg.host, cfg.port), RequestHandler)
+        server.address = f"http://{cfg.host}:{server.server_address[1]}"
+    server.batcher, server.stats = batcher, stats
+    server.result_format, server.timeout_s, server.verbose = cfg.result_format, cfg.timeout, cfg.verbose
+    return server
+
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super(_UnixConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServeClient():
+    """Client of a local server, by ``url`` (http://host:port) or unix ``socket`` path. One connection per thread."""
+
+    def __init__(self, url=None, socket=None, timeout=600):
+        self.url = urlparse(url) if url else None
+        self.socket = socket
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = _UnixConnection(self.socket, self.timeout) if self.socket else \
+                http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        return self.local.conn
+
+    def _request(self, method, path, body=None):
+        conn = self._connection()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            data = response.read()
+        except (ConnectionError, http.client.HTTPException):
+            self.local.conn = None
+            raise
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path}: {response.status} {data.decode(errors='replace')}")
+        return data
+
+    def predict(self, batch, fmt='npy'):
+        """batch: dict of [C, H, W] / [B, C, H, W] arrays or tensors -> [B, H, W, C] numpy array."""
+        buf = io.BytesIO()
+        np.savez(buf, **{k: np.asarray(v, dtype=np.float32) for k, v in batch.items()})
+        data = self._request('POST', f'/predict?format={fmt}', buf.getvalue())
+        if fmt == 'mat':
+            return sio.loadmat(io.BytesIO(data))['output']
+        return np.load(io.BytesIO(data))
+
+    def stats(self):
+        return json.loads(self._request('GET', '/stats'))
+
+
+def run_client(cfg):
+    """Sends --requests synthetic single-image requests from --concurrency threads and prints the latencies."""
+    client = ServeClient(cfg.url, cfg.socket, cfg.timeout)
+    batch = {k: v[0].numpy() for k, v in make_batch(cfg.task, 1, cfg.size, cfg.scale, cfg.hsi_bands,
+                                                     cfg.ms_bands).items() if k != 'gt'}
+    latencies = []
+
+    def one(_):
+        t = time.perf_counter()
+        out = client.predict(batch, cfg.result_format)
+        latencies.append(time.perf_counter() - t)
+        return out.shape
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(cfg.concurrency) as pool:
+        shapes = set(pool.map(one, range(cfg.requests)))
+    total = time.perf_counter() - start
+    p = np.percentile(np.asarray(latencies) * 1e3, [50, 95, 99])
+    print(f"{cfg.requests} requests, outputs {shapes}, {cfg.requests / total:.2f} req/s, "
+          f"latency p50 {p[0]:.1f} / p95 {p[1]:.1f} / p99 {p[2]:.1f} ms")
+    stats = client.stats()
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def serve_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-batching local inference server')
+    parser.add_argument('--client', action='store_true', help='run the load-test client against --url/--socket')
+    parser.add_argument('--task', default=None, choices=list(SEARCH_ROOTS.keys()))
+    parser.add_argument('--filter', default=None, type=str, help='regex matching exactly one builder')
+    parser.add_argument('--checkpoint', default='', type=str,
+                        help='weights or an int8 checkpoint of UDL.Basis.quantize, random init if empty')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--socket', default='', type=str, help='serve on / connect to this unix socket instead')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', type=str, help='server the client connects to')
+    # * Micro-batching
+    parser.add_argument('--max-batch-size', default=8, type=int, help='images per micro-batch')
+    parser.add_argument('--max-wait-ms', default=10, type=float,
+                        help='longest a request waits for same-shape requests to batch with')
+    parser.add_argument('--max-queue', default=256, type=int, help='queued requests before answering 503')
+    parser.add_argument('--timeout', default=600, type=float, help='seconds a request may take')
+    parser.add_argument('--result-format', default='npy', choices=['npy', 'mat'],
+                        help='default response format, ?format= overrides it per request')
+    parser.add_argument('--channels-last', action='store_true')
+    # * Tiled inference
+    parser.add_argument('--tile-size', default=0, type=int,
+                        help='scenes larger than this run in overlapping tiles (0: whole image at once)')
+    parser.add_argument('--tile-overlap', default=16, type=int)
+    parser.add_argument('--tile-window', default='gaussian', choices=['gaussian', 'cosine', 'uniform'])
+    parser.add_argument('--tiles-per-batch', default=16, type=int)
+    # * Client
+    parser.add_argument('--requests', default=32, type=int)
+    parser.add_argument('--concurrency', default=8, type=int)
+    parser.add_argument('--size', default=64, type=int, help='HR spatial size of the synthetic requests')
+    parser.add_argument('--scale', default=4, type=int, help='hisr upsampling ratio of lrhsi')
+    parser.add_argument('--hsi-bands', default=31, type=int)
+    parser.add_argument('--ms-bands', default=8, type=int)
+    parser.add_argument('--verbose', action='store_true', help='log every request and print tracebacks')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    cfg = serve_cfg(argv)
+    if cfg.client:
+        return run_client(cfg)
+    torch.set_num_threads(cfg.threads)
+    entries = find_builders({cfg.task: SEARCH_ROOTS[cfg.task]} if cfg.task else SEARCH_ROOTS)
+    entries = [e for e in entries if cfg.filter and (re.search(cfg.filter, e['name']) or
+                                                     re.search(cfg.filter, e['module']))]
+    if len(entries) != 1:
+        raise SystemExit(f"--filter has to match exactly one builder, matched "
+                         f"{[e['name'] for e in entries] if entries else 'none'}")
+    model = InferenceModel(entries[0], cfg)
+    server = make_server(model, cfg)
+    print(f"serving {entries[0]['name']} on {server.address} (max batch {cfg.max_batch_size}, "
+          f"max wait {cfg.max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if cfg.socket and os.path.exists(cfg.socket):
+            os.remove(cfg.socket)
+
+
+if __name__ == '__main__':
+    main()
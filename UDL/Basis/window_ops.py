@@ -0,0 +1,159 @@
+"""
+Window partition / reverse and the window shuffles (PSRT Win_Shuffle, Bidi Win_Dila) shared by the models.
+
+Every op is a view + permute followed by a single reshape, so the data is copied at most once. For
+window_partition / ka_window_partition, inputs whose (H, W) are not multiples of the window are zero-padded at the
+bottom/right; the matching reverse op takes the original (H, W) and crops the padding off again. The shuffles
+need multiples of the window, as the models call them between window ops on the same (H, W).
+"""
+import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+
+
+def _pad_hw(x, multiple, dims=(1, 2)):
+    """Zero-pads dims (H, W) of x at the end up to multiples of ``multiple`` (int or (mh, mw))."""
+    mh, mw = _pair(multiple)
+    H, W = x.shape[dims[0]], x.shape[dims[1]]
+    pad_h, pad_w = -H % mh, -W % mw
+    if pad_h == 0 and pad_w == 0:
+        return x
+    pad = [0, 0] * (x.dim() - 1 - dims[1]) + [0, pad_w] + [0, 0] * (dims[1] - dims[0] - 1) + [0, pad_h]
+    return F.pad(x, pad)
+
+
+def _crop_hw(x, H, W, dims=(1, 2)):
+    if x.shape[dims[0]] == H and x.shape[dims[1]] == W:
+        return x
+    return x.narrow(dims[0], 0, H).narrow(dims[1], 0, W).contiguous()
+
+
+def window_partition(x, window_size):
+    """
+    Args:
+        x: (B, H, W, C), padded to multiples of the window if needed
+        window_size (int | tuple[int]): window size
+
+    Returns:
+        windows: (num_windows*B, window_size, window_size, C)
+    """
+    wh, ww = _pair(window_size)
+    x = _pad_hw(x, (wh, ww))
+    B, H, W, C = x.shape
+    x = x.view(B, H // wh, wh, W // ww, ww, C)
+    return x.permute(0, 1, 3, 2, 4, 5).reshape(-1, wh, ww, C)
+
+
+def window_reverse(windows, window_size, H, W):
+    """
+    Args:
+        windows: (num_windows*B, window_size, window_size, C)
+        window_size (int | tuple[int]): Window size
+        H (int): Height of image (before padding)
+        W (int): Width of image (before padding)
+
+    Returns:
+        x: (B, H, W, C)
+    """
+    wh, ww = _pair(window_size)
+    nh, nw = -(-H // wh), -(-W // ww)
+    B = windows.shape[0] // (nh * nw)
+    x = windows.view(B, nh, nw, wh, ww, -1)
+    x = x.permute(0, 1, 3, 2, 4, 5).reshape(B, nh * wh, nw * ww, -1)
+    return _crop_hw(x, H, W)
+
+
+def ka_window_partition(x, window_size, H=None, W=None):
+    """
+    input: (B, H*W, C), window_size: int or (wh, ww), H/W default to a square input
+    output: (B, num_windows*C, wh, ww)
+    """
+    B, L, C = x.shape
+    if H is None:
+        H = W = int(L ** 0.5)
+    wh, ww = _pair(window_size)
+    x = _pad_hw(x.reshape(B, H, W, C), (wh, ww))
+    H, W = x.shape[1:3]
+    x = x.view(B, H // wh, wh, W // ww, ww, C)
+    return x.permute(0, 1, 3, 5, 2, 4).reshape(B, -1, wh, ww)
+
+
+def ka_window_reverse(windows, window_size, H, W):
+    """
+    input: (B, num_windows*C, wh, ww), window_size: int or (wh, ww), H/W before padding
+    output: (B, H*W, C)
+    """
+    B = windows.shape[0]
+    wh, ww = _pair(window_size)
+    nh, nw = -(-H // wh), -(-W // ww)
+    x = windows.reshape(B, nh, nw, -1, wh, ww)
+    x = x.permute(0, 1, 4, 2, 5, 3).reshape(B, nh * wh, nw * ww, -1)
+    return _crop_hw(x, H, W).view(B, H * W, -1)
+
+
+def pad_feature_map(input, window_size=8, H=None, W=None):
+    """(B, H*W, C) zero-padded at the bottom/right to (B, H'*W', C) with H', W' multiples of window_size."""
+    B, L, C = input.shape
+    if H is None:
+        H = W = int(L ** 0.5)
+    output = _pad_hw(input.reshape(B, H, W, C), window_size)
+    return output.view(B, -1, C)
+
+
+def Win_Shuffle(x, win_size):
+    """
+    PSRT shuffle: the (win_size/2)^2 blocks are interleaved so that blocks 2i and 2i+1 end up half the image
+    apart (per axis).
+    :param x: B C H W, H and W multiples of win_size
+    :param win_size:
+    :return: y: B C H W
+    """
+    B, C, H, W = x.shape
+    assert H % win_size == 0 and W % win_size == 0, 'resolution of input should be divisible'
+    assert win_size % 2 == 0, 'win_size should be the multiple of two'
+    d = win_size // 2
+    x = x.reshape(B, C, H // win_size, 2, d, W // win_size, 2, d)
+    return x.permute(0, 1, 3, 2, 4, 6, 5, 7).reshape(B, C, H, W)
+
+
+def Win_Reshuffle(x, win_size):
+    """
+    Inverse of Win_Shuffle.
+    :param x: B C H W, H and W multiples of win_size
+    :param win_size:
+    :return: y: B C H W
+    """
+    B, C, H, W = x.shape
+    assert H % win_size == 0 and W % win_size == 0, 'resolution of input should be divisible'
+    assert win_size % 2 == 0, 'win_size should be the multiple of two'
+    d = win_size // 2
+    x = x.reshape(B, C, 2, H // win_size, d, 2, W // win_size, d)
+    return x.permute(0, 1, 3, 2, 4, 6, 5, 7).reshape(B, C, H, W)
+
+
+def Win_Dila(x, win_size):
+    """
+    Bidi dilation: inside every (2*win_size)^2 window the pixels are regrouped by their (row, col) parity
+    into four win_size^2 quadrants.
+    :param x: B, H, W, C, H and W multiples of 2*win_size
+    :param
+    :return: y: B, H, W, C
+    """
+    n_win = win_size * 2
+    B, H, W, C = x.shape
+    assert H % n_win == 0 and W % n_win == 0, 'resolution of input should be divisible'
+    x = x.reshape(B, H // n_win, win_size, 2, W // n_win, win_size, 2, C)
+    return x.permute(0, 1, 3, 2, 4, 6, 5, 7).reshape(B, H, W, C)
+
+
+def Win_ReDila(x, win_size):
+    """
+    Inverse of Win_Dila.
+    :param x: B, H, W, C, H and W multiples of 2*win_size
+    :param
+    :return: y: B, H, W, C
+    """
+    n_win = win_size * 2
+    B, H, W, C = x.shape
+    assert H % n_win == 0 and W % n_win == 0, 'resolution of input should be divisible'
+    x = x.reshape(B, H // n_win, 2, win_size, W // n_win, 2, win_size, C)
+    return x.permute(0, 1, 3, 2, 4, 6, 5, 7).reshape(B, H, W, C)
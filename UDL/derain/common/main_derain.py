@@ -8,6 +8,7 @@ import shutil
 import time
 import warnings
 from collections import OrderedDict
+from functools import partial
 import datetime
 import imageio
 import torch
@@ -17,8 +18,10 @@ import torchvision
 from torch import nn
 from typing import Dict, List
 from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, create_logger
-from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint
+from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint, \
+    amp_state_dict
 from UDL.Basis.dist_utils import init_dist, dist_train_v1, get_dist_info, reduce_mean
+from UDL.Basis.module import enable_channels_last, enable_activation_checkpointing, to_channels_last
 import torch.multiprocessing as mp
 from UDL.derain.common.derain_dataset import derainSession as DataSession
 from torch.utils.tensorboard import SummaryWriter
@@ -55,14 +58,11 @@ def train_one_epoch(args, model, criterion, data_loader, optimizer, device, epoc
         losses = loss_dicts['reg_loss']
         losses = losses / args.accumulated_step
         model.backward(optimizer, losses, scaler)
-        if args.clip_max_norm > 0:
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_max_norm)
-            # print(get_grad_norm(model.parameters()))
-        else:
-            grad_norm = get_grad_norm(model.parameters())
+        step = idx % args.accumulated_step == 0
+        grad_norm = model.clip_grad(optimizer, args.clip_max_norm, scaler, step)
 
-        if idx % args.accumulated_step == 0:
-            optimizer.step()
+        if step:
+            model.step(optimizer, scaler)
             optimizer.zero_grad()
 
         # torch.cuda.synchronize()
@@ -94,6 +94,10 @@ def train_one_epoch(args, model, criterion, data_loader, optimizer, device, epoc
 ################################################################################
 # framework
 ################################################################################
+def _channels_last_step(eval_step, batch, *args, **kwargs):
+    return eval_step(to_channels_last(batch), *args, **kwargs)
+
+
 class EpochRunner():
 
     def __init__(self, args, sess):
@@ -135,7 +139,7 @@ class EpochRunner():
         model = model_amp(args, model, criterion, args.reg)
         optimizer, scaler = model.apex_initialize(optimizer)
         model.dist_train()
-        model, optimizer = load_checkpoint(args, model, optimizer)
+        model, optimizer = load_checkpoint(args, model, optimizer, scaler=scaler)
         if args.start_epoch >= 1:
             args.epochs += 1
         start_time = time.time()
@@ -164,7 +168,8 @@ class EpochRunner():
                         'best_metric': args.best_prec1,
                         'loss': val_loss,
                         'best_epoch': args.best_epoch,
-                        'amp': amp.state_dict() if args.amp_opt_level != 'O0' else None,
+                        'amp': amp_state_dict(args),
+                        'scaler': scaler.state_dict() if scaler is not None else None,
                         'optimizer': optimizer.state_dict()
                     }, args.model_save_dir, is_best, filename=f"{epoch}.pth.tar")
             if args.global_rank == 0:
@@ -186,6 +191,8 @@ class EpochRunner():
         model.eval()
         # for iteration, batch in enumerate(val_loader, 1):
         for batch, idx in metric_logger.log_every(val_loader, 1, header):
+            if args.channels_last:
+                batch = to_channels_last(batch)
             index = batch['index']
             samples = batch['O'].to(args.device, non_blocking=True)
             gt = batch['B'].to(args.device, non_blocking=True)
@@ -225,6 +232,9 @@ class EpochRunner():
     @torch.no_grad()
     def eval_framework(self, val_loader, model, criterion, epoch=0):
         from ..evaluation.ps_evaluate import eval_framework
+        if self.args.channels_last:
+            # the eval loop hands every batch to eval_step, convert them there like the hisr/pansharpening loops
+            model.eval_step = partial(_channels_last_step, model.eval_step)
         return eval_framework(self.args, val_loader, model)
 
 
@@ -262,6 +272,12 @@ def main(args):
     model, criterion, optimizer, scheduler = args.builder(args)
     # model.to(device)
     model.cuda(args.local_rank)
+    if args.channels_last:
+        enable_channels_last(model)
+    if args.checkpoint_stages and not args.eval:
+        stages = enable_activation_checkpointing(model, args.checkpoint_stages, args.checkpoint_granularity)
+        log_string(f"activation checkpointing ({args.checkpoint_granularity}): "
+                   f"{', '.join(type(s).__name__ for s in stages)}")
 
     ##################################################
     if args.eval:
@@ -8,6 +8,8 @@ from einops import rearrange, repeat
 import numbers
 import torch.nn.functional as F
 from math import sqrt
+from UDL.Basis.module import kernel_bank_conv2d, window_attention
+from UDL.Basis.window_ops import window_partition, window_reverse, ka_window_partition, Win_Dila, Win_ReDila
 
 
 class Mlp(nn.Module):
@@ -29,86 +31,6 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
-def Win_Dila(x, win_size):
-    """
-    :param x: B, H, W, C
-    :param
-    :return: y: B, H, W, C
-    """
-    n_win = win_size * 2
-    B, H, W, C = x.shape
-    x = x.reshape(-1, (H // n_win), n_win, (W // n_win), n_win, C)  # B x n1 x n_win x n2 x n_win x C
-    x = x.permute(0, 1, 3, 2, 4, 5)  # B x n1 x n2 x n_win x n_win x C
-
-    xt = torch.zeros_like(x)
-    x0 = x[:, :, :, 0::2, 0::2, :]
-    x1 = x[:, :, :, 0::2, 1::2, :]
-    x2 = x[:, :, :, 1::2, 0::2, :]
-    x3 = x[:, :, :, 1::2, 1::2, :]
-
-    xt[:, :, :, 0:n_win//2, 0:n_win//2, :] = x0  # B n/2 n/2 d2c
-    xt[:, :, :, 0:n_win//2, n_win//2:n_win, :] = x1  # B n/2 n/2 d2c
-    xt[:, :, :, n_win//2:n_win, 0:n_win//2, :] = x2  # B n/2 n/2 d2c
-    xt[:, :, :, n_win//2:n_win, n_win//2:n_win, :] = x3  # B n/2 n/2 d2c
-    xt = xt.permute(0, 1, 3, 2, 4, 5)
-    xt = xt.reshape(-1, H, W, C)
-
-    return xt
-
-def Win_ReDila(x, win_size):
-    """
-    :param x: B, H, W, C
-    :param
-    :return: y: B, H, W, C
-    """
-    n_win = win_size * 2
-    B, H, W, C = x.shape
-    x = x.reshape(-1, (H // n_win), n_win, (W // n_win), n_win, C)  # B x n1 x n_win x n2 x n_win x C
-    x = x.permute(0, 1, 3, 2, 4, 5)  # B x n1 x n2 x n_win x n_win x C
-
-    xt = torch.zeros_like(x)
-    xt[:, :, :, 0::2, 0::2, :] = x[:, :, :, 0:n_win//2, 0:n_win//2, :]
-    xt[:, :, :, 0::2, 1::2, :] = x[:, :, :, 0:n_win//2, n_win//2:n_win, :]
-    xt[:, :, :, 1::2, 0::2, :] = x[:, :, :, n_win//2:n_win, 0:n_win//2, :]
-    xt[:, :, :, 1::2, 1::2, :] = x[:, :, :, n_win//2:n_win, n_win//2:n_win, :]
-
-    xt = xt.permute(0, 1, 3, 2, 4, 5)
-    xt = xt.reshape(-1, H, W, C)
-
-    return xt
-
-
 class PatchMerging(nn.Module):
     r""" Patch Merging Layer.
 
@@ -150,17 +72,6 @@ class PatchMerging(nn.Module):
     
 
 
-def ka_window_partition(x, window_size):
-    """
-    input: (B, H*W, C)
-    output: (B, num_windows*C, window_size, window_size)
-    """
-    B, L, C = x.shape
-    H, W = int(sqrt(L)), int(sqrt(L))
-    x = x.reshape(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 5, 2, 4).contiguous().view(B, -1, window_size, window_size)
-    return windows
-
 class SELayer_KA(nn.Module):
     def __init__(self, channel):
         super().__init__()
@@ -244,15 +155,10 @@ class KernelAttention(nn.Module):
 
         # bs, num_heads, win_num*k_size**2, c/num_heads
         kernels_q, kernels_k, kernels_v = kernels_qkv[0], kernels_qkv[1], kernels_qkv[2]
-        kernels_q = kernels_q * self.scale
-
-        # attn: bs, num_heads, win_num*k_size**2, win_num*k_size**2
-        attn = (kernels_q @ kernels_k.transpose(-2, -1))
-        attn = self.softmax(attn)
-        attn = self.attn_drop(attn)
 
         # kernels:  bs, win_num*k_size**2, c
-        kernels = (attn @ kernels_v).transpose(1, 2).reshape(B, self.win_num*self.kernel_size**2, self.dim)
+        kernels = window_attention(kernels_q, kernels_k, kernels_v, self.scale, dropout_p=self.attn_drop.p if self.training else 0.)
+        kernels = kernels.transpose(1, 2).reshape(B, self.win_num*self.kernel_size**2, self.dim)
 
         # kernels:  bs, win_num*k_size**2, c
         kernels = self.proj_out(kernels)
@@ -275,25 +181,21 @@ class KernelAttention(nn.Module):
         # kernels:  bs*win_num, k_size, k_size, c, c
         kernels = kernels.reshape(B*self.win_num, self.kernel_size, self.kernel_size, self.dim, self.dim)
         # TODO: 这里应该把经过全连接层后生成的两个c，哪个作为卷积核的通道呢？
-        # kernels:  bs*win_num*c, c, k_size, k_size
-        kernels = kernels.permute(0, 3, 4, 1, 2).reshape(self.win_num*B*self.dim, self.dim, self.kernel_size, self.kernel_size)
+        # kernels:  bs, win_num*c, c, k_size, k_size
+        kernels = kernels.permute(0, 3, 4, 1, 2).reshape(B, self.win_num*self.dim, self.dim, self.kernel_size, self.kernel_size)
 
 
         ### 下面进行卷积操作
         # x:  bs, c, h, w
         x = x.reshape(B, H, W, C).permute(0, 3, 1, 2)
 
-        # x:  1, bs*win_num*c, h, w
-        x = x.repeat(1, self.win_num, 1, 1).view(1, B*self.win_num*self.dim, H, W)
-
-        # x:  1, bs*win_num*c, h, w
-        x = F.conv2d(x, kernels, stride=self.stride, padding=self.padding, groups=B*self.win_num)
-
-        # x:  bs, h*w, win_num*c 
-        x = x.reshape(B, self.win_num*self.dim, H*W).permute(0, 2, 1)
+        # concat_linear is folded into the kernel bank, x is convolved once instead of once per window
+        # x:  bs, c, h, w
+        x = kernel_bank_conv2d(x, kernels, self.concat_linear.weight, self.concat_linear.bias,
+                               stride=self.stride, padding=self.padding)
 
         # x:  bs, h*w, c
-        x = self.concat_linear(x)
+        x = x.flatten(2).transpose(1, 2)
 
         return x
     
@@ -337,13 +239,8 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-        attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(q, k, v, self.scale, dropout_p=self.attn_drop.p if self.training else 0.)
+        x = x.transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -725,14 +622,15 @@ class Merge(nn.Module):
 
 
 if __name__ == '__main__':
-    input1 = torch.randn(1, 34, 64, 64).cuda()
-    input2 = torch.randn(1, 31, 16, 16).cuda()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    input1 = torch.randn(1, 34, 64, 64).to(device)
+    input2 = torch.randn(1, 31, 16, 16).to(device)
     up = torch.nn.Upsample(scale_factor=2, mode='bicubic', align_corners=None)
     print(up(input2).shape)
     exit()
     # t = Bidirection(img_size=64, patch_size=1, in_chans=34, embed_dim=32, num_heads=[8, 8, 8], window_size=4).cuda()
     # t = Direction2().cuda()
-    t = Merge().cuda()
+    t = Merge().to(device)
     output = t(input1, input2)
     print(output.shape)
 
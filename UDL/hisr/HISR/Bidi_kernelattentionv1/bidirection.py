@@ -7,6 +7,7 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from einops import rearrange, repeat
 import numbers
 import torch.nn.functional as F
+from UDL.Basis.window_ops import window_partition, window_reverse, Win_Dila, Win_ReDila
 
 
 class Mlp(nn.Module):
@@ -28,86 +29,6 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
-def Win_Dila(x, win_size):
-    """
-    :param x: B, H, W, C
-    :param
-    :return: y: B, H, W, C
-    """
-    n_win = win_size * 2
-    B, H, W, C = x.shape
-    x = x.reshape(-1, (H // n_win), n_win, (W // n_win), n_win, C)  # B x n1 x n_win x n2 x n_win x C
-    x = x.permute(0, 1, 3, 2, 4, 5)  # B x n1 x n2 x n_win x n_win x C
-
-    xt = torch.zeros_like(x)
-    x0 = x[:, :, :, 0::2, 0::2, :]
-    x1 = x[:, :, :, 0::2, 1::2, :]
-    x2 = x[:, :, :, 1::2, 0::2, :]
-    x3 = x[:, :, :, 1::2, 1::2, :]
-
-    xt[:, :, :, 0:n_win//2, 0:n_win//2, :] = x0  # B n/2 n/2 d2c
-    xt[:, :, :, 0:n_win//2, n_win//2:n_win, :] = x1  # B n/2 n/2 d2c
-    xt[:, :, :, n_win//2:n_win, 0:n_win//2, :] = x2  # B n/2 n/2 d2c
-    xt[:, :, :, n_win//2:n_win, n_win//2:n_win, :] = x3  # B n/2 n/2 d2c
-    xt = xt.permute(0, 1, 3, 2, 4, 5)
-    xt = xt.reshape(-1, H, W, C)
-
-    return xt
-
-def Win_ReDila(x, win_size):
-    """
-    :param x: B, H, W, C
-    :param
-    :return: y: B, H, W, C
-    """
-    n_win = win_size * 2
-    B, H, W, C = x.shape
-    x = x.reshape(-1, (H // n_win), n_win, (W // n_win), n_win, C)  # B x n1 x n_win x n2 x n_win x C
-    x = x.permute(0, 1, 3, 2, 4, 5)  # B x n1 x n2 x n_win x n_win x C
-
-    xt = torch.zeros_like(x)
-    xt[:, :, :, 0::2, 0::2, :] = x[:, :, :, 0:n_win//2, 0:n_win//2, :]
-    xt[:, :, :, 0::2, 1::2, :] = x[:, :, :, 0:n_win//2, n_win//2:n_win, :]
-    xt[:, :, :, 1::2, 0::2, :] = x[:, :, :, n_win//2:n_win, 0:n_win//2, :]
-    xt[:, :, :, 1::2, 1::2, :] = x[:, :, :, n_win//2:n_win, n_win//2:n_win, :]
-
-    xt = xt.permute(0, 1, 3, 2, 4, 5)
-    xt = xt.reshape(-1, H, W, C)
-
-    return xt
-
-
 class PatchMerging(nn.Module):
     r""" Patch Merging Layer.
 
@@ -773,14 +694,15 @@ class Merge(nn.Module):
 
 
 if __name__ == '__main__':
-    input1 = torch.randn(1, 34, 64, 64).cuda()
-    input2 = torch.randn(1, 31, 16, 16).cuda()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    input1 = torch.randn(1, 34, 64, 64).to(device)
+    input2 = torch.randn(1, 31, 16, 16).to(device)
     up = torch.nn.Upsample(scale_factor=2, mode='bicubic', align_corners=None)
     print(up(input2).shape)
     exit()
     # t = Bidirection(img_size=64, patch_size=1, in_chans=34, embed_dim=32, num_heads=[8, 8, 8], window_size=4).cuda()
     # t = Direction2().cuda()
-    t = Merge().cuda()
+    t = Merge().to(device)
     output = t(input1, input2)
     print(output.shape)
 
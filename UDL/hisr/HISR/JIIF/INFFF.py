@@ -157,10 +157,11 @@ class BF_NIR_conv(nn.Module):
         return output
 
     def train_step(self, batch, *args, **kwargs):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['lrhsi'].cuda(), \
-                           batch['rgb'].cuda()
+        device = next(self.parameters()).device
+        gt, up, hsi, msi = batch['gt'].to(device), \
+                           batch['up'].to(device), \
+                           batch['lrhsi'].to(device), \
+                           batch['rgb'].to(device)
         sr = self(msi, up, hsi)
         loss = self.criterion(sr, gt, *args, **kwargs)
         log_vars = {}
@@ -171,10 +172,11 @@ class BF_NIR_conv(nn.Module):
         return {'loss': loss, 'log_vars': log_vars}
 
     def eval_step(self, batch, *args, **kwargs):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['lrhsi'].cuda(), \
-                           batch['rgb'].cuda()
+        device = next(self.parameters()).device
+        gt, up, hsi, msi = batch['gt'].to(device), \
+                           batch['up'].to(device), \
+                           batch['lrhsi'].to(device), \
+                           batch['rgb'].to(device)
 
         sr1 = self.forward(msi, up, hsi)
 
@@ -192,11 +194,11 @@ class BF_NIR_conv(nn.Module):
 def build(args):
     scheduler = None
     mode = "one"
-    loss1 = nn.L1Loss().cuda()
+    loss1 = nn.L1Loss().to(args.device)
     weight_dict = {'Loss': 1}
     losses = {'Loss': loss1}
     criterion = SetCriterion(losses, weight_dict)
-    model = BF_NIR_conv(128, 128).cuda()
+    model = BF_NIR_conv(128, 128).to(args.device)
     WEIGHT_DECAY = 1e-8  # params of ADAM
 
     num_params = 0
@@ -209,16 +211,17 @@ def build(args):
     return model, criterion, optimizer, scheduler
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     from fvcore.nn import FlopCountAnalysis, flop_count_table
 
-    model = BF_NIR_conv(64, 64).cuda()
+    model = BF_NIR_conv(64, 64).to(device)
 
     B, C, H, W = 1, 31, 64, 64
     scale = 4
 
-    HR_MSI = torch.randn([B, 3, H, W]).cuda()
-    lms = torch.randn([B, C, H, W]).cuda()
-    LR_HSI = torch.randn([B, C, H // scale, W // scale]).cuda()
+    HR_MSI = torch.randn([B, 3, H, W]).to(device)
+    lms = torch.randn([B, C, H, W]).to(device)
+    LR_HSI = torch.randn([B, C, H // scale, W // scale]).to(device)
 
     output = model(HR_MSI, lms, LR_HSI)
     print(output.shape)
@@ -4,12 +4,12 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 
-def grid_generator(k, r, n):
+def grid_generator(k, r, n, device=None):
     grid_x, grid_y = torch.meshgrid([torch.linspace(k//2, k//2+r-1, steps=r),
                                      torch.linspace(k//2, k//2+r-1, steps=r)])
     grid = torch.stack([grid_x,grid_y],2).view(r,r,2)
 
-    return grid.unsqueeze(0).repeat(n,1,1,1).cuda()
+    return grid.unsqueeze(0).repeat(n,1,1,1).to(device)
 
 
 class Kernel_DKN(nn.Module):
@@ -73,7 +73,7 @@ class DKN(nn.Module):
         weight = weight.permute(0,2,3,1).contiguous().view(b*hw, r*r, 1)
         
         # (b*hw, r, r, 2)
-        grid = grid_generator(k, r, b*hw)
+        grid = grid_generator(k, r, b*hw, offset.device)
 
         coord = grid + offset
         coord = (coord / k * 2) -1
@@ -229,7 +229,7 @@ class FDKN(nn.Module):
         weight = weight.permute(0,2,3,1).contiguous().view(b*hw, r*r, 1)
         
         # (b*hw, r, r, 2)
-        grid = grid_generator(k, r, b*hw)
+        grid = grid_generator(k, r, b*hw, offset.device)
         coord = grid + offset
         coord = (coord / k * 2) -1
         
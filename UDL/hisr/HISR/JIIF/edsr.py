@@ -2,6 +2,7 @@
 
 import math
 from argparse import Namespace
+from functools import lru_cache
 
 import torch
 import torch.nn as nn
@@ -25,6 +26,13 @@ def make_coord(shape, ranges=None, flatten=True):
         ret = ret.view(-1, ret.shape[-1])
     return ret
 
+
+@lru_cache(maxsize=16)
+def cached_coord(shape, device, flatten=True):
+    """ make_coord(shape) on device, built once per (shape, device, flatten). Do not modify it in place.
+    """
+    return make_coord(shape, flatten=flatten).to(device)
+
 def default_conv(in_channels, out_channels, kernel_size, bias=True):
     return nn.Conv2d(
         in_channels, out_channels, kernel_size,
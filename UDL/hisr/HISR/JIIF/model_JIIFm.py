@@ -1,6 +1,6 @@
 from torch import optim
 import torch
-from edsr import make_edsr_baseline, make_coord
+from edsr import make_edsr_baseline, cached_coord
 import torch.nn.functional as F
 from UDL.pansharpening.common.evaluate import analysis_accu
 from UDL.Basis.criterion_metrics import *
@@ -25,12 +25,14 @@ class MLP(nn.Module):
 
 
 class JIIF_conv_mean(nn.Module):
-    def __init__(self, feat_dim=128, guide_dim=128, spa_edsr_num=4, spe_edsr_num=4, mlp_dim=[256, 128], NIR_dim=33, lr_hw=(16, 16)):
+    def __init__(self, feat_dim=128, guide_dim=128, spa_edsr_num=4, spe_edsr_num=4, mlp_dim=[256, 128], NIR_dim=33, lr_hw=(16, 16), query_chunk=0):
         super().__init__()
         self.feat_dim = feat_dim
         self.guide_dim = guide_dim
         self.mlp_dim = mlp_dim
         self.NIR_dim = NIR_dim
+        # max rows (query points x 4 shifts) per imnet call, 0: all points at once
+        self.query_chunk = query_chunk
 
         self.spatial_encoder = make_edsr_baseline(n_resblocks=spa_edsr_num, n_feats=self.guide_dim, n_colors=34)
         self.spectral_encoder = make_edsr_baseline(n_resblocks=spe_edsr_num, n_feats=self.feat_dim, n_colors=31)
@@ -50,7 +52,7 @@ class JIIF_conv_mean(nn.Module):
     def query(self, feat, coord, hr_guide, lr_guide):
 
         # feat: [B, C, h, w]
-        # coord: [B, N, 2], N <= H * W
+        # coord: [B, N, 2], the N = H * W centers of the hr grid
 
         b, c, h, w = feat.shape  # lr  7x128x16x16
         _, _, H, W = hr_guide.shape  # hr  7x128x64x64
@@ -59,43 +61,35 @@ class JIIF_conv_mean(nn.Module):
         B, N, _ = coord.shape
 
         # LR centers' coords
-        feat_coord = make_coord((h, w), flatten=False).to(feat.device).permute(2, 0, 1).unsqueeze(0).expand(b, 2, h, w)
+        feat_coord = cached_coord((h, w), feat.device, flatten=False).permute(2, 0, 1).unsqueeze(0).expand(b, 2, h, w)
 
-        q_guide_hr = F.grid_sample(hr_guide, coord.flip(-1).unsqueeze(1), mode='nearest', align_corners=False)[:, :, 0,
-                     :].permute(0, 2, 1)  # [B, N, C]  no influence
+        # nearest sampling of hr_guide at its own pixel centers is hr_guide itself
+        q_guide_hr = hr_guide.flatten(2).permute(0, 2, 1)  # [B, N, C]  no influence
 
-        rx = 1 / h
-        ry = 1 / w
+        # the four neighbour shifts (vx, vy) in (-1, 1) x (-1, 1): [1, 4, 1, 2]
+        shifts = coord.new_tensor([[vx / h, vy / w] for vx in [-1, 1] for vy in [-1, 1]]).view(1, 4, 1, 2)
+        scale = coord.new_tensor([h, w])
 
-        preds = []
+        # the four shifts go through imnet together, N is split so that a call sees at most query_chunk rows
+        chunk = max(1, self.query_chunk // (4 * B)) if self.query_chunk else N
+        rets = []
+        for start in range(0, N, chunk):
+            coord_c = coord[:, start:start + chunk].unsqueeze(1)  # [B, 1, n, 2]
+            n = coord_c.shape[2]
+            coord_ = coord_c + shifts  # [B, 4, n, 2]
 
-        for vx in [-1, 1]:
-            for vy in [-1, 1]:
-                coord_ = coord.clone()
+            # feat: [B, c, h, w], grid: [B, 4, n, 2], out: [B, c, 4, n] --> [B, 4, n, c]
+            q_feat = F.grid_sample(feat, coord_.flip(-1), mode='nearest', align_corners=False).permute(0, 2, 3, 1)
+            q_coord = F.grid_sample(feat_coord, coord_.flip(-1), mode='nearest', align_corners=False).permute(0, 2, 3, 1)
 
-                coord_[:, :, 0] += (vx) * rx
-                coord_[:, :, 1] += (vy) * ry
+            rel_coord = (coord_c - q_coord) * scale
 
-                # feat: [B, c, h, w], coord_: [B, N, 2] --> [B, 1, N, 2], out: [B, c, 1, N] --> [B, c, N] --> [B, N, c]
-                q_feat = F.grid_sample(feat, coord_.flip(-1).unsqueeze(1), mode='nearest', align_corners=False)[:, :, 0,
-                         :].permute(0, 2, 1)  # [B, N, c]
+            inp = torch.cat([q_feat, q_guide_hr[:, start:start + n].unsqueeze(1).expand(B, 4, n, -1), rel_coord], dim=-1)
+            preds = self.imnet(inp.view(B * 4 * n, -1)).view(B, 4, n, -1)  # [B, 4, n, 2]
+            weight = F.softmax(preds[..., -1], dim=1)
+            rets.append((preds[..., 0:-1] * weight.unsqueeze(-1)).sum(1))  # [B, n, NIR_dim-1]
 
-                q_coord = F.grid_sample(feat_coord, coord_.flip(-1).unsqueeze(1), mode='nearest', align_corners=False)[
-                          :, :, 0, :].permute(0, 2, 1)  # [B, N, 2]
-
-
-                rel_coord = coord - q_coord
-                rel_coord[:, :, 0] *= h
-                rel_coord[:, :, 1] *= w
-
-                inp = torch.cat([q_feat, q_guide_hr, rel_coord], dim=-1)
-                pred = self.imnet(inp.view(B * N, -1)).view(B, N, -1)  # [B, N, 2]
-                preds.append(pred)
-
-        preds = torch.stack(preds, dim=-1)  # [B, N, 2, kk]
-        weight = F.softmax(preds[:, :, -1, :], dim=-1)
-        ret = (preds[:, :, 0:-1, :] * weight.unsqueeze(-2)).sum(-1, keepdim=True).squeeze(-1)
-        ret = ret.permute(0, 2, 1).view(b, -1, H, W)
+        ret = torch.cat(rets, dim=1).permute(0, 2, 1).reshape(b, -1, H, W)
 
         return ret
 
@@ -105,7 +99,7 @@ class JIIF_conv_mean(nn.Module):
         # LR_HSI Bx31x16x16
 
         _, _, H, W = HR_MSI.shape
-        coord = make_coord([H, W]).to(HR_MSI.device)
+        coord = cached_coord((H, W), HR_MSI.device)
         feat = torch.cat([HR_MSI, lms], dim=1)
         hr_spa = self.spatial_encoder(feat)  # Bx128xHxW
         lr_spa = self.spatial_encoder_lr(hr_spa)
@@ -145,12 +139,12 @@ def pixel_shuffle_inv(tensor, scale_factor):
 
 
 class JIIF_multiple2(nn.Module):
-    def __init__(self, h, w, m_scale):
+    def __init__(self, h, w, m_scale, query_chunk=0):
         super().__init__()
         self.pool1 = nn.AdaptiveAvgPool2d((h, w))
         self.pool2 = nn.AdaptiveAvgPool2d((h//m_scale, w//m_scale))
-        self.model_1 = JIIF_conv_mean(64, 64, lr_hw=(h, w)).cuda()
-        self.model_2 = JIIF_conv_mean(64, 64, lr_hw=(h//m_scale, w//m_scale)).cuda()
+        self.model_1 = JIIF_conv_mean(64, 64, lr_hw=(h, w), query_chunk=query_chunk)
+        self.model_2 = JIIF_conv_mean(64, 64, lr_hw=(h//m_scale, w//m_scale), query_chunk=query_chunk)
         self.out_conv = torch.nn.Conv2d(62, 31, 1).to('cuda')
 
     def forward(self, HR_MSI, lms, LR_HSI):
@@ -177,10 +171,11 @@ class JIIF_multiple2(nn.Module):
         return output
 
     def train_step(self, batch, *args, **kwargs):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['lrhsi'].cuda(), \
-                           batch['rgb'].cuda()
+        device = next(self.parameters()).device
+        gt, up, hsi, msi = batch['gt'].to(device), \
+                           batch['up'].to(device), \
+                           batch['lrhsi'].to(device), \
+                           batch['rgb'].to(device)
         sr = self(msi, up, hsi)
         loss = self.criterion(sr, gt, *args, **kwargs)
         log_vars = {}
@@ -191,10 +186,11 @@ class JIIF_multiple2(nn.Module):
         return {'loss': loss, 'log_vars': log_vars}
 
     def eval_step(self, batch, *args, **kwargs):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['lrhsi'].cuda(), \
-                           batch['rgb'].cuda()
+        device = next(self.parameters()).device
+        gt, up, hsi, msi = batch['gt'].to(device), \
+                           batch['up'].to(device), \
+                           batch['lrhsi'].to(device), \
+                           batch['rgb'].to(device)
 
         sr1 = self.forward(msi, up, hsi)
 
@@ -212,16 +208,16 @@ class JIIF_multiple2(nn.Module):
 def build(args):
     scheduler = None
     mode = "one"
-    loss1 = nn.L1Loss().cuda()
+    loss1 = nn.L1Loss().to(args.device)
     # weight_dict = {'Loss': 1}
     # losses = {'Loss': loss1}
 
     g_ssim = SSIM(size_average=True)
-    loss2 = g_ssim.cuda()
+    loss2 = g_ssim.to(args.device)
     weight_dict = {'Loss': 1, 'ssim_loss': 0.1}
     losses = {'Loss': loss1, 'ssim_loss': loss2}  # L1+0.1*Lssim
     criterion = SetCriterion(losses, weight_dict)
-    model = JIIF_multiple2(16, 16, 2).cuda()
+    model = JIIF_multiple2(16, 16, 2, query_chunk=args.query_chunk).to(args.device)
     WEIGHT_DECAY = 1e-8  # params of ADAM
 
     num_params = 0
@@ -235,12 +231,13 @@ def build(args):
 
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     B, C, H, W = 1, 31, 128, 128
     scale = 4
 
-    HR_MSI = torch.randn([B, 3, H, W]).cuda()
-    LR_HSI = torch.randn([B, C, H // scale, W // scale]).cuda()
-    lms = torch.randn([B, C, H, W]).cuda()
+    HR_MSI = torch.randn([B, 3, H, W]).to(device)
+    LR_HSI = torch.randn([B, C, H // scale, W // scale]).to(device)
+    lms = torch.randn([B, C, H, W]).to(device)
 
     model = JIIF_multiple2(H//scale, W//scale, 2)
     output = model(HR_MSI, lms, LR_HSI)
@@ -43,6 +43,8 @@ parser.add_argument('--rgb_range', type=int, default=255,
                     help='maximum value of RGB')
 parser.add_argument('--patch_size', type=int, default=1,
                     help='image2patch, set to model and dataset')
+parser.add_argument('--query-chunk', type=int, default=65536,
+                    help='max query points x 4 neighbour shifts per imnet call, 0: all at once')
 
 
 # SRData.py dataset setting
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 from einops import rearrange, repeat
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from math import sqrt
+from UDL.Basis.window_ops import window_partition, window_reverse, ka_window_partition, ka_window_reverse, Win_Shuffle, Win_Reshuffle
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -25,37 +26,6 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
 class Attention(nn.Module):
     """
     Args:
@@ -101,29 +71,6 @@ class Attention(nn.Module):
         return x
     
 
-def ka_window_partition(x, window_size):
-    """
-    input: (B, H*W, C)
-    output: (B, num_windows*C, window_size, window_size)
-    """
-    B, L, C = x.shape
-    H, W = int(sqrt(L)), int(sqrt(L))
-    x = x.reshape(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 5, 2, 4).contiguous().view(B, -1, window_size, window_size)
-    return windows
-
-
-def ka_window_reverse(windows, window_size, H, W):
-    """
-    input: (B, num_windows*C, window_size, window_size)
-    output: (B, H*W, C)
-    """
-    B = windows.shape[0]
-    x = windows.contiguous().view(B, H // window_size, W // window_size, -1, window_size, window_size)
-    x = x.permute(0, 1, 4, 2, 5, 3).contiguous().view(B, H*W, -1)
-    return x
-
-
 class SELayer_KA(nn.Module):
     def __init__(self, channel):
         super().__init__()
@@ -463,67 +410,6 @@ class Window_Attention_Reshuffle(nn.Module):
         x = rearrange(x, 'B (H W) C -> B C H W', H=H)
         return x
 
-def Win_Shuffle(x, win_size):
-    """
-    :param x: B C H W
-    :param win_size:
-    :return: y: B C H W
-    """
-    B, C, H, W = x.shape
-    dilation = win_size // 2
-    resolution = H
-    assert resolution % win_size == 0, 'resolution of input should be divisible'
-    assert win_size % 2 == 0, 'win_size should be the multiple of two'
-    "input size BxCxHxW"
-    "shuffle"
-
-    N1 = H // dilation
-    N2 = W // dilation
-    x = rearrange(x, 'B C H W -> B H W C')
-    x = window_partition(x, dilation)  # BN x d x d x c
-    x = x.reshape(-1, N1, N2, C * dilation ** 2)  # B x n x n x d2c
-    xt = torch.zeros_like(x)
-    x0 = x[:, 0::2, 0::2, :]  # B n/2 n/2 d2c
-    x1 = x[:, 0::2, 1::2, :]  # B n/2 n/2 d2c
-    x2 = x[:, 1::2, 0::2, :]  # B n/2 n/2 d2c
-    x3 = x[:, 1::2, 1::2, :]  # B n/2 n/2 d2c
-
-    xt[:, 0:N1 // 2, 0:N2 // 2, :] = x0  # B n/2 n/2 d2c
-    xt[:, 0:N1 // 2, N2 // 2:N2, :] = x1  # B n/2 n/2 d2c
-    xt[:, N1 // 2:N1, 0:N2 // 2, :] = x2  # B n/2 n/2 d2c
-    xt[:, N1 // 2:N1, N2 // 2:N2, :] = x3  # B n/2 n/2 d2c
-    xt = xt.reshape(-1, dilation, dilation, C)
-    xt = window_reverse(xt, dilation, H, W)
-    xt = rearrange(xt, 'B H W C -> B C H W')
-
-    return xt
-
-def Win_Reshuffle(x, win_size):
-    """
-        :param x: B C H W
-        :param win_size:
-        :return: y: B C H W
-        """
-    B, C, H, W = x.shape
-    dilation = win_size // 2
-    N1 = H // dilation
-    N2 = W // dilation
-    assert H % win_size == 0, 'resolution of input should be divisible'
-    assert win_size % 2 == 0, 'win_size should be the multiple of two'
-
-    x = rearrange(x, 'B C H W -> B H W C')
-    x = window_partition(x, dilation)  # BN x d x d x c
-    x = x.reshape(-1, N1, N2, C * dilation ** 2)  # B x n x n x d2c
-    xt = torch.zeros_like(x)
-    xt[:, 0::2, 0::2, :] = x[:, 0:N1// 2, 0:N2 // 2, :]  # B n/2 n/2 d2c
-    xt[:, 0::2, 1::2, :] = x[:, 0:N1 // 2, N2 // 2:N2, :]  # B n/2 n/2 d2c
-    xt[:, 1::2, 0::2, :] = x[:, N1 // 2:N1, 0:N2 // 2, :]  # B n/2 n/2 d2c
-    xt[:, 1::2, 1::2, :] = x[:, N1 // 2:N1, N2 // 2:N2, :]  # B n/2 n/2 d2c
-    xt = xt.reshape(-1, dilation, dilation, C)
-    xt = window_reverse(xt, dilation, H, W)
-    xt = rearrange(xt, 'B H W C -> B C H W')
-
-    return xt
 
 class SaR_Block(nn.Module):
     def __init__(self, img_size=64, in_chans=32, head=8, win_size=4, norm_layer=nn.LayerNorm):
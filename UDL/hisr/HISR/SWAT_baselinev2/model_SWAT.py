@@ -93,10 +93,10 @@ class SWATnet(PatchMergeModule):
         return ' SWAT'
 
     def train_step(self, batch, *args, **kwargs):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['lrhsi'].cuda(), \
-                           batch['rgb'].cuda()
+        gt, up, hsi, msi = batch['gt'].to(self.args.device), \
+                           batch['up'].to(self.args.device), \
+                           batch['lrhsi'].to(self.args.device), \
+                           batch['rgb'].to(self.args.device)
         # x = torch.cat((up, msi), 1)
         sr = self(gt, msi, up)
         loss = self.criterion(sr, gt, *args, **kwargs)
@@ -108,10 +108,10 @@ class SWATnet(PatchMergeModule):
         return {'loss': loss , 'log_vars': log_vars}
 
     def eval_step(self, batch):
-        gt, up, hsi, msi = batch['gt'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['up'].cuda(), \
-                           batch['rgb'].cuda()
+        gt, up, hsi, msi = batch['gt'].to(self.args.device), \
+                           batch['up'].to(self.args.device), \
+                           batch['up'].to(self.args.device), \
+                           batch['rgb'].to(self.args.device)
         # batch['lrhsi'].cuda(), \
         print(gt.shape)
         print(up.shape)
@@ -135,14 +135,14 @@ def build(args):
     scale = 2
     mode = "one"
     g_ssim = SSIM(size_average=True)
-    loss1 = nn.L1Loss().cuda()
-    loss2 = g_ssim.cuda()
+    loss1 = nn.L1Loss().to(args.device)
+    loss2 = g_ssim.to(args.device)
     weight_dict = {'Loss': 1, 'ssim_loss': 0.1}
     losses = {'Loss': loss1, 'ssim_loss': loss2}
     criterion = SetCriterion(losses, weight_dict)
-    model = SWATnet(args).cuda()
+    model = SWATnet(args).to(args.device)
     num_params = 0
-    for param in SWATnet(args).parameters():
+    for param in model.parameters():
         num_params += param.numel()
     print('[Network %s] Total number of parameters : %.3f M' % ('SWAT', num_params / 1e6))
     model.set_metrics(criterion)
@@ -9,6 +9,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
+from UDL.Basis.module import get_relative_position_bias, RelativePositionBiasCache, kernel_bank_conv2d, window_attention
+from UDL.Basis.window_ops import window_partition, window_reverse, ka_window_partition, ka_window_reverse
 
 
 class Mlp(nn.Module):
@@ -30,39 +32,7 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
-
-class WindowAttention(nn.Module):
+class WindowAttention(RelativePositionBiasCache, nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
 
@@ -121,25 +91,10 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        relative_position_bias = get_relative_position_bias(self)  # nH, Wh*Ww, Wh*Ww, reused in eval
+        x = window_attention(q, k, v, self.scale, bias=relative_position_bias, mask=mask,
+                             dropout_p=self.attn_drop.p if self.training else 0.)
+        x = x.transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -148,29 +103,6 @@ class WindowAttention(nn.Module):
         return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
     
 
-def ka_window_partition(x, window_size):
-    """
-    input: (B, H*W, C)
-    output: (B, num_windows*C, window_size, window_size)
-    """
-    B, L, C = x.shape
-    H, W = int(math.sqrt(L)), int(math.sqrt(L))
-    x = x.reshape(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 5, 2, 4).contiguous().view(B, -1, window_size, window_size)
-    return windows
-
-
-def ka_window_reverse(windows, window_size, H, W):
-    """
-    input: (B, num_windows*C, window_size, window_size)
-    output: (B, H*W, C)
-    """
-    B = windows.shape[0]
-    x = windows.contiguous().view(B, H // window_size, W // window_size, -1, window_size, window_size)
-    x = x.permute(0, 1, 4, 2, 5, 3).contiguous().view(B, H*W, -1)
-    return x
-
-
 class SELayer_KA(nn.Module):
     def __init__(self, channel):
         super().__init__()
@@ -224,9 +156,6 @@ class WinKernel_Reweight(nn.Module):
         # kernels:  1, win_num, c, c, k, k
         kernels = kernels.reshape(self.win_num, self.dim, self.dim, kernels.shape[-2], kernels.shape[-1]).unsqueeze(0)
 
-        # kernels:  bs, win_num, c, c, k, k
-        kernels = kernels.repeat(B, 1, 1, 1, 1, 1)
-
         # kernels:  bs, win_num, c, c, k, k
         kernels = weight * kernels
 
@@ -300,7 +229,9 @@ class KernelAttention(nn.Module):
         self.kernel_size = kernel_size
 
         self.scale = qk_scale or (dim//num_heads) ** (-0.5)
-        self.window_size = int(input_resolution // math.sqrt(ka_win_num))
+        # the windows form a fixed win_grid x win_grid layout, their size follows the input at forward
+        self.win_grid = int(math.sqrt(ka_win_num))
+        self.window_size = int(input_resolution // self.win_grid)
 
         self.num_layers = self.win_num
         self.convlayer1 = ConvLayer(dim, kernel_size, stride, padding, groups=ka_win_num, k_in=False)
@@ -310,15 +241,18 @@ class KernelAttention(nn.Module):
         self.fusion = nn.Conv2d((self.win_num+1)*self.dim, self.dim, kernel_size=1, stride=1, padding=0)
 
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         """
-        x: B, L, C
+        x: B, L, C with L = H*W (default input_resolution x input_resolution)
         """
         B, L, C = x.shape
-        H, W = self.input_resolution, self.input_resolution
+        if H is None:
+            H, W = self.input_resolution, self.input_resolution
+        assert H % self.win_grid == 0 and W % self.win_grid == 0, \
+            f"input size {(H, W)} is not divisible into {self.win_grid}x{self.win_grid} kernel windows"
 
         # x_windows:  bs, win_num*c, wh, ww
-        x_windows = ka_window_partition(x, self.window_size)
+        x_windows = ka_window_partition(x, (H // self.win_grid, W // self.win_grid), H, W)
 
         # windows_conv1:  bs, win_num*c, wh, ww
         # kernels:  win_num*c, c, k_size, k_size
@@ -343,31 +277,18 @@ class KernelAttention(nn.Module):
         # kernels:  bs, win_num, c, c, k_size, k_size
         kernels = kernels.reshape(B, self.dim, self.win_num, self.dim, self.kernel_size, self.kernel_size).transpose(1, 2)
 
-        # kernels:  bs, win_num+1, c, c, k_size, k_size
-        kernels = torch.cat([kernels, global_kernel], dim=1)
-
-        # kernels:  bs*(win_num+1)*c, c, k_size, k_size
-        kernels = kernels.reshape(-1, self.dim, self.kernel_size, self.kernel_size)
+        # kernels:  bs, (win_num+1)*c, c, k_size, k_size
+        kernels = torch.cat([kernels, global_kernel], dim=1).flatten(1, 2)
 
 
         ### 卷积核与输入特征计算卷积
         # x:  bs, c, h, w
         x = x.reshape(B, H, W, C).permute(0, 3, 1, 2)
 
-        # x:  bs, (win_num+1)*c, h, w
-        x = x.repeat(1, self.win_num+1, 1, 1)
-
-        # x:  1, bs*(win_num+1)*c, h, w
-        x = x.reshape(1, B*(self.win_num+1)*C, H, W)
-
-        # x:  1, bs*(win_num+1)*c, h, w
-        x, _ = self.convlayer2(x, kernels, groups=B*(self.win_num+1))
-        
-        # x:  bs, (win_num+1)*c, h, w
-        x = x.reshape(B, (self.win_num+1)*C, H, W)
-
+        # the 1x1 fusion is folded into the kernel bank, x is convolved once instead of once per window
         # x:  bs, c, h, w
-        x = self.fusion(x)
+        x = kernel_bank_conv2d(x, kernels, self.fusion.weight, self.fusion.bias,
+                               stride=self.convlayer2.stride, padding=self.convlayer2.padding)
 
         # x:  bs, h*w, c
         x = x.permute(0, 2, 3, 1).reshape(B, H*W, C)
@@ -452,7 +373,7 @@ class SwinTransformerBlock(nn.Module):
         
         # Kernel Attention
         x_ka = x_ka.view(B, L, C//2)
-        x_ka = self.kernelattention(x_ka)
+        x_ka = self.kernelattention(x_ka, H, W)
 
 
         # Window Attention
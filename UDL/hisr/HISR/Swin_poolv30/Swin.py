@@ -14,6 +14,8 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from einops import rearrange, repeat
 from math import sqrt
 import torch.nn.functional as F
+from UDL.Basis.module import dynamic_depthwise_conv2d, window_attention
+from UDL.Basis.window_ops import window_partition, window_reverse, pad_feature_map
 
 
 class Mlp(nn.Module):
@@ -35,37 +37,6 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -107,20 +78,8 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N).cuda() + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(q, k, v, self.scale, mask=mask, dropout_p=self.attn_drop.p if self.training else 0.)
+        x = x.transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -142,23 +101,6 @@ class WindowAttention(nn.Module):
         return flops
     
 
-def pad_feature_map(input, window_size=8):
-    _, L, C = input.size()
-    H, W = int(math.sqrt(L)), int(math.sqrt(L))
-    input = input.reshape(-1, H, W, C).permute(0, 3, 1, 2)
-    
-    # 计算要添加的上下左右 padding
-    pad_h = (window_size - (H % window_size)) % window_size
-    pad_w = (window_size - (W % window_size)) % window_size
-    
-    # 进行 padding
-    padded_feature_map = torch.nn.functional.pad(input, (0, pad_w, 0, pad_h), 'constant', 0)
-
-    output = padded_feature_map.permute(0, 2, 3, 1).reshape(-1, (H+pad_h)*(W+pad_w), C)
-    
-    return output
-
-
 class WinKernel_Reweight(nn.Module):
     def __init__(self, dim, nW=4):
         super().__init__()
@@ -184,7 +126,7 @@ class WinKernel_Reweight(nn.Module):
         win_weight = self.pooling(windows)
 
         # win_weight:  bs, nW
-        win_weight = self.downchannel(win_weight).squeeze()
+        win_weight = self.downchannel(win_weight).flatten(1)
 
         win_weight = self.linear1(win_weight)
         win_weight = self.gelu(win_weight)
@@ -215,11 +157,12 @@ class ConvLayer(nn.Module):
         self.padding = padding
         self.kernels_num = kernels_num
 
-    def forward(self, x, kernels, B):
-
-        G = B * self.kernels_num * self.dim
-        x = F.conv2d(x, kernels, stride=self.stride, padding=self.padding, groups=G)
-        return x
+    def forward(self, x, kernels, reduce=None):
+        '''
+        x:  B, C, H, W
+        kernels:  B, kernels_num, C, k_size, k_size
+        '''
+        return dynamic_depthwise_conv2d(x, kernels, stride=self.stride, padding=self.padding, reduce=reduce)
 
 class Fusion(nn.Module):
     def __init__(self, dim, n, act_layer=nn.GELU):
@@ -246,7 +189,7 @@ class Fusion(nn.Module):
 
         feats = self.act_layer(feats.permute(0, 2, 3, 1)).permute(0, 3, 1, 2) #[B, n*dim, H, W]
         feats = self.gap(feats) #[B, n*dim, 1, 1]
-        feats = self.fc1(feats.squeeze()) #[B, dim]
+        feats = self.fc1(feats.flatten(1)) #[B, dim]
         feats = self.act_layer(feats) #[B, d]
         attention_vectors = self.fc2(feats) #[B, n*dim]
         attention_vectors = attention_vectors.view(B, self.n, self.dim, 1, 1)
@@ -352,32 +295,15 @@ class WindowInterAttention(nn.Module):
 
 
         ### 三个全局卷积核和原图做卷积
-        # x:  B, 2*C, H, W
-        x = x.permute(0, 3, 1, 2).repeat(1, 2, 1, 1)
-
-        # x:  1, B*2*C, H, W
-        x = x.reshape(1, B*self.kernels_num*C, H, W)
-
-        # global_kernels:  B, 2*C, k_size, k_size
-        global_kernels = torch.cat([global_kernel_fusion, global_kernel_sum], dim=1)
-
-        # global_kernels:  B*2*C, 1, k_size, k_size
-        global_kernels = global_kernels.reshape(B*self.kernels_num*C, 1, self.k_size, self.k_size)
-
-        # x:  1, B*2*C, H, W
-        x = self.convlayer(x, global_kernels, B)
-        
-        # # x:  B, 2*C, H, W
-        # x = x.reshape(B, self.kernels_num, C, H, W).transpose(1, 2).reshape(B, C*self.kernels_num, H, W)
-
-        # # x:  B, C, H, W
-        # x = self.fusion(x)
+        # x:  B, C, H, W
+        x = x.permute(0, 3, 1, 2)
 
-        # x:  B, 2, C, H, W
-        x = x.reshape(B, self.kernels_num, C, H, W)
+        # global_kernels:  B, 2, C, k_size, k_size
+        global_kernels = torch.cat([global_kernel_fusion, global_kernel_sum], dim=1).squeeze(3)
 
+        # the two responses are summed, so the kernels are summed and x is convolved once
         # x:  B, C, H, W
-        x = torch.sum(x, dim=1).reshape(B, C, H, W)
+        x = self.convlayer(x, global_kernels, reduce='sum')
 
         # x:  B, C, H, W
         x = self.proj_out(x)
@@ -454,15 +380,14 @@ class SwinTransformerBlock(nn.Module):
                     img_mask[:, h, w, :] = cnt
                     cnt += 1
 
-            mask_windows = window_partition(img_mask, self.window_size).cuda()  # nW, window_size, window_size, 1
+            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
             mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
             attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
             attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
         else:
             attn_mask = None
 
-        self.attn_mask = attn_mask
-        # self.register_buffer("attn_mask", attn_mask)
+        self.register_buffer("attn_mask", attn_mask, persistent=False)
 
         if self.shift_size == 0:
             self.window_inter_attn = WindowInterAttention(input_resolution, dim=dim, ka_win_num=16, k_size=3, k_stride=1, k_padding=1, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop)
@@ -706,10 +631,11 @@ class T(nn.Module):
         return x
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     from UDL.Basis.auxiliary.torchstat.statistics import stat
 
-    input = torch.randn(32, 34, 64, 64).cuda()
-    t = T(img_size=64, patch_size=1, in_chans=34, embed_dim=32, depths=[2, 4], num_heads=[8, 8], window_size=4).cuda()
+    input = torch.randn(32, 34, 64, 64).to(device)
+    t = T(img_size=64, patch_size=1, in_chans=34, embed_dim=32, depths=[2, 4], num_heads=[8, 8], window_size=4).to(device)
     output = t(input)
     print(output.shape)
     out = stat(t, input_size=[[1, 34, 64, 64]])
@@ -28,5 +28,38 @@ class DatasetFromHdf5(data.Dataset):
                 'rgb': torch.from_numpy(self.RGB[index, :, :, :]).float()}
         #####必要函数
 
+    def sample_shape(self, index):
+        return self.GT.shape[1:]
+
     def __len__(self):
         return self.GT.shape[0]
+
+
+class SyntheticHISRDataset(data.Dataset):
+    """Random smooth HSI/RGB pairs with the same keys as DatasetFromHdf5, for cpu smoke runs and sweeps."""
+
+    def __init__(self, num=16, bands=31, size=64, scale=4, seed=0):
+        super(SyntheticHISRDataset, self).__init__()
+        self.num = num
+        self.bands = bands
+        self.size = size
+        self.scale = scale
+        self.seed = seed
+        g = torch.Generator().manual_seed(seed)
+        # fixed spectral response used to render the rgb image
+        self.srf = torch.softmax(torch.randn(3, bands, generator=g), dim=1)
+
+    def __getitem__(self, index):
+        g = torch.Generator().manual_seed(self.seed * 100003 + index)
+        gt = torch.rand(1, self.bands, self.size // 8, self.size // 8, generator=g)
+        gt = torch.nn.functional.interpolate(gt, size=(self.size, self.size), mode='bilinear', align_corners=False)
+        lrhsi = torch.nn.functional.avg_pool2d(gt, self.scale)
+        up = torch.nn.functional.interpolate(lrhsi, scale_factor=self.scale, mode='bilinear', align_corners=False)
+        rgb = torch.einsum('kc,bchw->bkhw', self.srf, gt)
+        return {'gt': gt[0], 'up': up[0], 'lrhsi': lrhsi[0], 'rgb': rgb[0]}
+
+    def sample_shape(self, index):
+        return (self.bands, self.size, self.size)
+
+    def __len__(self):
+        return self.num
@@ -0,0 +1,287 @@
+"""
+Multi-process cpu evaluation of HISR checkpoints.
+
+The test set of every checkpoint is split into ``--shards`` strided shards and each (checkpoint, shard) pair runs
+in its own subprocess. ``--workers`` subprocesses run at a time, each pinned to its own block of cores with as
+many intra-op threads. Per-image metrics and outputs are merged back in dataset order, so the summary of a
+checkpoint is the one of a serial eval with --eval-batch-size 1. A directory of ``{epoch}.pth.tar`` files is
+scored checkpoint by checkpoint in parallel.
+
+usage:
+    python -m UDL.hisr.common.eval_hisr --variant SWATv4 --checkpoints results/cave_x4/SWATv4 --workers 8
+    python -m UDL.hisr.common.eval_hisr --variant PSRT --checkpoints results/PSRT/1000.pth.tar --workers 4 \
+        --override tile_size=128 --result-format npy --out results/eval_psrt
+    # cpu smoke run on synthetic data
+    python -m UDL.hisr.common.eval_hisr --variant PSRT --checkpoints '' --dataset synthetic --workers 2 \
+        --override synthetic_num=16
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import importlib
+import inspect
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from UDL.hisr.common.sweep_hisr import variant_modules, _parse_value, REPO_ROOT
+
+FIELDS = ['checkpoint', 'epoch', 'images', 'SAM', 'ERGAS', 'PSNR', 'time(s)', 'status', 'results']
+
+
+def find_checkpoints(paths):
+    """Checkpoint files of ``paths`` (files or directories of *.pth.tar), ``{epoch}.pth.tar`` in epoch order first.
+    An empty path evaluates the builder's initial weights."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(os.path.join(path, '*.pth.tar'))
+            if not found:
+                raise ValueError(f"no *.pth.tar checkpoints in --checkpoints directory {path}")
+            epochs = {f: re.match(r'(\d+)\.pth\.tar$', os.path.basename(f)) for f in found}
+            files += sorted(found, key=lambda f: (epochs[f] is None, int(epochs[f].group(1)) if epochs[f] else 0, f))
+        else:
+            files.append(path)
+    return files
+
+
+def _epoch(checkpoint):
+    m = re.match(r'(\d+)\.pth\.tar$', os.path.basename(checkpoint))
+    return int(m.group(1)) if m else None
+
+
+################################################################################
+# shard process: evaluate the images of one shard, write shard<k>.pt
+################################################################################
+def eval_shard(spec):
+    import torch
+    from torch.utils.data import DataLoader, Subset
+    from UDL.Basis.auxiliary import set_random_seed
+    from UDL.Basis.framework import load_checkpoint
+    from UDL.Basis.module import enable_tiled_inference, enable_half_inference
+    from UDL.Basis.memory_plan import enable_planned_inference
+    from UDL.hisr.common.hisr_dataset import HISRSession
+
+    if spec['cores'] and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, spec['cores'])
+    torch.set_num_threads(spec['threads'])
+    option_module, model_module = variant_modules(spec['variant'])
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        args = importlib.import_module(option_module).cfg
+    finally:
+        sys.argv = argv
+    build = importlib.import_module(model_module).build
+    for k, v in spec['overrides'].items():
+        setattr(args, k, v)
+    args.dataset = spec['dataset']
+    args.device = 'cpu'
+    args.resume = spec['checkpoint']
+    args.launcher, args.distributed, args.mode = 'none', False, 'none'
+    args.global_rank = args.local_rank = 0
+    args.amp = None
+    args.use_log = args.use_tb = False
+    set_random_seed(args.seed)
+
+    model = build(args)[0].to('cpu')
+    model, _ = load_checkpoint(args, model, None)
+    model.eval()
+    if args.eval_memory_mb > 0 or args.band_chunk > 0:
+        enable_planned_inference(model, args)
+    elif args.tile_size > 0:
+        enable_tiled_inference(model, args)
+    if args.eval_precision != 'fp32':
+        enable_half_inference(model, args)
+    dataset = HISRSession(args).get_eval_dataloader(args.dataset, False)[0].dataset
+    loader = DataLoader(Subset(dataset, spec['indices']), batch_size=1)
+
+    metrics, outputs = [], []
+    with torch.no_grad():
+        for batch in loader:
+            sr, m = model.eval_step(batch)
+            # what MetricLogger.update_dict logs
+            metrics.append({k: torch.mean(v).item() if isinstance(v, torch.Tensor) else v for k, v in m.items()})
+            outputs.append(sr[0].detach().float().cpu())
+    torch.save({'indices': spec['indices'], 'metrics': metrics, 'outputs': outputs}, spec['result'])
+
+
+def shard_main(spec_file):
+    with open(spec_file) as f:
+        spec = json.load(f)
+    try:
+        eval_shard(spec)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+################################################################################
+# launcher
+################################################################################
+class ShardedEval():
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.checkpoints = find_checkpoints(cfg.checkpoints)
+        if not self.checkpoints:
+            raise ValueError("--checkpoints is empty, pass '' to evaluate the initial weights")
+        self.overrides = {k: _parse_value(v) for k, v in (kv.split('=', 1) for kv in cfg.override)}
+        cores = cfg.cores or sorted(os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else
+                                    range(os.cpu_count()))
+        if cfg.workers > len(cores):
+            raise ValueError(f"--workers {cfg.workers} needs at least as many cores, got {len(cores)}")
+        per_worker = len(cores) // cfg.workers
+        self.cores = [cores[i * per_worker:(i + 1) * per_worker] for i in range(cfg.workers)]
+        self.threads = cfg.threads or per_worker
+        self.shards = cfg.shards or max(1, cfg.workers // len(self.checkpoints))
+
+    def ckpt_dir(self, checkpoint):
+        name = os.path.basename(checkpoint).replace('.pth.tar', '') or 'init'
+        return os.path.abspath(os.path.join(self.cfg.out, name))
+
+    def spec(self, checkpoint, shard, slot):
+        cfg = self.cfg
+        out = self.ckpt_dir(checkpoint)
+        os.makedirs(out, exist_ok=True)
+        spec = {'variant': cfg.variant, 'overrides': self.overrides, 'dataset': cfg.dataset,
+                'checkpoint': os.path.abspath(checkpoint) if checkpoint else '',
+                'indices': list(range(shard, self.num_images, self.shards)),
+                'cores': self.cores[slot], 'threads': self.threads,
+                'result': os.path.join(out, f"shard{shard}.pt")}
+        with open(os.path.join(out, f"shard{shard}.spec.json"), 'w') as f:
+            json.dump(spec, f, indent=2)
+        return spec
+
+    def launch(self, checkpoint, shard, slot):
+        spec = self.spec(checkpoint, shard, slot)
+        out = self.ckpt_dir(checkpoint)
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads), MKL_NUM_THREADS=str(self.threads),
+                   PYTHONPATH=os.pathsep.join([REPO_ROOT, os.environ.get('PYTHONPATH', '')]))
+        log = open(os.path.join(out, f"shard{shard}.log"), 'w')
+        proc = subprocess.Popen([sys.executable, '-m', 'UDL.hisr.common.eval_hisr', '--shard',
+                                 os.path.join(out, f"shard{shard}.spec.json")],
+                                stdout=log, stderr=subprocess.STDOUT, env=env, cwd=REPO_ROOT)
+        proc.log, proc.slot, proc.start = log, slot, time.time()
+        return proc
+
+    def count_images(self):
+        from UDL.hisr.common.hisr_dataset import HISRSession
+        option_module, _ = variant_modules(self.cfg.variant)
+        argv, sys.argv = sys.argv, sys.argv[:1]
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                args = importlib.import_module(option_module).cfg
+        finally:
+            sys.argv = argv
+        for k, v in self.overrides.items():
+            setattr(args, k, v)
+        args.device, args.dataset = 'cpu', self.cfg.dataset
+        return len(HISRSession(args).get_eval_dataloader(args.dataset, False)[0].dataset)
+
+    def merge(self, checkpoint, failed):
+        """Summary row of a checkpoint, the outputs are written in dataset order through ResultWriter."""
+        import torch
+        from UDL.Basis.auxiliary import MetricLogger
+        from UDL.Basis.result_writer import ResultWriter, RESULT_EXTENSIONS
+        out = self.ckpt_dir(checkpoint)
+        row = {'checkpoint': checkpoint or 'init', 'epoch': _epoch(checkpoint) if checkpoint else None}
+        if failed:
+            row['status'] = f"failed shards {sorted(failed)}, see {out}/shard<k>.log"
+            return row
+        # outputs stay on disk until ResultWriter copies them, mmap loading needs torch >= 2.1
+        mmap = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters else {}
+        shards = [torch.load(os.path.join(out, f"shard{k}.pt"), weights_only=False, **mmap)
+                  for k in range(self.shards)]
+        order = sorted((index, k, i) for k, s in enumerate(shards) for i, index in enumerate(s['indices']))
+        metric_logger = MetricLogger(delimiter="  ")
+        results = os.path.join(out, f"{self.cfg.variant}_{self.cfg.dataset}{RESULT_EXTENSIONS[self.cfg.result_format]}")
+        with ResultWriter(results, self.cfg.result_format, num=len(order)) as writer:
+            for index, k, i in order:
+                metric_logger.update_dict(shards[k]['metrics'][i])
+                writer.put(index, shards[k]['outputs'][i])
+        row.update({k: meter.avg for k, meter in metric_logger.meters.items()})
+        row.update(images=len(order), status='ok', results=results)
+        with open(os.path.join(out, 'metrics.json'), 'w') as f:
+            json.dump([shards[k]['metrics'][i] for _, k, i in order], f)
+        return row
+
+    def run(self):
+        cfg = self.cfg
+        self.num_images = self.count_images()
+        jobs = [(c, s) for c in self.checkpoints for s in range(self.shards)]
+        left = {c: self.shards for c in self.checkpoints}
+        failed = {c: set() for c in self.checkpoints}
+        start = {}
+        rows, procs, free = {}, {}, list(range(cfg.workers))
+        while jobs or procs:
+            while free and jobs:
+                checkpoint, shard = jobs.pop(0)
+                start.setdefault(checkpoint, time.time())
+                procs[checkpoint, shard] = self.launch(checkpoint, shard, free.pop(0))
+            time.sleep(cfg.poll)
+            for (checkpoint, shard), proc in list(procs.items()):
+                if proc.poll() is None:
+                    continue
+                proc.log.close()
+                del procs[checkpoint, shard]
+                free.append(proc.slot)
+                if proc.returncode != 0:
+                    failed[checkpoint].add(shard)
+                left[checkpoint] -= 1
+                if left[checkpoint] == 0:
+                    row = self.merge(checkpoint, failed[checkpoint])
+                    row['time(s)'] = round(time.time() - start[checkpoint], 1)
+                    print(f"{row['checkpoint']}: " + "  ".join(f"{k} {row[k]:.4f}" for k in ('SAM', 'ERGAS', 'PSNR')
+                                                              if k in row) + f" ({row['status']})")
+                    rows[checkpoint] = row
+                    self.write_table(rows)
+        return [rows[c] for c in self.checkpoints]
+
+    def write_table(self, rows):
+        rows = [rows[c] for c in self.checkpoints if c in rows]
+        with open(os.path.join(self.cfg.out, 'summary.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def eval_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='Multi-process cpu evaluation of HISR checkpoints')
+    parser.add_argument('--shard', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--variant', default=None, type=str, help='directory under UDL/hisr/HISR')
+    parser.add_argument('--checkpoints', nargs='*', default=[''],
+                        help="checkpoint files or directories of {epoch}.pth.tar, '' for the initial weights")
+    parser.add_argument('--override', nargs='*', default=[], help='option=value, e.g. tile_size=128')
+    parser.add_argument('--dataset', default='cave_x4', type=str)
+    parser.add_argument('--workers', default=1, type=int, help='processes running at the same time, at most one per core')
+    parser.add_argument('--shards', default=0, type=int,
+                        help='shards of the test set per checkpoint, default workers / checkpoints')
+    parser.add_argument('--cores', nargs='*', default=[], type=int,
+                        help='cpu cores split into one block per worker, default the affinity of this process')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op threads per worker, default its cores')
+    parser.add_argument('--result-format', default='mat', choices=['mat', 'mat73', 'h5', 'npy'])
+    parser.add_argument('--poll', default=0.5, type=float)
+    parser.add_argument('--out', default='results/eval', type=str)
+    cfg = parser.parse_args(argv)
+    if cfg.shard is None and cfg.variant is None:
+        parser.error('--variant is required')
+    return cfg
+
+
+def main(argv=None):
+    cfg = eval_cfg(argv)
+    if cfg.shard is not None:
+        return shard_main(cfg.shard)
+    os.makedirs(cfg.out, exist_ok=True)
+    rows = ShardedEval(cfg).run()
+    print(f"summary in {os.path.join(cfg.out, 'summary.csv')}")
+    return rows
+
+
+if __name__ == '__main__':
+    main()
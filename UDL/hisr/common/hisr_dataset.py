@@ -12,8 +12,9 @@ import matplotlib.pyplot as plt
 from torch.utils.data import DataLoader
 import math
 import torch.nn as nn
-from UDL.hisr.common.dataUPHSI import DatasetFromHdf5
+from UDL.hisr.common.dataUPHSI import DatasetFromHdf5, SyntheticHISRDataset
 from UDL.derain.common.data.common import resize_image
+from UDL.Basis.dist_utils import ResumableSampler, ShapeBucketBatchSampler
 import h5py
 # cv2.setNumThreads(1)
 
@@ -124,20 +125,25 @@ class HISRSession():
                     '/'.join([self.args.data_dir, f'/{dataset_name}', 'train_Chikusei.h5']))
         elif dataset_name == 'pavia_x4':
             dataset = DatasetFromHdf5('/'.join([self.args.data_dir, f'/{dataset_name}', 'Pavia-train64(double_max_normalization).h5']))
+        elif dataset_name == 'synthetic':
+            dataset = self.synthetic_dataset(split=0)
 
         else:
             print(f"{dataset_name} is not supported.")
             raise NotImplementedError
         # dataset = TestDataset(dataset_name)
-        sampler = None
-        if distributed:
-            sampler = torch.utils.data.distributed.DistributedSampler(dataset)
+        # the shuffle order only depends on (seed, epoch), so a run can be resumed in the middle of an epoch
+        sampler = ResumableSampler(dataset, seed=self.args.seed)
 
         if not dataset_name in self.dataloaders:
+            # own generator: creating the loader iterator must not consume the global torch RNG
             self.dataloaders[dataset_name] = \
                 DataLoader(dataset, batch_size=self.samples_per_gpu,
                            persistent_workers=(True if self.workers_per_gpu > 0 else False),
-                           shuffle=(sampler is None), num_workers=self.workers_per_gpu, drop_last=False, sampler=sampler)
+                           num_workers=self.workers_per_gpu, drop_last=False, sampler=sampler,
+                           generator=torch.Generator().manual_seed(self.args.seed))
+        else:
+            sampler = self.dataloaders[dataset_name].sampler
 
         return self.dataloaders[dataset_name], sampler
 
@@ -160,17 +166,22 @@ class HISRSession():
                     '/'.join([self.args.data_dir, f'/{dataset_name}', 'train_Chikusei.h5']))
         elif dataset_name == 'pavia_x4':
             dataset = DatasetFromHdf5('/'.join([self.args.data_dir, f'/{dataset_name}', 'Pavia-validation64(double_max_normalization).h5']))
-        dataset = TrainValDataset(dataset_name, self.patch_size)
+        elif dataset_name == 'synthetic':
+            dataset = self.synthetic_dataset(split=1)
+        else:
+            print(f"{dataset_name} is not supported.")
+            raise NotImplementedError
         sampler = None
         if distributed:
-            sampler = torch.utils.data.distributed.DistributedSampler(dataset)
+            sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=False)
 
-        if not dataset_name in self.dataloaders:
-            self.dataloaders[dataset_name] = \
+        # the training loader is cached under dataset_name as well
+        if not f"{dataset_name}_val" in self.dataloaders:
+            self.dataloaders[f"{dataset_name}_val"] = \
                 DataLoader(dataset, batch_size=self.samples_per_gpu,
                            shuffle=False, num_workers=self.workers_per_gpu, drop_last=False, sampler=sampler)
 
-        return self.dataloaders[dataset_name], sampler
+        return self.dataloaders[f"{dataset_name}_val"], sampler
 
     def get_eval_dataloader(self, dataset_name, distributed):
         # global data_dir
@@ -187,20 +198,31 @@ class HISRSession():
             dataset = DatasetFromHdf5('/'.join([self.args.data_dir, f'/{dataset_name}', 'test_Chikusei.h5']))
         elif dataset_name == 'pavia_x4':
             dataset = DatasetFromHdf5('/'.join([self.args.data_dir, f'/{dataset_name}', 'Pavia-test256(double_max_normalization).h5']))
+        elif dataset_name == 'synthetic':
+            dataset = self.synthetic_dataset(split=2)
 
         else:
             print(f"{dataset_name} is not supported.")
             raise NotImplementedError
 
-        sampler = None
-        if distributed:
-            sampler = torch.utils.data.distributed.DistributedSampler(dataset)
+        # same-shape scenes are batched together, eval_framework restores the original order
+        batch_sampler = ShapeBucketBatchSampler(dataset, self.args.eval_batch_size,
+                                                self.args.eval_budget_mb * 2 ** 20)
         # dataset = TrainValDataset(dataset_name)
         if not dataset_name in self.dataloaders:
             self.dataloaders[dataset_name] = \
-                DataLoader(dataset, batch_size=1,
-                           shuffle=False, num_workers=0, drop_last=False, sampler=sampler)
-        return self.dataloaders[dataset_name], sampler
+                DataLoader(dataset, batch_sampler=batch_sampler, num_workers=self.args.eval_workers,
+                           pin_memory=str(self.args.device).startswith('cuda'))
+        return self.dataloaders[dataset_name], None
+
+    def synthetic_dataset(self, split=0):
+        args = self.args
+        num = getattr(args, 'synthetic_num', 16)
+        return SyntheticHISRDataset(num=num if split == 0 else max(num // 4, 1),
+                                    bands=getattr(args, 'synthetic_bands', 31),
+                                    size=getattr(args, 'synthetic_size', 64),
+                                    scale=getattr(args, 'synthetic_scale', 4),
+                                    seed=args.seed * 3 + split)
 
     def DID_dataset(self, datasetName, dataroot, batchSize=64, workers=4, shuffle=True, seed=None):
         # import pdb; pdb.set_trace()
@@ -16,9 +16,16 @@ import torch.distributed as dist
 import torchvision
 from torch import nn
 from typing import Dict, List
-from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, get_root_logger
-from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint
+from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, get_root_logger, get_rng_state, \
+    set_rng_state
+from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint, \
+    load_resume_state, amp_state_dict
 from UDL.Basis.dist_utils import init_dist, dist_train_v1, get_dist_info, reduce_mean
+from UDL.Basis.module import enable_tiled_inference, enable_channels_last, enable_activation_checkpointing, \
+    to_channels_last, enable_half_inference
+from UDL.Basis.result_writer import ResultWriter, DistributedResults, update_eval_metrics, compare_eval_precision, \
+    precision_deltas, RESULT_EXTENSIONS
+from UDL.Basis.eval_pipeline import EvalPipeline
 import torch.multiprocessing as mp
 from UDL.hisr.common.hisr_dataset import HISRSession as DataSession
 from torch.utils.tensorboard import SummaryWriter
@@ -68,7 +75,14 @@ class EpochRunner():
         header = 'Epoch: [{}]'.format(epoch)
         print_freq = len(data_loader) if args.print_freq <= 0 else args.print_freq
         metric_logger = self.metric_logger
+        sampler = getattr(data_loader, 'sampler', None)
+        # batches already done before a mid-epoch resume
+        start_iter = getattr(sampler, 'start_index', 0) // args.samples_per_gpu
+        save_every_iters = getattr(args, 'save_every_iters', 0)
+        # the last batch is covered by the epoch checkpoint, a state there would resume into an empty epoch
+        last_iter = start_iter + len(data_loader)
         for batch, idx in metric_logger.log_every(data_loader, print_freq, header):
+            idx += start_iter
             loss, log_vars = model(batch) #output
             loss_dicts, weight_dict = loss
             # weight_dict = criterion.weight_dict
@@ -79,14 +93,11 @@ class EpochRunner():
             loss = sum(loss_dicts[k] * weight_dict[k] for k in loss_dicts.keys() if k in weight_dict)
             losses = loss / args.accumulated_step
             model.backward(optimizer, losses, scaler)
-            if args.clip_max_norm > 0:
-                grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_max_norm)
-                # print(get_grad_norm(model.parameters()))
-            else:
-                grad_norm = get_grad_norm(model.parameters())
-
-            if idx % args.accumulated_step == 0:
-                optimizer.step()
+            step = idx % args.accumulated_step == 0
+            grad_norm = model.clip_grad(optimizer, args.clip_max_norm, scaler, step)
+
+            if step:
+                model.step(optimizer, scaler)
                 optimizer.zero_grad()
 
             # torch.cuda.synchronize()
@@ -96,6 +107,10 @@ class EpochRunner():
             metric_logger.update(grad_norm=grad_norm)
             metric_logger.update_dict(log_vars)
 
+            if save_every_iters > 0 and idx % save_every_iters == 0 and idx % args.accumulated_step == 0 \
+                    and idx < last_iter:
+                self.save_resume_state(model, optimizer, scaler, sampler, epoch, idx)
+
         # gather the stats from all processes
         # metric_logger.synchronize_between_processes()
 
@@ -113,8 +128,30 @@ class EpochRunner():
         # 解耦，用于在main中调整日志
         return metrics
 
+    def save_resume_state(self, model, optimizer, scaler, sampler, epoch, iters):
+        """Everything needed to continue the epoch after ``iters`` batches as if it was never interrupted."""
+        args = self.args
+        if args.global_rank != 0:
+            return
+        filename = os.path.join(args.model_save_dir, 'resume_state.pth.tar')
+        torch.save({
+            'epoch': epoch,
+            'iter': iters,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_metric': args.best_prec1,
+            'best_epoch': args.best_epoch,
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'sampler': sampler.state_dict(iters * args.samples_per_gpu) if hasattr(sampler, 'state_dict') else None,
+            'rng': get_rng_state(),
+            'metric_logger': self.metric_logger.state_dict()
+        }, filename + '.tmp')
+        # a job killed while writing keeps the previous state
+        os.replace(filename + '.tmp', filename)
+
     def eval(self, eval_loader, model, criterion, eval_sampler):
-        if self.args.distributed:
+        if eval_sampler is not None:
             eval_sampler.set_epoch(0)
         print(self.args.distributed)
         model = dist_train_v1(self.args, model)
@@ -129,13 +166,17 @@ class EpochRunner():
         model = model_amp(args, model, criterion, args.reg)
         optimizer, scaler = model.apex_initialize(optimizer)
         model.dist_train()
-        model, optimizer = load_checkpoint(args, model, optimizer)
+        model, optimizer = load_checkpoint(args, model, optimizer, scaler=scaler)
+        train_sampler = kwargs.get('train_sampler')
+        rng_state = load_resume_state(args, scaler, train_sampler, self.metric_logger)
         if args.start_epoch >= 1:
             args.epochs += 1
+        if rng_state is not None:
+            set_rng_state(rng_state)
         start_time = time.time()
         for epoch in range(args.start_epoch, args.epochs):
-            if self.args.distributed:
-                kwargs.get('train_sampler').set_epoch(epoch)
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
             epoch_time = datetime.datetime.now()
             train_stats = self.train_one_epoch(args, model, criterion, train_loader, optimizer, args.device,
                                           epoch, scaler)
@@ -160,7 +201,8 @@ class EpochRunner():
                         'best_metric': args.best_prec1,
                         'loss': val_loss,
                         'best_epoch': args.best_epoch,
-                        'amp': amp.state_dict() if args.amp_opt_level != 'O0' else None,
+                        'amp': amp_state_dict(args),
+                        'scaler': scaler.state_dict() if scaler is not None else None,
                         'optimizer': optimizer.state_dict()
                     }, args.model_save_dir, is_best, filename=f"{epoch}.pth.tar")
             if args.global_rank == 0:
@@ -227,44 +269,65 @@ class EpochRunner():
         os.makedirs(saved_path, exist_ok=True)
         # switch to evaluate mode
         model.eval()
-        if self.args.dataset == 'cave_x4':
-            sr = torch.zeros((11, 31, 512, 512))
-            # sr = torch.zeros((11, 31, 512, 512))
-            save_name = saved_path + '/' + args.name + '_cave' + str(args.test_epoch) + '.mat'
-        elif self.args.dataset == 'cave_x8':
-            sr = torch.zeros((11, 31, 512, 512))
-            save_name = saved_path + '/' + 'cave11_x8-' + args.name + str(args.test_epoch) + '.mat'
-        elif self.args.dataset == 'harvard_x4':
-            sr = torch.zeros((10, 31, 1000, 1000))
-            # sr = torch.zeros(10, 31, 1000, 1000)
-            save_name = saved_path + '/' + args.name + '_harvard_x4' + str(args.test_epoch) + '.mat'
-        elif self.args.dataset == 'harvard_x8':
-            # sr = torch.zeros((250, 31, 200, 200))
-            sr = torch.zeros(10, 31, 1000, 1000)
-            save_name = saved_path + '/' + args.name + '_harvard200_x8' + str(args.test_epoch) + '.mat'
-        elif self.args.dataset == 'Chikusei_x4':
-            sr = torch.zeros(6, 128, 680, 680)
-            save_name = saved_path + '/' + args.name + '_Chikusei' + str(args.test_epoch) + '.mat'
-        elif self.args.dataset == 'pavia_x4':
-            # sr = torch.zeros((250, 31, 200, 200))
-            sr = torch.zeros(4, 92, 256, 256)
-            save_name = saved_path + '/' + args.name + '_pavia' + str(args.test_epoch) + '.mat'
-
-
-        for batch, idx in metric_logger.log_every(eval_loader, 1, header):
-            if args.distributed:
-                sr1, metrics = model.module.eval_step(batch)
-            else:
-                sr1, metrics = model.eval_step(batch)
-
-            # padding
-            sr[idx-1] = sr1.cpu()
-            metric_logger.update_dict(metrics)
-
-        sr = sr.permute(0, 2, 3, 1).numpy()
-
-        sio.savemat(save_name, {'output': sr[:, :, :, :]})
-        stats = {k: meter.avg for k, meter in metric_logger.meters.items()}
+        if args.eval_memory_mb > 0 or args.band_chunk > 0:
+            from UDL.Basis.memory_plan import enable_planned_inference
+            enable_planned_inference(model.module if args.distributed else model, args)
+        elif args.tile_size > 0:
+            enable_tiled_inference(model.module if args.distributed else model, args)
+        net = model.module if args.distributed else model
+        # wraps the tiled / planned forward, so tiles run in half precision as well
+        half = enable_half_inference(net, args) if args.eval_precision != 'fp32' else None
+        ref_logger = MetricLogger(dist_print=args.global_rank, delimiter="  ") \
+            if half is not None and args.eval_precision_check else None
+        test_epoch = str(getattr(args, 'test_epoch', args.start_epoch))
+        save_names = {
+            'cave_x4': args.name + '_cave' + test_epoch,
+            'cave_x8': 'cave11_x8-' + args.name + test_epoch,
+            'harvard_x4': args.name + '_harvard_x4' + test_epoch,
+            'harvard_x8': args.name + '_harvard200_x8' + test_epoch,
+            'Chikusei_x4': args.name + '_Chikusei' + test_epoch,
+            'pavia_x4': args.name + '_pavia' + test_epoch,
+        }
+        save_name = save_names.get(args.dataset, f"{args.name}_{args.dataset}{test_epoch}")
+        save_name = f"{saved_path}/{save_name}{RESULT_EXTENSIONS[args.result_format]}"
+
+        # outputs are written while the next image is evaluated, sized from the first one
+        # dataset indices of every batch, the bucketed loader does not keep the dataset order
+        batch_indices = iter(eval_loader.batch_sampler)
+        # prefetch + device copies / compute / scoring overlap, the writer copies outputs back asynchronously
+        pipeline = EvalPipeline(eval_loader, args.device) if args.eval_pipeline else None
+        if args.distributed:
+            # every rank evaluates its share of the batches, metrics (and outputs) are merged in dataset order
+            results = DistributedResults(save_name, args.result_format, len(eval_loader.dataset),
+                                         not args.eval_rank_outputs, args.global_rank)
+        else:
+            results = ResultWriter(save_name, args.result_format, num=len(eval_loader.dataset))
+        with results as writer:
+            for batch, idx in metric_logger.log_every(eval_loader if pipeline is None else pipeline, 1, header):
+                if args.channels_last:
+                    batch = to_channels_last(batch)
+                if ref_logger is not None:
+                    sr1, metrics = compare_eval_precision(net.eval_step, half, batch, metric_logger, ref_logger)
+                elif args.distributed:
+                    sr1, metrics = model.module.eval_step(batch)
+                else:
+                    sr1, metrics = model.eval_step(batch)
+
+                indices = next(batch_indices)
+                for i, index in enumerate(indices):
+                    writer.put(index, sr1[i])
+                if args.distributed:
+                    writer.update(indices, batch, sr1, metrics, metric_logger)
+                elif pipeline is not None:
+                    pipeline.put(metric_logger, batch, sr1, metrics)
+                else:
+                    update_eval_metrics(metric_logger, batch, sr1, metrics)
+            if pipeline is not None:
+                pipeline.close(metric_logger)
+
+        stats = results.stats if args.distributed else {k: meter.avg for k, meter in metric_logger.meters.items()}
+        if ref_logger is not None:
+            stats.update(precision_deltas(metric_logger, ref_logger, args.eval_precision))
 
         return stats  # stats
 
@@ -279,7 +342,7 @@ def main(args):
         runner = EpochRunner(args)
     else:
         args.distributed = True
-        init_dist(args.launcher, args)
+        init_dist(args.launcher, args, backend=args.backend)
         local_rank = int(os.environ["LOCAL_RANK"])
         rank = int(os.environ["RANK"])
         args.global_rank = rank
@@ -297,10 +360,26 @@ def main(args):
             args.test_writer = SummaryWriter(args.tfb_dir + '/test')
 
     # device = torch.device("cuda", args.local_rank)
-    torch.cuda.set_device(args.local_rank)
+    if str(args.device).startswith('cuda'):
+        torch.cuda.set_device(args.local_rank)
+    if getattr(args, 'num_models', 1) > 1 and not args.eval:
+        # torch.func (torch>=2.0) only for vectorized training
+        from UDL.Basis.ensemble import EnsembleRunner
+        train_loader, train_sampler = sess.get_dataloader(args.dataset, args.distributed)
+        EnsembleRunner(args).run(train_loader, args.builder, train_sampler=train_sampler)
+        return
     model, criterion, optimizer, scheduler = args.builder(args)
     # model.to(device)
-    model.cuda(args.local_rank)
+    if str(args.device).startswith('cuda'):
+        model.cuda(args.local_rank)
+    else:
+        model.to(args.device)
+    if args.channels_last:
+        enable_channels_last(model)
+    if args.checkpoint_stages and not args.eval:
+        stages = enable_activation_checkpointing(model, args.checkpoint_stages, args.checkpoint_granularity)
+        log_string(f"activation checkpointing ({args.checkpoint_granularity}): "
+                   f"{', '.join(type(s).__name__ for s in stages)}")
 
     ##################################################
     if args.eval:
@@ -0,0 +1,345 @@
+"""
+Successive-halving (SHA) / asynchronous successive-halving (ASHA) sweep over HISR variants.
+
+Every trial is a variant directory under UDL/hisr/HISR plus optional option overrides. All trials are
+trained for ``--min-epochs``, the best 1/eta by validation PSNR are resumed from their own checkpoints
+for eta times more epochs, and so on until one remains or ``--max-epochs`` is reached.
+Each rung of each trial runs in its own subprocess; results of all rungs are kept in <out>/results.csv.
+
+usage:
+    python -m UDL.hisr.common.sweep_hisr --variants PSRT_KAv21_noshuffle PSRT_KAv22_noshuffle SWATv4 \
+        --min-epochs 5 --max-epochs 80 --eta 3 --jobs 2 --out results/sweep_cave
+    # cpu smoke run on synthetic data
+    python -m UDL.hisr.common.sweep_hisr --variants PSRT SWATv4 --dataset synthetic --device cpu \
+        --min-epochs 1 --max-epochs 2 --eta 2 --override samples_per_gpu=2 synthetic_num=4
+"""
+import argparse
+import csv
+import importlib
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HISR_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'HISR')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(HISR_ROOT)))
+
+FIELDS = ['name', 'variant', 'rung', 'epochs', 'val_PSNR', 'train_Loss', 'time(s)', 'status', 'promoted']
+
+
+def _parse_value(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+
+def variant_modules(variant):
+    """(option module, model module) of UDL/hisr/HISR/<variant>."""
+    files = sorted(os.listdir(os.path.join(HISR_ROOT, variant)))
+    option = [f for f in files if f.startswith('option') and f.endswith('.py')]
+    model = [f for f in files if f.startswith('model_') and f.endswith('.py')]
+    if not option or not model:
+        raise FileNotFoundError(f"{variant} needs an option_*.py and a model_*.py with build(args)")
+    pkg = f"UDL.hisr.HISR.{variant}"
+    return f"{pkg}.{option[0][:-3]}", f"{pkg}.{model[0][:-3]}"
+
+
+def load_trials(cfg):
+    """Trials from --variants and/or --configs (a json list of {"name", "variant", "overrides"})."""
+    overrides = dict(kv.split('=', 1) for kv in cfg.override)
+    overrides = {k: _parse_value(v) for k, v in overrides.items()}
+    trials = [{'name': v, 'variant': v, 'overrides': dict(overrides)} for v in cfg.variants]
+    if cfg.configs:
+        with open(cfg.configs) as f:
+            for t in json.load(f):
+                t.setdefault('name', t['variant'])
+                t['overrides'] = {**overrides, **t.get('overrides', {})}
+                trials.append(t)
+    names = [t['name'] for t in trials]
+    if len(set(names)) != len(names):
+        raise ValueError(f"trial names must be unique: {names}")
+    return trials
+
+
+################################################################################
+# trial process: train one rung, validate, write rung<r>.json
+################################################################################
+def train_rung(spec):
+    import torch
+    from UDL.Basis.auxiliary import set_random_seed
+    from UDL.hisr.common.main_hisr import EpochRunner
+    from UDL.hisr.common.hisr_dataset import HISRSession
+    from UDL.pansharpening.common.evaluate import analysis_accu
+
+    option_module, model_module = variant_modules(spec['variant'])
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        args = importlib.import_module(option_module).cfg
+    finally:
+        sys.argv = argv
+    build = importlib.import_module(model_module).build
+
+    for k, v in spec['overrides'].items():
+        setattr(args, k, v)
+    args.dataset = spec['dataset']
+    args.device = spec['device']
+    args.epochs = spec['epochs']
+    args.resume = spec['resume'] or ''
+    args.model_save_dir = spec['trial_dir']
+    args.launcher, args.distributed, args.mode = 'none', False, 'none'
+    args.global_rank = args.local_rank = 0
+    args.use_log = args.use_tb = False
+    # save every epoch so the next rung can resume from the last one
+    args.print_freq = 1
+    args.start_epoch = args.best_epoch = 1
+    torch.set_num_threads(spec['threads'])
+    set_random_seed(args.seed)
+
+    if str(args.device).startswith('cuda'):
+        torch.cuda.set_device(args.local_rank)
+    model, criterion, optimizer, scheduler = build(args)
+    model.to(args.device)
+    sess = HISRSession(args)
+    train_loader, train_sampler = sess.get_dataloader(args.dataset, args.distributed)
+    val_loader, _ = sess.get_test_dataloader(args.dataset, args.distributed)
+    runner = EpochRunner(args)
+    start = time.time()
+    runner.run(train_loader, model, criterion, optimizer, None, scheduler=scheduler, train_sampler=train_sampler)
+    meters = runner.metric_logger.meters
+    train_loss = float(meters['Loss'].avg) if 'Loss' in meters else None
+
+    model.eval()
+    psnr = []
+    with torch.no_grad():
+        for batch in val_loader:
+            sr, _ = model.eval_step(batch)
+            gt = batch['gt'].to(sr.device)
+            for i in range(gt.shape[0]):
+                psnr.append(float(analysis_accu(gt[i].permute(1, 2, 0), sr[i].permute(1, 2, 0), 4)['PSNR']))
+    return {'val_PSNR': sum(psnr) / len(psnr), 'train_Loss': train_loss, 'time(s)': round(time.time() - start, 1)}
+
+
+def trial_main(spec_file):
+    with open(spec_file) as f:
+        spec = json.load(f)
+    result = {'status': 'ok'}
+    try:
+        result.update(train_rung(spec))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        result['status'] = f"{type(e).__name__}: {e}"
+    with open(spec['result'], 'w') as f:
+        json.dump(result, f)
+
+
+################################################################################
+# scheduler
+################################################################################
+class SuccessiveHalving():
+
+    def __init__(self, cfg, trials):
+        self.cfg = cfg
+        self.trials = {t['name']: t for t in trials}
+        self.pending = [t['name'] for t in trials]
+        self.budgets = []
+        epochs = cfg.min_epochs
+        while epochs < cfg.max_epochs:
+            self.budgets.append(epochs)
+            epochs *= cfg.eta
+        self.budgets.append(cfg.max_epochs)
+        self.results = [{} for _ in self.budgets]
+        self.promoted = [set() for _ in self.budgets]
+        self.running = {}
+        self.rows = []
+
+    def _score(self, rung, name):
+        r = self.results[rung][name]
+        return r['val_PSNR'] if r['status'] == 'ok' else -math.inf
+
+    def next_job(self):
+        cfg = self.cfg
+        for rung in reversed(range(len(self.budgets) - 1)):
+            done = self.results[rung]
+            if not cfg.asynchronous:
+                # sha promotes a rung only once all of its trials have finished
+                if self.pending or any(r <= rung for r in self.running.values()):
+                    continue
+                if len(done) <= 1:
+                    continue
+                k = max(1, len(done) // cfg.eta)
+            else:
+                k = len(done) // cfg.eta
+            top = sorted(done, key=lambda n: self._score(rung, n), reverse=True)[:k]
+            for name in top:
+                if name not in self.promoted[rung] and self._score(rung, name) > -math.inf:
+                    self.promoted[rung].add(name)
+                    return name, rung + 1
+        if self.pending:
+            return self.pending.pop(0), 0
+        return None
+
+    def spec(self, name, rung):
+        cfg = self.cfg
+        trial_dir = os.path.abspath(os.path.join(cfg.out, name))
+        os.makedirs(trial_dir, exist_ok=True)
+        resume = os.path.join(trial_dir, f"{self.budgets[rung - 1]}.pth.tar") if rung > 0 else None
+        spec = {'name': name, 'variant': self.trials[name]['variant'], 'overrides': self.trials[name]['overrides'],
+                'rung': rung, 'epochs': self.budgets[rung], 'resume': resume, 'trial_dir': trial_dir,
+                'dataset': cfg.dataset, 'device': cfg.device, 'threads': cfg.threads,
+                'result': os.path.join(trial_dir, f"rung{rung}.json")}
+        with open(os.path.join(trial_dir, f"rung{rung}.spec.json"), 'w') as f:
+            json.dump(spec, f, indent=2)
+        return spec
+
+    def _limits(self):
+        cfg = self.cfg
+        if resource is None or not cfg.mem_limit:
+            return None
+
+        def set_limits():
+            limit = int(cfg.mem_limit * 1024 ** 3)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        return set_limits
+
+    def launch(self, name, rung, slot):
+        cfg = self.cfg
+        spec = self.spec(name, rung)
+        if os.path.isfile(spec['result']):
+            with open(spec['result']) as f:
+                if json.load(f).get('status') == 'ok':
+                    # finished in an earlier invocation of the sweep
+                    return None
+        env = dict(os.environ, OMP_NUM_THREADS=str(cfg.threads), MKL_NUM_THREADS=str(cfg.threads),
+                   PYTHONPATH=os.pathsep.join([REPO_ROOT, os.environ.get('PYTHONPATH', '')]))
+        if cfg.gpus:
+            env['CUDA_VISIBLE_DEVICES'] = cfg.gpus[slot % len(cfg.gpus)]
+        log = open(os.path.join(spec['trial_dir'], f"rung{rung}.log"), 'w')
+        proc = subprocess.Popen([sys.executable, '-m', 'UDL.hisr.common.sweep_hisr', '--trial',
+                                 os.path.join(spec['trial_dir'], f"rung{rung}.spec.json")],
+                                stdout=log, stderr=subprocess.STDOUT, env=env, cwd=REPO_ROOT,
+                                preexec_fn=self._limits())
+        proc.log, proc.slot, proc.start = log, slot, time.time()
+        return proc
+
+    def collect(self, name, rung, status=None):
+        result_file = os.path.join(self.cfg.out, name, f"rung{rung}.json")
+        result = {'status': status or 'crashed'}
+        if status is None and os.path.isfile(result_file):
+            with open(result_file) as f:
+                result = json.load(f)
+        self.results[rung][name] = result
+        print(f"[rung {rung} | {self.budgets[rung]} epochs] {name}: "
+              f"{result.get('val_PSNR', float('nan')):.4f} dB ({result['status']})")
+
+    def run(self):
+        cfg = self.cfg
+        procs = {}
+        free = list(range(cfg.jobs))
+        while True:
+            while free:
+                job = self.next_job()
+                if job is None:
+                    break
+                slot = free.pop(0)
+                proc = self.launch(*job, slot)
+                if proc is None:
+                    self.collect(*job)
+                    free.insert(0, slot)
+                    continue
+                procs[job] = proc
+                self.running[job[0]] = job[1]
+            if not procs:
+                break
+            time.sleep(cfg.poll)
+            for job, proc in list(procs.items()):
+                status = None
+                if proc.poll() is None:
+                    if cfg.time_limit and time.time() - proc.start > cfg.time_limit:
+                        proc.kill()
+                        proc.wait()
+                        status = 'timeout'
+                    else:
+                        continue
+                proc.log.close()
+                del procs[job]
+                del self.running[job[0]]
+                free.append(proc.slot)
+                self.collect(*job, status=status)
+            self.write_table()
+        self.write_table()
+        return self.winner()
+
+    def winner(self):
+        for rung in reversed(range(len(self.budgets))):
+            done = [n for n in self.results[rung] if self._score(rung, n) > -math.inf]
+            if done:
+                return max(done, key=lambda n: self._score(rung, n)), rung
+        return None, None
+
+    def write_table(self):
+        rows = []
+        for rung, results in enumerate(self.results):
+            for name, r in results.items():
+                rows.append({'name': name, 'variant': self.trials[name]['variant'], 'rung': rung,
+                             'epochs': self.budgets[rung], 'val_PSNR': r.get('val_PSNR'),
+                             'train_Loss': r.get('train_Loss'), 'time(s)': r.get('time(s)'),
+                             'status': r['status'], 'promoted': name in self.promoted[rung]})
+        with open(os.path.join(self.cfg.out, 'results.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        self.rows = rows
+
+
+def sweep_cfg(argv=None):
+    parser = argparse.ArgumentParser(description='Successive-halving sweep for HISR variants')
+    parser.add_argument('--trial', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--variants', nargs='*', default=[], help='directories under UDL/hisr/HISR')
+    parser.add_argument('--configs', default=None, type=str,
+                        help='json list of {"name", "variant", "overrides": {option: value}}')
+    parser.add_argument('--override', nargs='*', default=[], help='option=value applied to all trials')
+    parser.add_argument('--dataset', default='cave_x4', type=str)
+    parser.add_argument('--device', default='cuda', type=str)
+    parser.add_argument('--min-epochs', default=1, type=int)
+    parser.add_argument('--max-epochs', default=27, type=int)
+    parser.add_argument('--eta', default=3, type=int, help='keep the top 1/eta of every rung')
+    parser.add_argument('--asynchronous', action='store_true', help='ASHA: promote without waiting for the rung')
+    parser.add_argument('--jobs', default=1, type=int, help='trials running at the same time')
+    parser.add_argument('--threads', default=1, type=int, help='cpu threads per trial')
+    parser.add_argument('--gpus', nargs='*', default=[], help='CUDA_VISIBLE_DEVICES per job slot, round robin')
+    parser.add_argument('--mem-limit', default=0, type=float, help='address space limit per trial in GB')
+    parser.add_argument('--time-limit', default=0, type=float, help='seconds per rung of a trial')
+    parser.add_argument('--poll', default=1.0, type=float)
+    parser.add_argument('--out', default='results/sweep', type=str)
+    cfg = parser.parse_args(argv)
+    if cfg.trial is None:
+        assert cfg.eta >= 2 and 0 < cfg.min_epochs <= cfg.max_epochs
+        if not cfg.variants and not cfg.configs:
+            parser.error('--variants or --configs is required')
+    return cfg
+
+
+def main(argv=None):
+    cfg = sweep_cfg(argv)
+    if cfg.trial is not None:
+        return trial_main(cfg.trial)
+    os.makedirs(cfg.out, exist_ok=True)
+    sweep = SuccessiveHalving(cfg, load_trials(cfg))
+    name, rung = sweep.run()
+    print(f"best: {name} after {sweep.budgets[rung] if rung is not None else 0} epochs, "
+          f"results in {os.path.join(cfg.out, 'results.csv')}")
+    return name
+
+
+if __name__ == '__main__':
+    main()
@@ -33,5 +33,8 @@ class Dataset_Pro(data.Dataset):
 
 
             #####必要函数
+    def sample_shape(self, index):
+        return self.gt.shape[1:]
+
     def __len__(self):
         return self.gt.shape[0]
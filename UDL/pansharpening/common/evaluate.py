@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn.functional as F
 import numpy as np
+from UDL.Basis.auxiliary import autocast_fp32
 
 
 # 由于dat及其方差等数值舍入存在误差，最终结果有0.001左右的误差
@@ -291,6 +292,7 @@ n_digits = 6
 
 
 # panHrnet: 2.6565  |1.4651  | 0.98364  | 0.98024  | 0.98089-Q8
+@autocast_fp32
 def analysis_accu(img_base, img_out, ratio, flag_cut_bounds=True, dim_cut=1, choices=4):
     if flag_cut_bounds:
         img_base = img_base[dim_cut - 1:-dim_cut, dim_cut - 1:-dim_cut, :]  #:
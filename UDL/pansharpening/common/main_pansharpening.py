@@ -17,8 +17,14 @@ import torchvision
 from torch import nn
 from typing import Dict, List
 from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, create_logger
-from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint
+from UDL.Basis.framework import model_amp, get_grad_norm, set_weight_decay, load_checkpoint, save_checkpoint, \
+    amp_state_dict
 from UDL.Basis.dist_utils import init_dist, dist_train_v1, get_dist_info, reduce_mean
+from UDL.Basis.module import enable_tiled_inference, enable_channels_last, enable_activation_checkpointing, \
+    to_channels_last, enable_half_inference
+from UDL.Basis.result_writer import ResultWriter, DistributedResults, update_eval_metrics, compare_eval_precision, \
+    precision_deltas, RESULT_EXTENSIONS
+from UDL.Basis.eval_pipeline import EvalPipeline
 import torch.multiprocessing as mp
 from UDL.pansharpening.common.psdata import PansharpeningSession as DataSession
 from torch.utils.tensorboard import SummaryWriter
@@ -57,14 +63,11 @@ def train_one_epoch(args, model, criterion, data_loader, optimizer, device, epoc
 
         losses = loss / args.accumulated_step
         model.backward(optimizer, losses, scaler)
-        if args.clip_max_norm > 0:
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_max_norm)
-            # print(get_grad_norm(model.parameters()))
-        else:
-            grad_norm = get_grad_norm(model.parameters())
+        step = idx % args.accumulated_step == 0
+        grad_norm = model.clip_grad(optimizer, args.clip_max_norm, scaler, step)
 
-        if idx % args.accumulated_step == 0:
-            optimizer.step()
+        if step:
+            model.step(optimizer, scaler)
             optimizer.zero_grad()
 
         # torch.cuda.synchronize()
@@ -123,7 +126,7 @@ class EpochRunner():
         return is_best, val_loss
 
     def eval(self, eval_loader, model, criterion, eval_sampler):
-        if self.args.distributed:
+        if eval_sampler is not None:
             eval_sampler.set_epoch(0)
         print(self.args.distributed)
         model = dist_train_v1(self.args, model)
@@ -138,7 +141,7 @@ class EpochRunner():
         model = model_amp(args, model, criterion, args.reg)
         optimizer, scaler = model.apex_initialize(optimizer)
         model.dist_train()
-        model, optimizer = load_checkpoint(args, model, optimizer)
+        model, optimizer = load_checkpoint(args, model, optimizer, scaler=scaler)
         if args.start_epoch >= 1:
             args.epochs += 1
         start_time = time.time()
@@ -167,7 +170,8 @@ class EpochRunner():
                         'best_metric': args.best_prec1,
                         'loss': val_loss,
                         'best_epoch': args.best_epoch,
-                        'amp': amp.state_dict() if args.amp_opt_level != 'O0' else None,
+                        'amp': amp_state_dict(args),
+                        'scaler': scaler.state_dict() if scaler is not None else None,
                         'optimizer': optimizer.state_dict()
                     }, args.model_save_dir, is_best, filename=f"{epoch}.pth.tar")
             if args.global_rank == 0:
@@ -227,7 +231,6 @@ class EpochRunner():
 
     @torch.no_grad()
     def eval_framework(self, eval_loader, model, criterion):
-        import scipy.io as sio
         args = self.args
         metric_logger = MetricLogger(dist_print=args.global_rank, delimiter="  ")
         header = 'TestEpoch: [{0}]'.format(args.start_epoch)
@@ -235,27 +238,53 @@ class EpochRunner():
         os.makedirs(saved_path, exist_ok=True)
         # switch to evaluate mode
         model.eval()
-        if self.args.dataset == 'wv3':
-            sr = torch.zeros((20, 8, 256, 256))
-        elif self.args.dataset == 'harvard_x4':
-            sr = torch.zeros((250, 31, 200, 200))
-
-        for batch, idx in metric_logger.log_every(eval_loader, 1, header):
-            if args.distributed:
-                sr1, metrics = model.module.eval_step(batch)
-            else:
-                sr1, metrics = model.eval_step(batch)
-            sr[idx - 1] = sr1.cpu()
-            metric_logger.update_dict(metrics)
-
-        sr = sr.permute(0, 2, 3, 1).numpy()
-        if args.dataset == 'wv3':
-            save_name = saved_path + '/' + args.name + 'wv3_256.mat'
-        elif args.dataset == 'harvard_x4':
-            save_name = saved_path + '/' + args.name + 'harvard200.mat'
-
-        sio.savemat(save_name, {'output': sr[:, :, :, :]})
-        stats = {k: meter.avg for k, meter in metric_logger.meters.items()}
+        if args.eval_memory_mb > 0 or args.band_chunk > 0:
+            from UDL.Basis.memory_plan import enable_planned_inference
+            enable_planned_inference(model.module if args.distributed else model, args)
+        elif args.tile_size > 0:
+            enable_tiled_inference(model.module if args.distributed else model, args)
+        net = model.module if args.distributed else model
+        # wraps the tiled / planned forward, so tiles run in half precision as well
+        half = enable_half_inference(net, args) if args.eval_precision != 'fp32' else None
+        ref_logger = MetricLogger(dist_print=args.global_rank, delimiter="  ") \
+            if half is not None and args.eval_precision_check else None
+        save_names = {'wv3': args.name + 'wv3_256', 'harvard_x4': args.name + 'harvard200'}
+        save_name = f"{saved_path}/{save_names.get(args.dataset, args.name + args.dataset)}{RESULT_EXTENSIONS[args.result_format]}"
+
+        batch_indices = iter(eval_loader.batch_sampler)
+        # prefetch + device copies / compute / scoring overlap, the writer copies outputs back asynchronously
+        pipeline = EvalPipeline(eval_loader, args.device) if args.eval_pipeline else None
+        if args.distributed:
+            # every rank evaluates its share of the batches, metrics (and outputs) are merged in dataset order
+            results = DistributedResults(save_name, args.result_format, len(eval_loader.dataset),
+                                         not args.eval_rank_outputs, args.global_rank)
+        else:
+            results = ResultWriter(save_name, args.result_format, num=len(eval_loader.dataset))
+        with results as writer:
+            for batch, idx in metric_logger.log_every(eval_loader if pipeline is None else pipeline, 1, header):
+                if args.channels_last:
+                    batch = to_channels_last(batch)
+                if ref_logger is not None:
+                    sr1, metrics = compare_eval_precision(net.eval_step, half, batch, metric_logger, ref_logger)
+                elif args.distributed:
+                    sr1, metrics = model.module.eval_step(batch)
+                else:
+                    sr1, metrics = model.eval_step(batch)
+                indices = next(batch_indices)
+                for i, index in enumerate(indices):
+                    writer.put(index, sr1[i])
+                if args.distributed:
+                    writer.update(indices, batch, sr1, metrics, metric_logger)
+                elif pipeline is not None:
+                    pipeline.put(metric_logger, batch, sr1, metrics)
+                else:
+                    update_eval_metrics(metric_logger, batch, sr1, metrics)
+            if pipeline is not None:
+                pipeline.close(metric_logger)
+
+        stats = results.stats if args.distributed else {k: meter.avg for k, meter in metric_logger.meters.items()}
+        if ref_logger is not None:
+            stats.update(precision_deltas(metric_logger, ref_logger, args.eval_precision))
 
         return stats  # stats
 
@@ -271,7 +300,7 @@ def main(args):
         runner = EpochRunner(args, sess)
     else:
         args.distributed = True
-        init_dist(args.launcher, args)
+        init_dist(args.launcher, args, backend=args.backend)
         local_rank = int(os.environ["LOCAL_RANK"])
         rank = int(os.environ["RANK"])
         args.global_rank = rank
@@ -294,6 +323,12 @@ def main(args):
     model, criterion, optimizer, scheduler = args.builder(args)
     # model.to(device)
     model.cuda(args.local_rank)
+    if args.channels_last:
+        enable_channels_last(model)
+    if args.checkpoint_stages and not args.eval:
+        stages = enable_activation_checkpointing(model, args.checkpoint_stages, args.checkpoint_granularity)
+        log_string(f"activation checkpointing ({args.checkpoint_granularity}): "
+                   f"{', '.join(type(s).__name__ for s in stages)}")
 
     ##################################################
     if args.eval:
@@ -1,6 +1,7 @@
 import glob
 import torch
 from torch.utils.data import DataLoader
+from UDL.Basis.dist_utils import ShapeBucketBatchSampler
 
 
 class PansharpeningSession():
@@ -67,15 +68,15 @@ class PansharpeningSession():
             print(f"{dataset_name} is not supported.")
             raise NotImplementedError
 
-        sampler = None
-        if distributed:
-            sampler = torch.utils.data.distributed.DistributedSampler(dataset)
+        # same-shape images are batched together, eval_framework restores the original order
+        batch_sampler = ShapeBucketBatchSampler(dataset, self.args.eval_batch_size,
+                                                self.args.eval_budget_mb * 2 ** 20)
 
         if not dataset_name in self.dataloaders:
             self.dataloaders[dataset_name] = \
-                DataLoader(dataset, batch_size=1,
-                           shuffle=False, num_workers=1, drop_last=False, sampler=sampler)
-        return self.dataloaders[dataset_name], sampler
+                DataLoader(dataset, batch_sampler=batch_sampler, num_workers=self.args.eval_workers,
+                           pin_memory=str(self.args.device).startswith('cuda'))
+        return self.dataloaders[dataset_name], None
 
 
 
@@ -8,7 +8,8 @@ import torch
 import torch.nn.functional as F
 from scipy import io as sio
 from torch.utils.data import DataLoader, Dataset
-from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed, log_string
+from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, set_random_seed
+from logging import info as log_string
 from UDL.Basis.dist_utils import init_dist, dist_train_v1, get_dist_info, reduce_mean
 from UDL.pansharpening.common.evaluate import analysis_accu
 from UDL.Basis.postprocess import showimage8
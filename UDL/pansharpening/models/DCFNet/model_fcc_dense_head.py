@@ -382,8 +382,9 @@ class TransitionFPN(nn.Module):
 
 
 class DCFNet(nn.Module):
-    def __init__(self, spectral_num, criterion, mode="SUM"):
+    def __init__(self, spectral_num, criterion, args, mode="SUM"):
         super(DCFNet, self).__init__()
+        self.args = args
         self.first_fuse = mode
         if mode == "SUM":
             print("repeated sum head")
@@ -443,7 +444,7 @@ class DCFNet(nn.Module):
 
         ################################################################################################
         # 保主分支，进行最终分支融合输出
-        last_inp_channels = np.int(np.sum(pre_stage_channels))  # ms_channels
+        last_inp_channels = int(np.sum(pre_stage_channels))  # ms_channels
         FINAL_CONV_KERNEL = 1
         self.last_layer = nn.Sequential(
             nn.Conv2d(in_channels=last_inp_channels, out_channels=last_inp_channels,
@@ -668,28 +669,28 @@ class DCFNet(nn.Module):
 
     def train_step(self, data):
 
-        lms = data['lms'].cuda()
-        ms = data['ms'].cuda()
+        lms = data['lms'].to(self.args.device)
+        ms = data['ms'].to(self.args.device)
         mms = torch.nn.functional.interpolate(ms, size=(ms.size(2) * 2, ms.size(3) * 2),
                                                    mode="bilinear", align_corners=True)
-        pan = data['pan'].cuda()
-        gt = data['gt'].cuda()
+        pan = data['pan'].to(self.args.device)
+        gt = data['gt'].to(self.args.device)
         sr = self(pan, lms, mms, ms)
         loss = self.criterion(sr, gt)
 
         return sr, loss
 
     def eval_step(self, data):
-        lms = data['lms'].cuda().float()
-        ms = data['ms'].cuda().float()
+        lms = data['lms'].to(self.args.device).float()
+        ms = data['ms'].to(self.args.device).float()
         # if hasattr(data, 'mms') is not None:
-        mms = data['mms'].cuda().float()
+        mms = data['mms'].to(self.args.device).float()
         # else:
         #     mms = torch.nn.functional.interpolate(ms, size=(ms.size(2) * 2, ms.size(3) * 2),
         #                                                mode="bilinear", align_corners=True)
-        pan = data['pan'].cuda().float()
+        pan = data['pan'].to(self.args.device).float()
         sr = self(pan, lms, mms, ms)
-        return sr, data['gt'].cuda().float()
+        return sr, data['gt'].to(self.args.device).float()
 
 class SetCriterion(nn.Module):
     """ This class computes the loss for DETR.
@@ -750,11 +751,11 @@ def build_DCFNet(args):
     else:
         spectral_num = 4
 
-    loss = nn.MSELoss(size_average=True).cuda()  ## Define the Loss function
+    loss = nn.MSELoss(size_average=True).to(args.device)  ## Define the Loss function
     weight_dict = {'Loss': 1}
     losses = {'Loss': loss}
     criterion = SetCriterion(losses, weight_dict)
-    model = DCFNet(spectral_num, criterion, mode="C").cuda()
+    model = DCFNet(spectral_num, criterion, args, mode="C").to(args.device)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=0)   ## optimizer 1: Adam
 
     return model, criterion, optimizer, scheduler
@@ -12,6 +12,7 @@ import torch.nn as nn
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from einops import rearrange, repeat
+from UDL.Basis.window_ops import window_partition, window_reverse, Win_Dila as Win_Shuffle, Win_ReDila as Win_Reshuffle
 
 
 class Mlp(nn.Module):
@@ -33,90 +34,6 @@ class Mlp(nn.Module):
         return x
 
 
-def window_partition(x, window_size):
-    """
-    Args:
-        x: (B, H, W, C)
-        window_size (int): window size
-
-    Returns:
-        windows: (num_windows*B, window_size, window_size, C)
-    """
-    B, H, W, C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows
-
-
-def window_reverse(windows, window_size, H, W):
-    """
-    Args:
-        windows: (num_windows*B, window_size, window_size, C)
-        window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
-
-    Returns:
-        x: (B, H, W, C)
-    """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    return x
-
-def Win_Shuffle(x, win_size):
-    """
-    :param x: B H W C
-    :param win_size:
-    :return: y: B H W C
-    """
-    B, H, W, C = x.shape
-    dilation = win_size*2
-    resolution = H
-    assert resolution % win_size == 0, 'resolution of input should be divisible'
-    assert win_size % 2 == 0, 'win_size should be the multiple of two'
-    "input size BxCxHxW"
-    "shuffle"
-
-    x = window_partition(x, dilation)  # BN x d x d x c
-    xt = torch.zeros_like(x)
-    x0 = x[:, 0::2, 0::2, :]  # B n/2 n/2 d2c
-    x1 = x[:, 0::2, 1::2, :]  # B n/2 n/2 d2c
-    x2 = x[:, 1::2, 0::2, :]  # B n/2 n/2 d2c
-    x3 = x[:, 1::2, 1::2, :]  # B n/2 n/2 d2c
-
-    xt[:, 0:win_size, 0:win_size, :] = x0  # B n/2 n/2 d2c
-    xt[:, 0:win_size, win_size:dilation, :] = x1  # B n/2 n/2 d2c
-    xt[:, win_size:dilation, 0:win_size, :] = x2  # B n/2 n/2 d2c
-    xt[:, win_size:dilation, win_size:dilation, :] = x3  # B n/2 n/2 d2c
-    xt = xt.reshape(-1, dilation, dilation, C)
-    xt = window_reverse(xt, dilation, H, W)
-
-    return xt
-
-def Win_Reshuffle(x, win_size):
-    """
-        :param x: B H W C
-        :param win_size:
-        :return: y: B H W C
-    """
-    B, H, W, C = x.shape
-    dilation = win_size*2
-    assert H % win_size == 0, 'resolution of input should be divisible'
-    assert win_size % 2 == 0, 'win_size should be the multiple of two'
-
-    x = window_partition(x, dilation)  # BN x d x d x c
-    xt = torch.zeros_like(x)
-    xt[:, 0::2, 0::2, :] = x[:, 0:win_size, 0:win_size, :]  # B n/2 n/2 d2c
-    xt[:, 0::2, 1::2, :] = x[:, 0:win_size, win_size:dilation, :]  # B n/2 n/2 d2c
-    xt[:, 1::2, 0::2, :] = x[:, win_size:dilation, 0:win_size, :]  # B n/2 n/2 d2c
-    xt[:, 1::2, 1::2, :] = x[:, win_size:dilation, win_size:dilation, :]  # B n/2 n/2 d2c
-    xt = xt.reshape(-1, dilation, dilation, C)
-    xt = window_reverse(xt, dilation, H, W)
-
-    return xt
-
-
 class PatchMerging(nn.Module):
     r""" Patch Merging Layer.
 
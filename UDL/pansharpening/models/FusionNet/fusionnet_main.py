@@ -6,7 +6,7 @@ import torch.optim as optim
 from torch.autograd import Variable
 from .model_fusionnet import FusionNet
 import numpy as np
-from UDL.Basis.auxiliary import MetricLogger, SmoothedValue, log_string
+from UDL.Basis.auxiliary import MetricLogger, SmoothedValue
 from UDL.Basis.framework import get_grad_norm
 from UDL.Basis.dist_utils import reduce_mean
 # from ..evaluation.ps_evaluate import testToPanshaprening
@@ -73,11 +73,11 @@ def build_fusionnet(args):
         spectral_num = 4
 
 
-    loss = nn.MSELoss(size_average=True).cuda()  ## Define the Loss function
+    loss = nn.MSELoss(size_average=True).to(args.device)  ## Define the Loss function
     weight_dict = {'Loss': 1}
     losses = {'Loss': loss}
     criterion = SetCriterion(losses, weight_dict)
-    model = FusionNet(spectral_num, criterion).cuda()
+    model = FusionNet(spectral_num, criterion, args).to(args.device)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=0)   ## optimizer 1: Adam
 
     return model, criterion, optimizer, scheduler
@@ -77,8 +77,9 @@ class Resblock(nn.Module):
 
 # -----------------------------------------------------
 class FusionNet(nn.Module):
-    def __init__(self, spectral_num, criterion, channel=32):
+    def __init__(self, spectral_num, criterion, args, channel=32):
         super(FusionNet, self).__init__()
+        self.args = args
         # ConvTranspose2d: output = (input - 1)*stride + outpading - 2*padding + kernelsize
         self.criterion = criterion
 
@@ -118,8 +119,8 @@ class FusionNet(nn.Module):
 
 
     def train_step(self, data, *args, **kwargs):
-        gt, lms, ms, pan = data['gt'].cuda(), data['lms'].cuda(), \
-                                data['ms'].cuda(), data['pan'].cuda()
+        gt, lms, ms, pan = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                                data['ms'].to(self.args.device), data['pan'].to(self.args.device)
         res = self(lms, pan)
         sr = lms + res  # output:= lms + hp_sr
         loss = self.criterion(sr, gt, *args, **kwargs)
@@ -127,8 +128,8 @@ class FusionNet(nn.Module):
 
     def eval_step(self, data, *args, **kwargs):
         # gt, lms, ms, pan = data
-        gt, lms, ms, pan = data['gt'].cuda(), data['lms'].cuda(), \
-                                data['ms'].cuda(), data['pan'].cuda()
+        gt, lms, ms, pan = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                                data['ms'].to(self.args.device), data['pan'].to(self.args.device)
         res = self(lms, pan)
         sr = lms + res  # output:= lms + hp_sr
         return sr, gt
@@ -37,8 +37,9 @@ def init_weights(*modules):
 
 
 class PNN(nn.Module):
-    def __init__(self, spectral_num, criterion, channel=64):
+    def __init__(self, spectral_num, criterion, args, channel=64):
         super(PNN, self).__init__()
+        self.args = args
 
         self.criterion = criterion
 
@@ -64,8 +65,8 @@ class PNN(nn.Module):
         return output
 
     def train_step(self, data, *args, **kwargs):
-        gt, lms, ms, pan = data['gt'].cuda(), data['lms'].cuda(), \
-                           data['ms'].cuda(), data['pan'].cuda()
+        gt, lms, ms, pan = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                           data['ms'].to(self.args.device), data['pan'].to(self.args.device)
         blk = self.blk
 
         gt = gt[:, :, blk:-blk, blk:-blk]
@@ -79,8 +80,8 @@ class PNN(nn.Module):
 
     def eval_step(self, data, *args, **kwargs):
         blk = self.blk
-        gt, lms, ms, pan = data['gt'].cuda(), data['lms'].cuda(), \
-                           data['ms'].cuda(), data['pan'].cuda()
+        gt, lms, ms, pan = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                           data['ms'].to(self.args.device), data['pan'].to(self.args.device)
         lms = torch.cat([lms, pan], dim=1)
         sr = self(lms)
 
@@ -67,11 +67,11 @@ def build_pnn(args):
     print(f"PNN adopt another lr: {lr} in \"build_pnn in pnn_main.py\" ")
 
 
-    loss = nn.MSELoss(size_average=True).cuda()  ## Define the Loss function
+    loss = nn.MSELoss(size_average=True).to(args.device)  ## Define the Loss function
     weight_dict = {'Loss': 1}
     losses = {'Loss': loss}
     criterion = SetCriterion(losses, weight_dict)
-    model = PNN(spectral_num, criterion).cuda()
+    model = PNN(spectral_num, criterion, args).to(args.device)
     target_layerParam = list(map(id, model.conv3.parameters()))
     base_layerParam = filter(lambda p: id(p) not in target_layerParam, model.parameters())
 
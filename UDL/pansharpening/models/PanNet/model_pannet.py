@@ -51,8 +51,9 @@ class Resblock(nn.Module):
 
 # -----------------------------------------------------
 class PanNet(nn.Module):
-    def __init__(self, spectral_num, criterion, channel=32):
+    def __init__(self, spectral_num, criterion, args, channel=32):
         super(PanNet, self).__init__()
+        self.args = args
         self.criterion = criterion
         # ConvTranspose2d: output = (input - 1)*stride + outpading - 2*padding + kernelsize
         self.deconv = nn.ConvTranspose2d(in_channels=spectral_num, out_channels=spectral_num, kernel_size=8, stride=4,
@@ -91,8 +92,8 @@ class PanNet(nn.Module):
         return output
 
     def train_step(self, data, *args, **kwargs):
-        gt, lms, ms_hp, pan_hp = data['gt'].cuda(), data['lms'].cuda(), \
-                                data['ms_hp'].cuda(), data['pan_hp'].cuda()
+        gt, lms, ms_hp, pan_hp = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                                data['ms_hp'].to(self.args.device), data['pan_hp'].to(self.args.device)
         hp_sr = self(ms_hp, pan_hp)
         sr = lms + hp_sr  # output:= lms + hp_sr
         loss = self.criterion(sr, gt, *args, **kwargs)
@@ -100,8 +101,8 @@ class PanNet(nn.Module):
 
     def eval_step(self, data, *args, **kwargs):
         # gt, lms, ms, pan = data
-        gt, lms, ms_hp, pan_hp = data['gt'].cuda(), data['lms'].cuda(), \
-                                data['ms_hp'].cuda(), data['pan_hp'].cuda()
+        gt, lms, ms_hp, pan_hp = data['gt'].to(self.args.device), data['lms'].to(self.args.device), \
+                                data['ms_hp'].to(self.args.device), data['pan_hp'].to(self.args.device)
         hp_sr = self(ms_hp, pan_hp)
         sr = lms + hp_sr  # output:= lms + hp_sr
         return sr, gt
@@ -72,11 +72,11 @@ def build_pannet(args):
     else:
         spectral_num = 4
 
-    loss = nn.MSELoss(size_average=True).cuda()  ## Define the Loss function
+    loss = nn.MSELoss(size_average=True).to(args.device)  ## Define the Loss function
     weight_dict = {'Loss': 1}
     losses = {'Loss': loss}
     criterion = SetCriterion(losses, weight_dict)
-    model = PanNet(spectral_num, criterion).cuda()
+    model = PanNet(spectral_num, criterion, args).to(args.device)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=0)   ## optimizer 1: Adam
 
     return model, criterion, optimizer, scheduler
@@ -16,6 +16,7 @@ setup(
         "psutil",
         "opencv-python",
         "numpy",
+        "packaging",
         "matplotlib",
         "tensorboard",
         "addict",
@@ -0,0 +1,76 @@
+import copy
+import pytest
+import torch
+import torch.nn as nn
+from UDL.Basis.module import enable_activation_checkpointing, checkpoint_stages
+
+
+class Block(nn.Module):
+
+    def __init__(self, dim):
+        super(Block, self).__init__()
+        self.norm = nn.LayerNorm(dim)
+        self.fc = nn.Linear(dim, dim)
+        self.drop = nn.Dropout(0.2)
+
+    def forward(self, x):
+        return x + self.drop(torch.relu(self.fc(self.norm(x))))
+
+
+class BasicLayer(nn.Module):
+
+    def __init__(self, dim, depth):
+        super(BasicLayer, self).__init__()
+        self.blocks = nn.ModuleList([Block(dim) for _ in range(depth)])
+
+    def forward(self, x):
+        for blk in self.blocks:
+            x = blk(x)
+        return x
+
+
+class Net(nn.Module):
+
+    def __init__(self, dim=8):
+        super(Net, self).__init__()
+        self.embed = nn.Linear(4, dim)
+        self.layers = nn.ModuleList([BasicLayer(dim, 2), BasicLayer(dim, 3)])
+        self.head = nn.Linear(dim, 4)
+
+    def forward(self, x):
+        x = self.embed(x)
+        for layer in self.layers:
+            x = layer(x)
+        return self.head(x)
+
+
+def _step(model, x):
+    torch.manual_seed(1)
+    out = model(x)
+    out.square().mean().backward()
+    return out.detach(), {n: p.grad for n, p in model.named_parameters()}
+
+
+@pytest.mark.parametrize('granularity', ['block', 'stage'])
+@pytest.mark.parametrize('stages', [[-1], [1]])
+def test_checkpointing_keeps_outputs_and_gradients(granularity, stages):
+    torch.manual_seed(0)
+    model = Net().train()
+    wrapped = copy.deepcopy(model)
+    selected = enable_activation_checkpointing(wrapped, stages, granularity)
+    assert selected == [checkpoint_stages(wrapped)[i] for i in ([0, 1] if stages == [-1] else stages)]
+    # inputs without grad, dropout masks are replayed in the recompute
+    x = torch.randn(2, 16, 4)
+    out, grads = _step(model, x)
+    wrapped_out, wrapped_grads = _step(wrapped, x)
+    torch.testing.assert_close(wrapped_out, out)
+    for name, grad in grads.items():
+        torch.testing.assert_close(wrapped_grads[name], grad, msg=name)
+
+
+def test_empty_stages_restore_the_plain_forwards():
+    model = Net()
+    enable_activation_checkpointing(model, [-1], 'block')
+    assert any('forward' in m.__dict__ for m in model.modules())
+    enable_activation_checkpointing(model, [])
+    assert not any('forward' in m.__dict__ for m in model.modules())
@@ -0,0 +1,71 @@
+import types
+import pytest
+import torch
+import torch.nn as nn
+from UDL.Basis.framework import model_amp, get_grad_norm
+
+
+def _args(**kwargs):
+    args = dict(amp=None, amp_dtype='fp16', device='cpu', channels_last=False, clip_max_norm=0, lr=1e-3)
+    args.update(kwargs)
+    return types.SimpleNamespace(**args)
+
+
+def _hisr_batches(n, size=16, bands=31):
+    g = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(n):
+        gt = torch.rand(2, bands, size, size, generator=g)
+        batches.append({'gt': gt, 'up': gt + 0.05 * torch.randn(gt.shape, generator=g),
+                        'lrhsi': gt[..., ::4, ::4], 'rgb': torch.rand(2, 3, size, size, generator=g)})
+    return batches
+
+
+def _train(args, batches):
+    from UDL.hisr.HISR.PSRT.model_PSRT import build
+    torch.manual_seed(0)
+    model, criterion, optimizer, _ = build(args)
+    model = model_amp(args, model, criterion)
+    optimizer, scaler = model.apex_initialize(optimizer)
+    losses = []
+    for batch in batches:
+        (loss_dicts, weight_dict), log_vars = model(batch)
+        loss = sum(loss_dicts[k] * weight_dict[k] for k in loss_dicts if k in weight_dict)
+        model.backward(optimizer, loss, scaler)
+        model.clip_grad(optimizer, args.clip_max_norm, scaler)
+        model.step(optimizer, scaler)
+        optimizer.zero_grad()
+        losses.append(loss.item())
+    return losses, log_vars
+
+
+def test_bf16_training_tracks_fp32():
+    batches = _hisr_batches(4)
+    fp32, _ = _train(_args(), batches)
+    bf16, log_vars = _train(_args(amp=True, amp_dtype='bf16'), batches)
+    assert fp32[-1] < fp32[0]
+    assert bf16 == pytest.approx(fp32, rel=0.03)
+    # metrics are computed in fp32
+    assert all(not torch.is_tensor(v) or v.dtype == torch.float32 for v in log_vars.values())
+
+
+@pytest.mark.parametrize('max_norm', [0, 0.5])
+def test_clip_grad_unscales(max_norm):
+    x, y = torch.randn(8, 4), torch.randn(8, 2)
+    ref = nn.Linear(4, 2)
+    ((ref(x) - y) ** 2).mean().backward()
+    ref_norm = get_grad_norm(ref.parameters())
+
+    net = nn.Linear(4, 2)
+    net.load_state_dict(ref.state_dict())
+    model = model_amp(_args(), net, None)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    scaler = torch.amp.GradScaler('cpu', init_scale=1024.)
+    scaler.scale(((net(x) - y) ** 2).mean()).backward()
+    # between accumulation steps: norm of the real gradients, nothing unscaled yet
+    assert model.clip_grad(optimizer, max_norm, scaler, step=False) == pytest.approx(ref_norm, rel=1e-5)
+    assert float(model.clip_grad(optimizer, max_norm, scaler)) == pytest.approx(ref_norm, rel=1e-5)
+    expected = min(ref_norm, max_norm) if max_norm > 0 else ref_norm
+    assert get_grad_norm(net.parameters()) == pytest.approx(expected, rel=1e-4)
+    model.step(optimizer, scaler)
+    assert scaler.get_scale() == 1024.
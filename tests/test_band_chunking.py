@@ -0,0 +1,67 @@
+import types
+import torch
+from torch import nn
+from UDL.Basis.module import enable_band_chunking
+from UDL.Basis.memory_plan import PeakMemory, MB, chunked_blocks, measure_peak, plan_inference
+
+
+class Tails(nn.Module):
+
+    def __init__(self, bands=32):
+        super(Tails, self).__init__()
+        self.head = nn.Conv2d(3, bands, 3, padding=1)
+        self.grouped = nn.Sequential(nn.Conv2d(bands, bands, 3, padding=1, groups=bands), nn.GELU())
+        self.inplace = nn.Sequential(nn.Conv2d(bands, bands, 1), nn.ReLU(inplace=True))
+        self.tail = nn.Sequential(nn.Conv2d(bands, bands, 3, padding=1), nn.LeakyReLU(0.2))
+
+    def forward(self, x):
+        return self.tail(self.inplace(self.grouped(self.head(x))))
+
+
+def _patched(model):
+    return {name for name, m in model.named_modules() if 'forward' in m.__dict__}
+
+
+def test_only_conv_activation_blocks_are_chunked():
+    torch.manual_seed(0)
+    model = Tails().eval()
+    x = torch.rand(1, 3, 48, 48)
+    with torch.no_grad():
+        ref = model(x)
+        enable_band_chunking(model, 8, 32)
+        assert _patched(model) == {'grouped', 'tail'}
+        out = model(x)
+        enable_band_chunking(model, 0, 32)
+        assert not _patched(model)
+    assert torch.allclose(out, ref, atol=1e-6)
+
+
+def test_chunking_lowers_the_peak_of_a_tail():
+    model = nn.Sequential(nn.Conv2d(32, 32, 1), nn.GELU()).eval()
+    x = torch.rand(1, 32, 64, 64)
+    peaks = []
+    for chunk in (0, 8):
+        enable_band_chunking(model, chunk, 32)
+        with torch.no_grad(), PeakMemory() as memory:
+            model(x)
+        peaks.append(memory.peak)
+    # unchunked: conv and activation outputs, chunked: the output and a conv / activation chunk (2 x 1/4)
+    assert peaks[1] == 0.75 * peaks[0]
+
+
+def test_band_chunking_is_a_noop_for_psrt():
+    # the tails of the hisr variants end in an in-place LeakyReLU, the plan for them is tiling only
+    from UDL.hisr.HISR.PSRT.model_PSRT import build
+    torch.manual_seed(0)
+    args = types.SimpleNamespace(device='cpu', amp=None, lr=1e-3)
+    model = build(args)[0].eval()
+    assert chunked_blocks(model, 8, 31) == 0
+    enable_band_chunking(model, 8, 31)
+    assert not _patched(model)
+
+    g = torch.Generator().manual_seed(0)
+    gt, rgb = torch.rand(1, 31, 96, 96, generator=g), torch.rand(1, 3, 96, 96, generator=g)
+    inputs = (gt, rgb, gt + 0.05 * torch.randn(gt.shape, generator=g))
+    whole = measure_peak(model, *inputs)[0]
+    plan = plan_inference(model, inputs, 0.6 * whole / MB, overlap=8)
+    assert plan['band_chunk'] == 0 and 0 < plan['tile_size'] < 96
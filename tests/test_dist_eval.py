@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data.distributed import DistributedSampler
+from UDL.Basis.dist_utils import gather_eval_records
+from UDL.Basis.result_writer import DistributedResults
+
+WORLD_SIZE = 3
+NUM_IMAGES = 5
+
+
+def _gather(rank, init_file, out):
+    dist.init_process_group('gloo', init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        sampler = DistributedSampler(range(NUM_IMAGES), num_replicas=WORLD_SIZE, rank=rank, shuffle=False)
+        records = [(i, {'index': i, 'rank': rank}) for i in sampler]
+        torch.save({'records': records, 'dst': gather_eval_records(records),
+                    'all': gather_eval_records(records, all_ranks=True)}, os.path.join(out, f"rank{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gather_keeps_dataset_order_and_drops_padding(tmp_path):
+    mp.spawn(_gather, args=(str(tmp_path / 'init'), str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(tmp_path / f"rank{r}.pt", weights_only=False) for r in range(WORLD_SIZE)]
+    # 6 samples for 5 images: DistributedSampler pads the last rank with image 0
+    assert sum(len(r['records']) for r in results) == 6
+    assert [i for i, _ in results[-1]['records']] == [2, 0]
+    expected = [(i, {'index': i, 'rank': i % WORLD_SIZE}) for i in range(NUM_IMAGES)]
+    assert results[0]['dst'] == expected
+    assert all(r['dst'] is None for r in results[1:])
+    assert all(r['all'] == expected for r in results)
+
+
+def _results(rank, init_file, out):
+    dist.init_process_group('gloo', init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        sampler = DistributedSampler(range(NUM_IMAGES), num_replicas=WORLD_SIZE, rank=rank, shuffle=False)
+        with DistributedResults(os.path.join(out, 'out.npy'), 'npy', NUM_IMAGES, rank=rank) as results:
+            for i in sampler:
+                results.put(i, torch.full((2, 3, 4), float(i)))
+                results.update([i], {}, torch.zeros(1, 2, 3, 4), {'PSNR': 10. * i})
+        torch.save(results.stats, os.path.join(out, f"stats{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_distributed_results_merge_the_rank_shards(tmp_path):
+    mp.spawn(_results, args=(str(tmp_path / 'init'), str(tmp_path)), nprocs=WORLD_SIZE)
+    out = np.load(tmp_path / 'out.npy')
+    assert out.shape == (NUM_IMAGES, 3, 4, 2)
+    assert [float(image.mean()) for image in out] == list(range(NUM_IMAGES))
+    # the padded duplicate of image 0 counts once, the shards are removed after the merge
+    assert all(torch.load(tmp_path / f"stats{r}.pt") == {'PSNR': 20., 'images': NUM_IMAGES}
+               for r in range(WORLD_SIZE))
+    assert not list(tmp_path.glob('*.part.h5'))
@@ -0,0 +1,64 @@
+import types
+import pytest
+import torch
+import torch.nn as nn
+from torch import optim
+from UDL.Basis.criterion_metrics import SetCriterion
+from UDL.Basis.ensemble import build_ensemble
+
+
+class TinyHISR(nn.Module):
+    def __init__(self, args):
+        super(TinyHISR, self).__init__()
+        self.args = args
+        self.body = nn.Sequential(nn.Conv2d(34, 16, 3, 1, 1), nn.LeakyReLU(0.2), nn.Conv2d(16, 31, 3, 1, 1))
+
+    def forward(self, rgb, lms):
+        return self.body(torch.cat((lms, rgb), 1)) + lms
+
+    def train_step(self, batch):
+        sr = self(batch['rgb'], batch['up'])
+        loss = self.criterion(sr, batch['gt'])
+        return {'loss': loss, 'log_vars': {}}
+
+
+def build(args):
+    criterion = SetCriterion({'Loss': nn.L1Loss()}, {'Loss': 1})
+    model = TinyHISR(args)
+    model.criterion = criterion
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=1e-4)
+    return model, criterion, optimizer, None
+
+
+def _batches(n):
+    g = torch.Generator().manual_seed(0)
+    return [{'gt': torch.rand(2, 31, 8, 8, generator=g), 'up': torch.rand(2, 31, 8, 8, generator=g),
+             'rgb': torch.rand(2, 3, 8, 8, generator=g)} for _ in range(n)]
+
+
+def test_vectorized_copies_match_separate_training():
+    args = types.SimpleNamespace(num_models=2, ensemble_seeds=[3, 7], ensemble_lrs=[1e-2, 1e-3], seed=0,
+                                 device='cpu', lr=1e-3)
+    ensemble, optimizer, seeds = build_ensemble(args, build)
+    batches = _batches(3)
+    stacked = []
+    for batch in batches:
+        losses, _, _ = ensemble(batch)
+        losses.sum().backward()
+        ensemble.clip_grad_norm_(0)
+        optimizer.step()
+        optimizer.zero_grad()
+        stacked.append(losses.detach())
+
+    for i, (seed, lr) in enumerate(zip(seeds, args.ensemble_lrs)):
+        torch.manual_seed(seed)
+        model, criterion, _, _ = build(args)
+        opt = optim.AdamW(model.parameters(), lr=lr, weight_decay=1e-4)
+        for batch, losses in zip(batches, stacked):
+            loss = criterion(model(batch['rgb'], batch['up']), batch['gt'])[0]['Loss']
+            assert loss.item() == pytest.approx(losses[i].item(), rel=1e-5)
+            loss.backward()
+            opt.step()
+            opt.zero_grad()
+        for k, v in model.state_dict().items():
+            torch.testing.assert_close(ensemble.model_state_dict(i)[k], v, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,47 @@
+import json
+import os
+import numpy as np
+import pytest
+import torch
+from UDL.hisr.common.eval_hisr import ShardedEval, eval_cfg
+
+
+def test_more_workers_than_cores_raises():
+    with pytest.raises(ValueError):
+        ShardedEval(eval_cfg(['--variant', 'PSRT', '--workers', '3', '--cores', '0', '1']))
+    sharded = ShardedEval(eval_cfg(['--variant', 'PSRT', '--workers', '2', '--cores', '0', '1', '2']))
+    assert sharded.cores == [[0], [1]]
+
+
+def test_checkpoint_dir_without_checkpoints_raises(tmp_path):
+    with pytest.raises(ValueError, match=str(tmp_path)):
+        ShardedEval(eval_cfg(['--variant', 'PSRT', '--checkpoints', str(tmp_path), '--cores', '0']))
+    with pytest.raises(ValueError):
+        ShardedEval(eval_cfg(['--variant', 'PSRT', '--checkpoints', '--cores', '0']))
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_merge_restores_dataset_order(tmp_path, monkeypatch, mmap):
+    if not mmap:
+        # torch < 2.1 has no mmap argument
+        load = torch.load
+        monkeypatch.setattr(torch, 'load', lambda f, map_location=None, weights_only=None:
+                            load(f, map_location=map_location, weights_only=weights_only))
+    cfg = eval_cfg(['--variant', 'PSRT', '--workers', '2', '--cores', '0', '1', '--out', str(tmp_path),
+                    '--result-format', 'npy'])
+    sharded = ShardedEval(cfg)
+    assert sharded.shards == 2
+    out = sharded.ckpt_dir('')
+    os.makedirs(out)
+    # strided shards of 5 images: 0 2 4 and 1 3
+    for k in range(2):
+        indices = list(range(k, 5, 2))
+        torch.save({'indices': indices, 'metrics': [{'PSNR': float(i)} for i in indices],
+                    'outputs': [torch.full((2, 4, 4), float(i)) for i in indices]},
+                   os.path.join(out, f"shard{k}.pt"))
+    row = sharded.merge('', set())
+    assert row['status'] == 'ok' and row['images'] == 5 and row['PSNR'] == 2.0
+    with open(os.path.join(out, 'metrics.json')) as f:
+        assert [m['PSNR'] for m in json.load(f)] == [0., 1., 2., 3., 4.]
+    outputs = np.load(row['results'], mmap_mode='r')
+    assert [float(o[0, 0, 0]) for o in outputs] == [0., 1., 2., 3., 4.]
@@ -0,0 +1,38 @@
+import contextlib
+import copy
+import importlib
+import io
+import os
+import sys
+import pytest
+import torch
+from UDL.Basis.benchmark import SEARCH_ROOTS, REPO_ROOT, find_builders, load_args, make_batch, capture_inputs
+from UDL.Basis.quantize import quantize_model
+
+BACKEND = 'x86' if 'x86' in torch.backends.quantized.supported_engines else torch.backends.quantized.supported_engines[-1]
+
+
+def _build(name):
+    entry = next(e for e in find_builders({'pansharpening': SEARCH_ROOTS['pansharpening']})
+                 if e['module'].split('.')[-2] == name)
+    sys.path.insert(0, os.path.join(REPO_ROOT, *entry['module'].split('.')[:-1]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = load_args(entry, 'cpu')
+        torch.manual_seed(0)
+        model = getattr(importlib.import_module(entry['module']), entry['builder'])(copy.deepcopy(args))[0]
+    return model.eval()
+
+
+@pytest.mark.parametrize('name', ['PNN', 'PanNet', 'FusionNet'])
+def test_static_quantization_on_cpu(name):
+    model = _build(name)
+    assert all(p.device.type == 'cpu' for p in model.parameters())
+    torch.manual_seed(0)
+    batches = [make_batch('pansharpening', 2, 64) for _ in range(4)]
+    with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+        inputs = capture_inputs(model, batches[0], step='eval_step')
+        qmodel = quantize_model(model, 'static', batches[1:], BACKEND, inputs)
+        ref, out = model.eval_step(batches[0])[0], qmodel.eval_step(batches[0])[0]
+    assert out.shape == ref.shape and out.device.type == 'cpu'
+    # int8 activations: close to the float forward, not equal to it
+    assert (out - ref).abs().max() < 0.1 * ref.abs().max()
@@ -0,0 +1,30 @@
+import h5py
+import numpy as np
+import pytest
+import scipy.io as sio
+import torch
+from UDL.Basis.result_writer import ResultWriter
+
+
+@pytest.mark.parametrize('num', [5, None])
+def test_mat_results_load_with_loadmat(tmp_path, num):
+    # plt_mat.py reads the default format with sio.loadmat
+    outputs = torch.randn(5, 3, 4, 6)
+    path = str(tmp_path / 'out.mat')
+    with ResultWriter(path, 'mat', num=num) as writer:
+        writer.put(0, outputs[:2])
+        for i in range(2, 5):
+            writer.put(i, outputs[i])
+    assert np.array_equal(sio.loadmat(path)['output'], outputs.permute(0, 2, 3, 1).numpy())
+
+
+def test_mat73_results_load_with_h5py(tmp_path):
+    outputs = torch.randn(3, 2, 4, 6)
+    path = str(tmp_path / 'out.mat')
+    with ResultWriter(path, 'mat73') as writer:
+        writer.put(0, outputs)
+    with open(path, 'rb') as f:
+        assert f.read(10) == b'MATLAB 7.3'
+    with h5py.File(path, 'r') as f:
+        # column-major on disk, transposed back to N x H x W x C
+        assert np.array_equal(f['output'][()].transpose(3, 2, 1, 0), outputs.permute(0, 2, 3, 1).numpy())
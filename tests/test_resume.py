@@ -0,0 +1,92 @@
+import copy
+import importlib
+import os
+import sys
+import torch
+from UDL.Basis.auxiliary import set_random_seed
+from UDL.hisr.common.hisr_dataset import HISRSession
+from UDL.hisr.common.main_hisr import EpochRunner
+from UDL.hisr.common.sweep_hisr import variant_modules
+
+
+class Preempted(Exception):
+    pass
+
+
+def _args(out, **overrides):
+    option_module, model_module = variant_modules('Swin_poolv30_shortcut')
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        # run() changes args, the option module's cfg is shared
+        args = copy.deepcopy(importlib.import_module(option_module).cfg)
+    finally:
+        sys.argv = argv
+    args.dataset, args.device, args.epochs, args.resume = 'synthetic', 'cpu', 2, ''
+    args.samples_per_gpu, args.synthetic_num, args.workers_per_gpu = 2, 8, 0
+    args.model_save_dir = str(out)
+    os.makedirs(out, exist_ok=True)
+    args.launcher, args.distributed, args.mode = 'none', False, 'none'
+    args.global_rank = args.local_rank = 0
+    args.use_log = args.use_tb = False
+    args.print_freq, args.save_every_iters = 1, 2
+    args.start_epoch = args.best_epoch = 1
+    args.best_prec1 = 10000
+    for k, v in overrides.items():
+        setattr(args, k, v)
+    return args, importlib.import_module(model_module).build
+
+
+def _train(args, build, stop_after=None):
+    """Per-iteration losses of EpochRunner.run, raising Preempted after ``stop_after`` iterations."""
+    set_random_seed(args.seed)
+    model, criterion, optimizer, scheduler = build(args)
+    losses = []
+    train_step = model.train_step
+
+    def recorder(*inputs, **kwargs):
+        if stop_after is not None and len(losses) == stop_after:
+            raise Preempted()
+        out = train_step(*inputs, **kwargs)
+        losses.append(out['loss'][0]['Loss'].item())
+        return out
+
+    model.train_step = recorder
+    train_loader, train_sampler = HISRSession(args).get_dataloader(args.dataset, args.distributed)
+    try:
+        EpochRunner(args).run(train_loader, model, criterion, optimizer, None, scheduler=scheduler,
+                              train_sampler=train_sampler)
+    except Preempted:
+        pass
+    return losses
+
+
+def test_resumed_run_reproduces_the_loss_trajectory(tmp_path):
+    torch.set_num_threads(1)
+    full = _train(*_args(tmp_path / 'full'))
+    assert len(full) == 8
+
+    # killed in the middle of epoch 2, the last state is the one after its 2nd iteration
+    args, build = _args(tmp_path / 'preempted')
+    first = _train(args, build, stop_after=7)
+    assert first == full[:7]
+    resume = os.path.join(args.model_save_dir, 'resume_state.pth.tar')
+    assert torch.load(resume, weights_only=False)['iter'] == 2
+
+    args, build = _args(tmp_path / 'preempted', resume=resume)
+    assert _train(args, build) == full[6:]
+
+
+def test_bf16_run_saves_and_resumes(tmp_path):
+    # torch.amp bf16 has no apex state and no GradScaler to checkpoint
+    torch.set_num_threads(1)
+    bf16 = dict(amp=True, amp_dtype='bf16', amp_opt_level='O1')
+    full = _train(*_args(tmp_path / 'full', **bf16))
+    assert len(full) == 8
+    checkpoint = torch.load(os.path.join(tmp_path / 'full', '1.pth.tar'), weights_only=False)
+    assert checkpoint['amp'] is None and checkpoint['scaler'] is None
+
+    args, build = _args(tmp_path / 'preempted', **bf16)
+    assert _train(args, build, stop_after=7) == full[:7]
+    resume = os.path.join(args.model_save_dir, 'resume_state.pth.tar')
+    args, build = _args(tmp_path / 'preempted', resume=resume, **bf16)
+    assert _train(args, build) == full[6:]
@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import torch
+from UDL.Basis.benchmark import SEARCH_ROOTS, find_builders, make_batch
+from UDL.Basis.serve import MicroBatcher, InferenceModel, ServeClient, make_server, serve_cfg
+
+
+class Recorder():
+    """Tiny model: 2 * x + y per image, remembers the batch sizes it was called with."""
+
+    def __init__(self):
+        self.sizes = []
+
+    def __call__(self, batch):
+        self.sizes.append(batch['x'].shape[0])
+        return 2 * batch['x'] + batch['y']
+
+
+def test_concurrent_requests_are_batched_and_mapped_back():
+    model = Recorder()
+    server = make_server(model, serve_cfg(['--port', '0', '--max-batch-size', '4', '--max-wait-ms', '500']))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = ServeClient(server.address)
+        requests = [{'x': np.full((2, 5, 6), i, np.float32), 'y': np.full((2, 5, 6), 0.5, np.float32)}
+                    for i in range(8)]
+        with ThreadPoolExecutor(8) as pool:
+            outputs = list(pool.map(client.predict, requests))
+        stats = client.stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.batcher.close()
+    for i, out in enumerate(outputs):
+        assert out.shape == (1, 5, 6, 2)
+        assert np.all(out == 2 * i + 0.5)
+    assert sum(model.sizes) == 8 and max(model.sizes) <= 4
+    # eight requests within the 500 ms window can not all run alone
+    assert len(model.sizes) < 8
+    assert stats['completed'] == 8 and stats['images'] == 8 and stats['mean_batch_size'] > 1
+
+
+def _blocked_batcher(**kwargs):
+    release, seen = threading.Event(), []
+
+    def fn(batch):
+        seen.append(batch['x'][:, 0, 0, 0].tolist())
+        release.wait(10)
+        return batch['x']
+
+    batcher = MicroBatcher(fn, max_batch_size=1, max_wait_ms=0, **kwargs)
+    running = batcher.submit({'x': torch.zeros(1, 1, 2, 2)})
+    while not seen:
+        threading.Event().wait(0.01)
+    return batcher, release, seen, running
+
+
+def test_cancelled_requests_are_not_computed():
+    batcher, release, seen, running = _blocked_batcher()
+    cancelled = batcher.submit({'x': torch.ones(1, 1, 2, 2)})
+    kept = batcher.submit({'x': torch.full((1, 1, 2, 2), 2.)})
+    assert cancelled.cancel()
+    release.set()
+    assert kept.result(10)[0].flatten().tolist() == [2.] * 4
+    batcher.close()
+    assert seen == [[0.], [2.]]
+    assert running.done() and batcher.stats.counts['expired'] == 1
+
+
+def test_expired_requests_are_not_computed():
+    batcher, release, seen, running = _blocked_batcher(timeout_s=0.05)
+    expired = batcher.submit({'x': torch.ones(1, 1, 2, 2)})
+    threading.Event().wait(0.1)
+    release.set()
+    batcher.close()
+    assert seen == [[0.]] and expired.cancelled()
+
+
+def _entry(name):
+    return next(e for e in find_builders(SEARCH_ROOTS) if e['module'].split('.')[-2] == name)
+
+
+@pytest.mark.parametrize('name, task, direct', [('PSRT', 'hisr', True), ('FusionNet', 'pansharpening', False)])
+def test_inference_model_matches_eval_step(name, task, direct):
+    # PSRT returns its forward from eval_step, FusionNet adds lms to it and stays on eval_step
+    model = InferenceModel(_entry(name), serve_cfg([]))
+    torch.manual_seed(0)
+    batch = {k: v for k, v in make_batch(task, 2, 32).items() if k != 'gt'}
+    first = model(batch)
+    assert (model.forward_keys[tuple(sorted(dict(batch, gt=None)))] is not None) == direct
+    calls = []
+    eval_step = model.model.eval_step
+    model.model.eval_step = lambda *a, **kw: calls.append(1) or eval_step(*a, **kw)
+    torch.testing.assert_close(model(batch), first)
+    assert len(calls) == (0 if direct else 1)
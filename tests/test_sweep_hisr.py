@@ -0,0 +1,65 @@
+import csv
+import json
+import os
+from UDL.hisr.common.sweep_hisr import SuccessiveHalving, sweep_cfg, main
+
+
+def _sweep(tmp_path, *extra):
+    cfg = sweep_cfg(['--variants', 'a', '--out', str(tmp_path)] + list(extra))
+    trials = [{'name': n, 'variant': 'PSRT', 'overrides': {}} for n in 'abcd']
+    return SuccessiveHalving(cfg, trials)
+
+
+def _finish(sweep, name, rung, psnr):
+    sweep.results[rung][name] = {'status': 'ok', 'val_PSNR': psnr}
+
+
+def test_sha_promotes_top_fraction_after_the_rung(tmp_path):
+    sweep = _sweep(tmp_path, '--min-epochs', '1', '--max-epochs', '4', '--eta', '2')
+    assert sweep.budgets == [1, 2, 4]
+    jobs = [sweep.next_job() for _ in range(4)]
+    assert jobs == [(n, 0) for n in 'abcd']
+    for name, psnr in zip('abc', [30., 32., 31.]):
+        _finish(sweep, name, 0, psnr)
+    sweep.running = {'d': 0}
+    # sha waits for the whole rung
+    assert sweep.next_job() is None
+    sweep.running = {}
+    sweep.results[0]['d'] = {'status': 'crashed'}
+    assert sweep.next_job() == ('b', 1)
+    assert sweep.next_job() == ('c', 1)
+    assert sweep.next_job() is None
+    _finish(sweep, 'b', 1, 33.)
+    _finish(sweep, 'c', 1, 34.)
+    assert sweep.next_job() == ('c', 2)
+    _finish(sweep, 'c', 2, 35.)
+    assert sweep.next_job() is None
+    assert sweep.winner() == ('c', 2)
+
+
+def test_asha_promotes_without_waiting(tmp_path):
+    sweep = _sweep(tmp_path, '--min-epochs', '1', '--max-epochs', '2', '--eta', '2', '--asynchronous')
+    assert sweep.next_job() == ('a', 0)
+    assert sweep.next_job() == ('b', 0)
+    _finish(sweep, 'a', 0, 30.)
+    _finish(sweep, 'b', 0, 31.)
+    assert sweep.next_job() == ('b', 1)
+
+
+def test_synthetic_sweep_on_cpu(tmp_path):
+    configs = tmp_path / 'configs.json'
+    configs.write_text(json.dumps([{'name': f'lr{lr}', 'variant': 'Swin_poolv30_shortcut', 'overrides': {'lr': lr}}
+                                   for lr in (1e-3, 1e-7)]))
+    out = tmp_path / 'sweep'
+    best = main(['--configs', str(configs), '--dataset', 'synthetic', '--device', 'cpu', '--min-epochs', '1',
+                 '--max-epochs', '2', '--eta', '2', '--jobs', '2', '--override', 'samples_per_gpu=2',
+                 'synthetic_num=4', '--out', str(out)])
+    with open(out / 'results.csv') as f:
+        rows = list(csv.DictReader(f))
+    assert all(r['status'] == 'ok' for r in rows), rows
+    assert sorted(r['name'] for r in rows if r['rung'] == '0') == ['lr0.001', 'lr1e-07']
+    assert [r['name'] for r in rows if r['rung'] == '1'] == [best]
+    # the survivor resumed from its rung 0 checkpoint
+    with open(out / best / 'rung1.spec.json') as f:
+        spec = json.load(f)
+    assert spec['resume'] == os.path.join(str(out / best), '1.pth.tar') and os.path.isfile(spec['resume'])
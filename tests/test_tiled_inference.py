@@ -0,0 +1,101 @@
+import types
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from UDL.Basis.module import tiled_inference, PatchMergeModule
+
+
+class Fusion(nn.Module):
+    """up (H, W), rgb (H, W) and lrhsi (H / 4, W / 4) to a x``scale`` output, like the HISR models."""
+
+    def __init__(self, scale=1, kernel_size=1):
+        super(Fusion, self).__init__()
+        self.scale = scale
+        self.head = nn.Conv2d(34, 31 * scale ** 2, kernel_size, 1, kernel_size // 2)
+        self.lr = nn.Conv2d(31, 31 * scale ** 2, 1)
+
+    def forward(self, up, rgb, lrhsi):
+        x = self.head(torch.cat((up, rgb), 1)) + F.interpolate(self.lr(lrhsi), scale_factor=4, mode='nearest')
+        return F.pixel_shuffle(x, self.scale) if self.scale > 1 else x
+
+
+def _inputs(h, w, b=2):
+    g = torch.Generator().manual_seed(0)
+    return (torch.rand(b, 31, h, w, generator=g), torch.rand(b, 3, h, w, generator=g),
+            torch.rand(b, 31, h // 4, w // 4, generator=g))
+
+
+@pytest.mark.parametrize('window', ['gaussian', 'cosine', 'uniform'])
+@pytest.mark.parametrize('scale', [1, 2])
+def test_tiled_matches_untiled(window, scale):
+    torch.manual_seed(0)
+    model = Fusion(scale).eval()
+    # 72 x 88 needs padding on both axes, lrhsi is tiled at 1/4 of the tile grid
+    x = _inputs(72, 88)
+    with torch.no_grad():
+        ref = model(*x)
+    out = tiled_inference(model, *x, tile_size=32, overlap=8, window=window, tiles_per_batch=3)
+    assert out.shape == ref.shape
+    torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-5)
+
+
+def test_blending_windows_hide_tile_borders():
+    # a 3x3 conv sees zero padding at every tile border, the windows down-weight those pixels
+    torch.manual_seed(0)
+    model = Fusion(kernel_size=3).eval()
+    x = _inputs(96, 96, b=1)
+    with torch.no_grad():
+        ref = model(*x)
+    err = {window: (tiled_inference(model, *x, tile_size=32, overlap=16, window=window) - ref).abs().max()
+           for window in ['gaussian', 'cosine', 'uniform']}
+    assert err['gaussian'] < 0.1 * err['uniform'] and err['cosine'] < 0.1 * err['uniform']
+    assert err['gaussian'] < 1e-2 * ref.abs().max()
+
+
+def test_pointwise_model_is_exact_with_padding():
+    model = nn.Conv2d(31, 8, 1).eval()
+    x = torch.rand(1, 31, 50, 70)
+    with torch.no_grad():
+        ref = model(x)
+    torch.testing.assert_close(tiled_inference(model, x, tile_size=24, overlap=8), ref, rtol=1e-5, atol=1e-6)
+
+
+def test_several_outputs():
+    model = nn.Conv2d(31, 8, 1).eval()
+    x = torch.rand(1, 31, 40, 40)
+    out = tiled_inference(lambda t: (model(t), 2 * model(t)), x, tile_size=16, overlap=4)
+    assert isinstance(out, list) and len(out) == 2
+    torch.testing.assert_close(out[1], 2 * out[0])
+
+
+class ChopFusion(PatchMergeModule, Fusion):
+
+    def __init__(self, args):
+        super(ChopFusion, self).__init__()
+        self.args = args
+
+
+def test_forward_chop_clamps_an_overlap_larger_than_the_patch():
+    # --tile-overlap defaults to 16, models trained on 16 px patches still tile with a quarter overlap
+    torch.manual_seed(0)
+    args = types.SimpleNamespace(patch_size=16, tile_size=0, tile_overlap=16, crop_batch_size=4)
+    model = ChopFusion(args).eval()
+    x = _inputs(40, 40, b=1)
+    with torch.no_grad():
+        ref = model(*x)
+    torch.testing.assert_close(model.forward_chop(*x), ref, rtol=1e-5, atol=1e-5)
+
+
+def test_invalid_tiles_raise():
+    model = Fusion().eval()
+    with pytest.raises(ValueError, match='multiples of 4'):
+        tiled_inference(model, *_inputs(64, 64), tile_size=30, overlap=8)
+    with pytest.raises(ValueError, match='integer fraction'):
+        tiled_inference(model, torch.rand(1, 31, 64, 64), torch.rand(1, 3, 64, 64), torch.rand(1, 31, 15, 15),
+                        tile_size=32, overlap=8)
+    with pytest.raises(ValueError, match='smaller than the tile size'):
+        tiled_inference(model, *_inputs(64, 64), tile_size=16, overlap=16)
+    # x1/2 outputs (a strided model) cannot be blended at the input tile grid
+    with pytest.raises(ValueError, match='integer upscaling'):
+        tiled_inference(nn.Conv2d(31, 8, 2, 2), torch.rand(1, 31, 64, 64), tile_size=32, overlap=8)
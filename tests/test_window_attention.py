@@ -0,0 +1,70 @@
+import pytest
+import torch
+from UDL.Basis import module
+from UDL.Basis.module import window_attention, shifted_window_mask
+
+
+def _qkv(B=2, H=16, W=16, ws=4, nH=3, d=8):
+    g = torch.Generator().manual_seed(0)
+    nW, N = (H // ws) * (W // ws), ws * ws
+    q, k, v = (torch.randn(B * nW, nH, N, d, generator=g) for _ in range(3))
+    bias = torch.randn(nH, N, N, generator=g)
+    mask = shifted_window_mask(H, W, ws, ws // 2, 'cpu')
+    return q, k, v, bias, mask, d ** -0.5
+
+
+@pytest.mark.parametrize('with_bias', [False, True])
+@pytest.mark.parametrize('with_mask', [False, True])
+@pytest.mark.parametrize('sdpa_scale', [False, True])
+def test_fused_matches_reference(monkeypatch, with_bias, with_mask, sdpa_scale):
+    # sdpa_scale=False is the torch 2.0 path, q pre-scaled instead of scale=
+    monkeypatch.setattr(module, '_SDPA_SCALE', sdpa_scale)
+    q, k, v, bias, mask, scale = _qkv()
+    bias, mask = bias if with_bias else None, mask if with_mask else None
+    ref = window_attention(q, k, v, 0.7 * scale, bias=bias, mask=mask, fused=False)
+    out = window_attention(q, k, v, 0.7 * scale, bias=bias, mask=mask, fused=True)
+    torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-5)
+
+
+def test_fused_matches_reference_in_backward():
+    q, k, v, bias, mask, scale = _qkv()
+    grads = []
+    for fused in (False, True):
+        leaves = [t.clone().requires_grad_() for t in (q, k, v, bias)]
+        window_attention(*leaves[:3], scale, bias=leaves[3], mask=mask, fused=fused).square().sum().backward()
+        grads.append([t.grad for t in leaves])
+    for ref, out in zip(*grads):
+        torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+def test_dropout_only_with_positive_p():
+    q, k, v, bias, mask, scale = _qkv()
+    ref = window_attention(q, k, v, scale, fused=False)
+    torch.testing.assert_close(window_attention(q, k, v, scale, dropout_p=0., fused=False), ref)
+    torch.manual_seed(0)
+    assert not torch.allclose(window_attention(q, k, v, scale, dropout_p=0.5, fused=False), ref)
+
+
+def test_sdpa_scale_compares_versions_not_strings(monkeypatch):
+    # '10.0' < '2.1' as strings
+    for version, expected in [('2.0.1', False), ('2.1.0', True), ('2.10.0+cu121', True), ('2.2.0a0+git1234', True),
+                              ('10.0.0', True)]:
+        monkeypatch.setattr(torch, '__version__', version)
+        assert module._torch_at_least('2.1') == expected
+
+
+def test_relative_position_bias_cache_drops_data_writes_on_mode_switch():
+    from UDL.hisr.HISR.SWAT_baselinev2.swat import WindowAttention
+    attn = WindowAttention(16, (4, 4), 2).eval()
+    table = attn.relative_position_bias_table
+    with torch.no_grad():
+        first = module.get_relative_position_bias(attn)
+        # an EMA / fp16 master copy: .data writes keep the version counter
+        table.data.copy_(torch.randn_like(table))
+        assert module.get_relative_position_bias(attn) is first
+        attn.eval()
+        expected = table[attn.relative_position_index.view(-1)].view(16, 16, -1).permute(2, 0, 1)
+        torch.testing.assert_close(module.get_relative_position_bias(attn), expected)
+        state = dict(attn.state_dict(), relative_position_bias_table=table + 1)
+        attn.load_state_dict(state, assign=True)
+        torch.testing.assert_close(module.get_relative_position_bias(attn), expected + 1)
@@ -0,0 +1,97 @@
+import pytest
+import torch
+from einops import rearrange
+from UDL.Basis.window_ops import Win_Shuffle, Win_Reshuffle, Win_Dila, Win_ReDila
+
+
+# the implementations the models carried before UDL.Basis.window_ops
+def _window_partition(x, window_size):
+    B, H, W, C = x.shape
+    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
+    return x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
+
+
+def _window_reverse(windows, window_size, H, W):
+    B = int(windows.shape[0] / (H * W / window_size / window_size))
+    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
+    return x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
+
+
+def _win_shuffle(x, win_size):
+    B, C, H, W = x.shape
+    dilation = win_size // 2
+    N1, N2 = H // dilation, W // dilation
+    x = rearrange(x, 'B C H W -> B H W C')
+    x = _window_partition(x, dilation).reshape(-1, N1, N2, C * dilation ** 2)
+    xt = torch.zeros_like(x)
+    xt[:, 0:N1 // 2, 0:N2 // 2, :] = x[:, 0::2, 0::2, :]
+    xt[:, 0:N1 // 2, N2 // 2:N2, :] = x[:, 0::2, 1::2, :]
+    xt[:, N1 // 2:N1, 0:N2 // 2, :] = x[:, 1::2, 0::2, :]
+    xt[:, N1 // 2:N1, N2 // 2:N2, :] = x[:, 1::2, 1::2, :]
+    xt = _window_reverse(xt.reshape(-1, dilation, dilation, C), dilation, H, W)
+    return rearrange(xt, 'B H W C -> B C H W')
+
+
+def _win_reshuffle(x, win_size):
+    B, C, H, W = x.shape
+    dilation = win_size // 2
+    N1, N2 = H // dilation, W // dilation
+    x = rearrange(x, 'B C H W -> B H W C')
+    x = _window_partition(x, dilation).reshape(-1, N1, N2, C * dilation ** 2)
+    xt = torch.zeros_like(x)
+    xt[:, 0::2, 0::2, :] = x[:, 0:N1 // 2, 0:N2 // 2, :]
+    xt[:, 0::2, 1::2, :] = x[:, 0:N1 // 2, N2 // 2:N2, :]
+    xt[:, 1::2, 0::2, :] = x[:, N1 // 2:N1, 0:N2 // 2, :]
+    xt[:, 1::2, 1::2, :] = x[:, N1 // 2:N1, N2 // 2:N2, :]
+    xt = _window_reverse(xt.reshape(-1, dilation, dilation, C), dilation, H, W)
+    return rearrange(xt, 'B H W C -> B C H W')
+
+
+def _win_dila(x, win_size):
+    n_win = win_size * 2
+    B, H, W, C = x.shape
+    x = x.reshape(-1, H // n_win, n_win, W // n_win, n_win, C).permute(0, 1, 3, 2, 4, 5)
+    xt = torch.zeros_like(x)
+    xt[:, :, :, 0:n_win // 2, 0:n_win // 2, :] = x[:, :, :, 0::2, 0::2, :]
+    xt[:, :, :, 0:n_win // 2, n_win // 2:n_win, :] = x[:, :, :, 0::2, 1::2, :]
+    xt[:, :, :, n_win // 2:n_win, 0:n_win // 2, :] = x[:, :, :, 1::2, 0::2, :]
+    xt[:, :, :, n_win // 2:n_win, n_win // 2:n_win, :] = x[:, :, :, 1::2, 1::2, :]
+    return xt.permute(0, 1, 3, 2, 4, 5).reshape(-1, H, W, C)
+
+
+def _win_redila(x, win_size):
+    n_win = win_size * 2
+    B, H, W, C = x.shape
+    x = x.reshape(-1, H // n_win, n_win, W // n_win, n_win, C).permute(0, 1, 3, 2, 4, 5)
+    xt = torch.zeros_like(x)
+    xt[:, :, :, 0::2, 0::2, :] = x[:, :, :, 0:n_win // 2, 0:n_win // 2, :]
+    xt[:, :, :, 0::2, 1::2, :] = x[:, :, :, 0:n_win // 2, n_win // 2:n_win, :]
+    xt[:, :, :, 1::2, 0::2, :] = x[:, :, :, n_win // 2:n_win, 0:n_win // 2, :]
+    xt[:, :, :, 1::2, 1::2, :] = x[:, :, :, n_win // 2:n_win, n_win // 2:n_win, :]
+    return xt.permute(0, 1, 3, 2, 4, 5).reshape(-1, H, W, C)
+
+
+SHAPES = [(1, 3, 8, 8, 4), (2, 5, 16, 8, 4), (2, 4, 16, 24, 8), (1, 2, 32, 32, 2)]
+
+
+@pytest.mark.parametrize('B, C, H, W, win_size', SHAPES)
+def test_shuffles_match_the_loop_implementations(B, C, H, W, win_size):
+    x = torch.randn(B, C, H, W)
+    assert torch.equal(Win_Shuffle(x, win_size), _win_shuffle(x, win_size))
+    assert torch.equal(Win_Reshuffle(x, win_size), _win_reshuffle(x, win_size))
+    assert torch.equal(Win_Reshuffle(Win_Shuffle(x, win_size), win_size), x)
+
+
+@pytest.mark.parametrize('B, C, H, W, win_size', [(1, 3, 8, 8, 4), (2, 5, 16, 8, 2), (2, 4, 16, 32, 8)])
+def test_dilations_match_the_loop_implementations(B, C, H, W, win_size):
+    x = torch.randn(B, H, W, C)
+    assert torch.equal(Win_Dila(x, win_size), _win_dila(x, win_size))
+    assert torch.equal(Win_ReDila(x, win_size), _win_redila(x, win_size))
+    assert torch.equal(Win_ReDila(Win_Dila(x, win_size), win_size), x)
+
+
+def test_sizes_that_are_not_window_multiples_raise():
+    with pytest.raises(AssertionError):
+        Win_Shuffle(torch.randn(1, 3, 12, 8), 8)
+    with pytest.raises(AssertionError):
+        Win_ReDila(torch.randn(1, 12, 8, 3), 4)